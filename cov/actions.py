@@ -0,0 +1,233 @@
+"""
+Structured (function calling) protocol for chat actions and view selection.
+
+Tool calls are converted to the canonical action strings of the text protocol, e.g.
+"forward-movement+2" or "done+[a red chair]", so the rest of the agent is unchanged.
+Replies without a valid tool call fall back to the regex parsing of their text.
+"""
+
+import copy
+import json
+import logging
+import re
+from typing import Optional
+
+from cov.utils import extract_patterns, extract_target, extract_zoom
+
+log = logging.getLogger(__name__)
+
+ACTION_PROTOCOLS = ("text", "tools")
+
+MOVE_DIRECTIONS = ["forward", "backward", "left", "right", "upward", "downward"]
+ROTATE_DIRECTIONS = ["left", "right"]
+
+ACTION_TOOL = {
+    "type": "function",
+    "function": {
+        "name": "take_action",
+        "description": "Perform exactly one camera action, or give the final answer.",
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "action": {
+                    "type": "string",
+                    "enum": [
+                        "move",
+                        "rotate",
+                        "switch_view",
+                        "bird_eye_view",
+                        "look_around",
+                        "zoom",
+                        "look_at",
+                        "go_to",
+                        "answer",
+                    ],
+                },
+                "direction": {
+                    "type": "string",
+                    "enum": MOVE_DIRECTIONS,
+                    "description": "For move: any direction, for rotate: left or right.",
+                },
+                "amount": {
+                    "type": "integer",
+                    "description": "Steps for move, degrees for rotate.",
+                },
+                "view_id": {"type": "integer", "description": "For switch_view."},
+                "x": {
+                    "type": "integer",
+                    "description": "For zoom, look_at and go_to: 0-1000 from the left.",
+                },
+                "y": {
+                    "type": "integer",
+                    "description": "For zoom, look_at and go_to: 0-1000 from the top.",
+                },
+                "factor": {"type": "integer", "description": "For zoom: magnification."},
+                "answer": {"type": "string", "description": "For answer."},
+            },
+            "required": ["action"],
+        },
+    },
+}
+
+SELECTION_TOOL = {
+    "type": "function",
+    "function": {
+        "name": "select_views",
+        "description": "Select the view ids that best answer the question.",
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "view_ids": {"type": "array", "items": {"type": "integer"}},
+            },
+            "required": ["view_ids"],
+        },
+    },
+}
+
+BATCH_SELECTION_TOOL = {
+    "type": "function",
+    "function": {
+        "name": "select_views_batch",
+        "description": "Select view ids for every question label, e.g. {\"Q1\": [3, 7]}.",
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "selections": {
+                    "type": "object",
+                    "additionalProperties": {"type": "array", "items": {"type": "integer"}},
+                },
+            },
+            "required": ["selections"],
+        },
+    },
+}
+
+
+def action_tool(look_around: bool = False, zoom: bool = False, targeting: bool = False) -> dict:
+    """
+    ``ACTION_TOOL`` advertising only the enabled actions.
+    """
+    actions = ["move", "rotate", "switch_view", "bird_eye_view"]
+    if look_around:
+        actions.append("look_around")
+    if zoom:
+        actions.append("zoom")
+    if targeting:
+        actions += ["look_at", "go_to"]
+    actions.append("answer")
+
+    tool = copy.deepcopy(ACTION_TOOL)
+    properties = tool["function"]["parameters"]["properties"]
+    properties["action"]["enum"] = actions
+    if not zoom:
+        del properties["factor"]
+    if not (zoom or targeting):
+        del properties["x"], properties["y"]
+    return tool
+
+
+def tool_kwargs(tool: dict) -> dict:
+    """
+    Completion kwargs forcing a call of ``tool``.
+    """
+    return {
+        "tools": [tool],
+        "tool_choice": {"type": "function", "function": {"name": tool["function"]["name"]}},
+    }
+
+
+def tool_arguments(tool_calls: list, name: str) -> Optional[dict]:
+    """
+    Arguments of the first call of tool ``name``, or None if missing or not JSON.
+    """
+    for call in tool_calls or []:
+        if call["name"] != name:
+            continue
+        try:
+            arguments = json.loads(call["arguments"] or "{}")
+        except json.JSONDecodeError:
+            return None
+        return arguments if isinstance(arguments, dict) else None
+    return None
+
+
+def action_from_arguments(arguments: dict, actions: list = None) -> Optional[str]:
+    """
+    Canonical action string of ``take_action`` arguments, None if they are invalid or
+    the action is not one of ``actions`` (default: all).
+    """
+    action = arguments.get("action")
+    if actions is not None and action not in actions:
+        return None
+    direction = arguments.get("direction")
+    amount = arguments.get("amount")
+    if action == "move" and direction in MOVE_DIRECTIONS and isinstance(amount, int) and amount > 0:
+        return f"{direction}-movement+{amount}"
+    if action == "rotate" and direction in ROTATE_DIRECTIONS and isinstance(amount, int) and amount > 0:
+        return f"{direction}-rotation+{amount}"
+    if action == "switch_view" and isinstance(arguments.get("view_id"), int):
+        return f"switch to view {arguments['view_id']}"
+    if action == "bird_eye_view":
+        return "switch to bird-eye-view"
+    if action == "look_around":
+        return "look-around"
+    if action == "zoom" and all(
+        isinstance(arguments.get(key), int) for key in ("x", "y", "factor")
+    ):
+        return f"zoom+{arguments['x']},{arguments['y']},{arguments['factor']}"
+    if action in ("look_at", "go_to") and all(
+        isinstance(arguments.get(key), int) for key in ("x", "y")
+    ):
+        return f"{action.replace('_', '-')}+{arguments['x']},{arguments['y']}"
+    if action == "answer" and str(arguments.get("answer") or "").strip():
+        return f"done+[{arguments['answer'].strip()}]"
+    return None
+
+
+def is_action(text: str) -> bool:
+    """
+    Whether the text protocol finds an action or answer in a reply.
+    """
+    return (
+        "done" in text.lower()
+        or "switch to bird-eye-view" in text
+        or "look-around" in text
+        or extract_zoom(text) is not None
+        or extract_target(text) is not None
+        or bool(extract_patterns(text))
+    )
+
+
+def selection_from_tool_calls(tool_calls: list) -> Optional[str]:
+    """
+    ``select_views`` call as "selected views: 1, 2, 3", or None.
+    """
+    arguments = tool_arguments(tool_calls, SELECTION_TOOL["function"]["name"])
+    if arguments is None:
+        return None
+    view_ids = arguments.get("view_ids")
+    if not isinstance(view_ids, list) or not all(isinstance(v, int) for v in view_ids):
+        return None
+    return f"selected views: {', '.join(map(str, view_ids))}"
+
+
+def batch_selection_from_tool_calls(tool_calls: list) -> Optional[str]:
+    """
+    ``select_views_batch`` call as the JSON text of the batched selection reply, or None.
+    """
+    arguments = tool_arguments(tool_calls, BATCH_SELECTION_TOOL["function"]["name"])
+    if arguments is None or not isinstance(arguments.get("selections"), dict):
+        return None
+    return json.dumps(arguments["selections"])
+
+
+def parse_selected_views(selection: str) -> list:
+    """
+    View ids of a "selected views: A, B, C" reply, empty if there are none.
+    """
+    pattern = r"selected\s*views?\s*[:=]?\s*\[?([\d,\s]+)\]?"
+    match = re.search(pattern, selection, re.IGNORECASE)
+    if not match:
+        return []
+    # findall tolerates trailing commas and stray whitespace.
+    return [int(v) for v in re.findall(r"\d+", match.group(1))]
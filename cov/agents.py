@@ -1,14 +1,24 @@
+import hashlib
 import logging
 import os
-import re
-
-from cov.bots import BaselineBot, Chatbot, ViewSelectionBot
-from cov.camera import Camera
+from dataclasses import dataclass
+from typing import Optional
+
+from cov import ledger, replay
+from cov.actions import parse_selected_views
+from cov.branches import explore_branches
+from cov.bots import BaselineBot, BatchViewSelectionBot, Chatbot, ViewSelectionBot
+from cov.camera import get_camera
 from cov.config import OpenEQAConfig
+from cov.coverage import CoverageMemory
+from cov.execution import execute_action
+from cov.retrieval import get_retriever
+from cov.tracing import span
 from cov.utils import (
     build_agent_output_paths,
     extract_answer,
     is_mostly_blank,
+    parse_batch_selection,
     process_openeqa_path,
 )
 from tools.html_generator import HTMLGenerator
@@ -22,9 +32,11 @@ def cov_agent(
     question: str = "What is the white object on the wall above the TV?",
     gts=["Air conditioning unit"],
     config: OpenEQAConfig = None,
+    preselected_views: list = None,
 ):
     """
     Agent query for one question.
+    ``preselected_views`` skips view selection, e.g. when done by ``batch_view_selection``.
     """
     log.info(f"Question ID: {question_id}")
 
@@ -45,23 +57,40 @@ def cov_agent(
 
     log.info(f"Loading GLB from: {glb_path}")
 
-    cam1 = Camera(ply_path=glb_path, pose_path=pose_path, rgb_img_path=rgb_img_path)
-
-    selbot = ViewSelectionBot(
-        question=question,
-        rgb_img_list=cam1.view_img_list,
-        max_views=config.max_views_k,
-        model_config=config.model,
-    )
+    with span("camera_init", agent="cov", scene=episode_history):
+        cam1 = get_camera(
+            glb_path,
+            pose_path,
+            rgb_img_path,
+            cache_size=config.scene_cache_size,
+            render_config=config.render,
+            num_agents=config.concurrent_questions,
+        )
 
-    selection = selbot.invoke()
-    pattern = r"selected\s*views?\s*[:=]?\s*\[?([\d,\s]+)\]?"
-    match = re.search(pattern, selection, re.IGNORECASE)
-    sel_views = []
-    if match:
-        sel_views = [int(v.strip()) for v in match.group(1).split(",")]
+    shortlist = None
+    if preselected_views is not None:
+        sel_views = preselected_views
     else:
-        log.error("No matching pattern found for 'selected views: '")
+        if config.retrieval.enabled:
+            shortlist = shortlist_views(
+                episode_history, [question], cam1.view_img_list, config
+            )
+        with span("view_selection", views=len(shortlist or cam1.view_img_list)):
+            with span("payload_build", bot="selection"):
+                selbot = ViewSelectionBot(
+                    question=question,
+                    rgb_img_list=cam1.view_img_list,
+                    max_views=config.max_views_k,
+                    view_ids=shortlist,
+                    model_config=config.model,
+                    protocol=config.action_protocol,
+                )
+
+            selection = selbot.invoke()
+        sel_views = parse_selected_views(selection)
+        if not sel_views:
+            ledger.count("malformed_output")
+            log.error("No matching pattern found for 'selected views: '")
     sel_views = sel_views[: config.max_views_k]
     sel_view_path_list = {
         sel_view: cam1.view_img_list[sel_view] for sel_view in sel_views
@@ -70,7 +99,15 @@ def cov_agent(
     best5_urls = list(sel_view_path_list.values())
     html_generator.set_best5(best5_urls)
 
-    birdeye_path = cam1.shot_birdeye_view(screen_shot_dir)
+    if config.render.top_down_map:
+        # The bird-eye shot used to move the camera, start from the best view instead.
+        if sel_views:
+            cam1.switch_to_view(sel_views[0])
+        with span("render", kind="top_down_map"):
+            birdeye_path = cam1.top_down_map(screen_shot_dir)
+    else:
+        with span("render", kind="birdeye"):
+            birdeye_path = cam1.shot_birdeye_view(screen_shot_dir)
     html_generator.set_birdeye(birdeye_path)
 
     answer = None
@@ -78,33 +115,114 @@ def cov_agent(
     prev_action = None
     total_action_cnt = 0
     switch_to_birdeye = False
+    override_path = None  # Panorama or close-up to show instead of the next screenshot.
+    snapshots = []  # Intermediate frames of the last macro step.
+    coverage = None
+    if config.coverage.enabled:
+        coverage = CoverageMemory(config.coverage.voxel_size, config.coverage.yaw_bins)
+
+    with span("payload_build", bot="chat"):
+        chatbot = Chatbot(
+            question=question,
+            view_ids=list(range(len(cam1.view_pose_list))),
+            best5_view_list=sel_view_path_list,
+            bird_eye_view=birdeye_path,
+            max_views=config.max_views_k,
+            min_action_step=config.min_action_step,
+            model_config=config.model,
+            stream=config.stream.enabled,
+            early_stop=config.stream.early_stop,
+            protocol=config.action_protocol,
+            repair_retries=config.action_repair_retries,
+            max_actions_per_step=config.macro_max_actions if config.macro_steps else 1,
+            look_around_views=config.look_around_views,
+            zoom=config.render.zoom,
+            targeting=config.render.targeting,
+            top_down_map=config.render.top_down_map,
+        )
 
-    chatbot = Chatbot(
-        question=question,
-        view_ids=list(range(len(cam1.view_pose_list))),
-        best5_view_list=sel_view_path_list,
-        bird_eye_view=birdeye_path,
-        max_views=config.max_views_k,
-        min_action_step=config.min_action_step,
-        model_config=config.model,
-    )
+    if config.branches.enabled and len(sel_views) > 1:
+        with span("branches", branches=len(sel_views)):
+            answer, total_action_cnt = explore_branches(
+                chatbot,
+                cam1,
+                sel_views,
+                birdeye_path,
+                screen_shot_dir,
+                html_generator,
+                question,
+                config,
+            )
+        html_generator.set_answer(answer)
 
     # query loop
-    while total_action_cnt <= 65:
-        image_path = (
-            birdeye_path if switch_to_birdeye else cam1.screen_shot(screen_shot_dir)
-        )
-        switch_to_birdeye = False
-        total_action_cnt += 1
-
-        try:
-            if is_mostly_blank(image_path):
-                cam1.switch_back_view()
+    pre_action_state = None  # Camera state before the last action, to undo it.
+    step_image_path = None  # View the last action was chosen on.
+    while answer is None and total_action_cnt <= 65:
+        note = None
+        with span("render", kind="step", step=total_action_cnt + 1) as render_attrs:
+            if override_path is not None:
+                image_path = override_path
+            elif switch_to_birdeye:
+                image_path = birdeye_path
+            elif coverage is not None:
+                state = cam1.get_state()
+                revisit = coverage.lookup(state)
+                if (
+                    revisit is not None
+                    and config.coverage.reuse_frames
+                    and coverage.same_pose(
+                        revisit,
+                        state,
+                        config.coverage.reuse_distance,
+                        config.coverage.reuse_angle,
+                    )
+                ):
+                    render_attrs["reused"] = True
+                    image_path = revisit.image_path
+                else:
+                    image_path = cam1.screen_shot(screen_shot_dir)
+            else:
                 image_path = cam1.screen_shot(screen_shot_dir)
-                text = "You are moving to a blank view and I switched back. Please resume from the view I provided and continue to give adjustment instructions or provide answer."
-                action = chatbot.invoke_in_text(text=text, img_path=image_path)
+
+        # A streamed reply was executed early, the rest of it arrived meanwhile.
+        full_reply = chatbot.finish()
+        if full_reply is not None:
+            # Undo the early action, the full reply is executed as the action of the
+            # same step and the view above is discarded.
+            cam1.set_state(pre_action_state)
+            action, image_path = full_reply, step_image_path
+        else:
+            if coverage is not None and override_path is None and not switch_to_birdeye:
+                if revisit is not None:
+                    ledger.count("revisit")
+                coverage.record(state, total_action_cnt + 1, image_path)
+                note = coverage.summary(state, revisit)
+            total_action_cnt += 1
+
+        with span("step", step=total_action_cnt) as step_attrs:
+            if full_reply is None:
+                with span("blank_check"):
+                    is_blank = is_mostly_blank(image_path)
+                if is_blank:
+                    cam1.switch_back_view()
+                    with span("render", kind="switch_back"):
+                        image_path = cam1.screen_shot(screen_shot_dir)
+                    text = "You are moving to a blank view and I switched back. Please resume from the view I provided and continue to give adjustment instructions or provide answer."
+                    action = chatbot.invoke_in_text(
+                        text=text,
+                        img_path=image_path,
+                        step=total_action_cnt,
+                        snapshots=snapshots,
+                    )
+                else:
+                    action = chatbot.invoke(image_path, total_action_cnt, snapshots, note)
+                step_image_path = image_path
             else:
-                action = chatbot.invoke(image_path, total_action_cnt)
+                step_attrs["corrected"] = True
+            switch_to_birdeye = False
+            override_path = None
+            snapshots = []
 
             # 检测重复动作
             if action == prev_action and "switch" not in action:
@@ -113,44 +231,163 @@ def cov_agent(
             if action_repetition >= 10:
                 print(f"Too many times with action: {action}, changing to another...")
                 text = "You have repeated this instruction too many times. Please try to use other instructions to get the proper view or answer the question if you can."
-                action = chatbot.invoke_in_text(text=text, img_path=image_path)
+                action = chatbot.invoke_in_text(
+                    text=text, img_path=image_path, step=total_action_cnt
+                )
                 action_repetition = 0
 
             prev_action = action
 
             html_generator.add_step(image_path, action)
 
-            if "switch to bird-eye-view" in action:
-                switch_to_birdeye = True
-            else:
-                cam1.exec_instruction(action)
+            step_attrs["action"] = action
+            pre_action_state = cam1.get_state()
+            outcome = execute_action(
+                cam1, action, screen_shot_dir, config, chatbot.max_actions_per_step
+            )
+            override_path, switch_to_birdeye = outcome.override_path, outcome.show_birdeye
+            snapshots = outcome.snapshots
+            for snapshot_path in snapshots:
+                html_generator.add_step(snapshot_path, "snapshot")
+
+            episode = replay.current()
+            if episode is not None:
+                episode.on_step(total_action_cnt, action, cam1.get_state())
 
             if "done" in action.lower():
                 answer = extract_answer(action)
                 html_generator.set_answer(answer)
                 log.info(f"{question_id} token usage: {chatbot.get_token_usage()}")
                 break
-        except Exception as e:
-            raise e
 
     # If answer is None, it means exceeding maximum turns
     if answer is None:
         raise Exception("Exceeds maximum turns")
 
     # Save query history html
-    html_content = html_generator.generate_html()
-    with open(local_html_path, "w") as f:
-        f.write(html_content)
+    with span("write_html"):
+        html_content = html_generator.generate_html()
+        with open(local_html_path, "w") as f:
+            f.write(html_content)
     log.info(f"Local HTML saved to: {local_html_path}")
 
     return {
         "question_id": question_id,
         "answer": answer,
         "action_steps": total_action_cnt,
-        "token_consumption": chatbot.usage_info,
+        "token_consumption": chatbot.get_token_usage(),
+        "selected_views": sel_views,
+        "shortlist": shortlist,
     }
 
 
+def shortlist_views(
+    episode_history: str,
+    questions: list,
+    view_img_list: list,
+    config: OpenEQAConfig = None,
+) -> list:
+    """
+    Union of the retrieval shortlists of ``questions``, in view order.
+    """
+    retriever = get_retriever(config.retrieval)
+    with span("retrieval", views=len(view_img_list), questions=len(questions)) as attrs:
+        shortlist = set()
+        for question in questions:
+            shortlist.update(retriever.shortlist(episode_history, question, view_img_list))
+        attrs["shortlisted"] = len(shortlist)
+    return sorted(shortlist)
+
+
+@dataclass
+class Preselection:
+    """
+    Views chosen for one question by a batched selection request.
+    ``views`` is None when the reply had no valid selection for the question.
+    ``calls`` are the ledger records of the request, shared by ``share`` of each.
+    """
+
+    views: Optional[list]
+    calls: list
+    share: float
+
+
+def batch_view_selection(
+    episode_history: str,
+    items: list,
+    config: OpenEQAConfig = None,
+) -> dict:
+    """
+    Select views for several questions of one scene, sending the scene frames once per
+    ``config.selection_batch_size`` questions. Returns question_id -> ``Preselection``.
+    """
+    glb_path, pose_path, rgb_img_path = map(
+        lambda x: config.dataset_dir / x, process_openeqa_path(episode_history)
+    )
+    with span("camera_init", agent="cov", scene=episode_history):
+        cam1 = get_camera(
+            glb_path,
+            pose_path,
+            rgb_img_path,
+            cache_size=config.scene_cache_size,
+            render_config=config.render,
+            num_agents=config.concurrent_questions,
+        )
+    num_views = len(cam1.view_img_list)
+
+    preselections = {}
+    batch_size = max(1, config.selection_batch_size)
+    for start in range(0, len(items), batch_size):
+        batch = items[start : start + batch_size]
+        question_ids = [item["question_id"] for item in batch]
+        # Recorded and replayed like a question, under a name derived from its questions.
+        batch_id = "selection-" + hashlib.sha1(",".join(question_ids).encode()).hexdigest()[:16]
+
+        with replay.episode(config, batch_id), ledger.question(
+            batch_id, config.model
+        ) as batch_ledger:
+            # Frames shortlisted for any question of the batch.
+            shortlist = None
+            if config.retrieval.enabled:
+                shortlist = shortlist_views(
+                    episode_history,
+                    [item["question"] for item in batch],
+                    cam1.view_img_list,
+                    config,
+                )
+            with span(
+                "view_selection_batch",
+                questions=len(batch),
+                views=len(shortlist or cam1.view_img_list),
+            ):
+                with span("payload_build", bot="selection_batch"):
+                    selbot = BatchViewSelectionBot(
+                        questions=[item["question"] for item in batch],
+                        rgb_img_list=cam1.view_img_list,
+                        max_views=config.max_views_k,
+                        view_ids=shortlist,
+                        model_config=config.model,
+                        protocol=config.action_protocol,
+                    )
+                selection = selbot.invoke()
+            selections = parse_batch_selection(selection, len(batch), num_views)
+
+        calls = batch_ledger.summary()["calls"]
+        for idx, question_id in enumerate(question_ids):
+            if idx not in selections:
+                log.warning(
+                    f"No batched selection for {question_id}, falling back to a single request"
+                )
+            preselections[question_id] = Preselection(
+                views=selections.get(idx), calls=calls, share=1 / len(batch)
+            )
+        log.info(
+            f"Batched view selection for {len(batch)} questions of {episode_history}: {len(selections)} parsed"
+        )
+
+    return preselections
+
+
 def baseline_agent(
     episode_history: str = "hm3d-v0/000-hm3d-BFRyYbPCCPE",
     question_id: str = "f2e82760-5c3c-41b1-88b6-85921b9e7b32",
@@ -179,15 +416,24 @@ def baseline_agent(
 
     log.info(f"Loading GLB from: {glb_path}")
 
-    cam1 = Camera(ply_path=glb_path, pose_path=pose_path, rgb_img_path=rgb_img_path)
+    with span("camera_init", agent="baseline", scene=episode_history):
+        cam1 = get_camera(
+            glb_path,
+            pose_path,
+            rgb_img_path,
+            cache_size=config.scene_cache_size,
+            render_config=config.render,
+            num_agents=config.concurrent_questions,
+        )
 
     img_path_list = cam1.view_img_list
 
-    baseline_bot = BaselineBot(
-        question=question,
-        rgb_img_list=img_path_list,
-        model_config=config.model,
-    )
+    with span("payload_build", bot="baseline", images=len(img_path_list)):
+        baseline_bot = BaselineBot(
+            question=question,
+            rgb_img_list=img_path_list,
+            model_config=config.model,
+        )
 
     answer = extract_answer(baseline_bot.invoke())
 
@@ -198,9 +444,10 @@ def baseline_agent(
 
     log.info(f"{question_id} token usage: {baseline_bot.get_token_usage()}")
 
-    html_content = html_generator.generate_html()
-    with open(local_html_path, "w") as f:
-        f.write(html_content)
+    with span("write_html"):
+        html_content = html_generator.generate_html()
+        with open(local_html_path, "w") as f:
+            f.write(html_content)
     log.info(f"Local HTML saved to: {local_html_path}")
 
     return {
@@ -1,14 +1,61 @@
 import base64
+import copy
+import hashlib
+import json
 import logging
 import os
-
-from litellm import completion
-
+from functools import lru_cache
+
+from cov import ledger
+from cov.actions import (
+    BATCH_SELECTION_TOOL,
+    SELECTION_TOOL,
+    action_from_arguments,
+    action_tool,
+    batch_selection_from_tool_calls,
+    is_action,
+    selection_from_tool_calls,
+    tool_arguments,
+    tool_kwargs,
+)
 from cov.config import ModelConfig
+from cov.llm import chat_completion
+from cov.streaming import StreamedReply, strip_think
+from cov.tracing import span
 from cov.utils import load_prompt_template
 
 log = logging.getLogger(__name__)
 
+REPAIR_PROMPT = "Your last reply did not contain a valid action. Call take_action with exactly one action, or with your answer."
+
+
+def _read_base64(img_path) -> str:
+    with open(img_path, "rb") as image_file:
+        return base64.b64encode(image_file.read()).decode("utf-8")
+
+
+@lru_cache(maxsize=256)
+def _read_base64_cached(img_path: str, mtime_ns: int, size: int) -> str:
+    return _read_base64(img_path)
+
+
+def encode_image(img_path, cache: bool = False) -> str:
+    """
+    Read an image file as base64 text.
+    Use ``cache`` for scene frames, which are shared by all questions of a scene;
+    entries are keyed by path and modification time.
+    """
+    with span("encode_image", cached=cache) as attrs:
+        if cache:
+            stat = os.stat(img_path)
+            image_data = _read_base64_cached(
+                str(img_path), stat.st_mtime_ns, stat.st_size
+            )
+        else:
+            image_data = _read_base64(img_path)
+        attrs["image_bytes"] = len(image_data)
+    return image_data
+
 
 class EvalBot:
     def __init__(
@@ -21,7 +68,11 @@ class EvalBot:
     ):
         self.model_config = model_config
         self.messages = []
-        self.usage_info = {}
+        self.usage_info = {
+            "prompt_tokens": 0,
+            "completion_tokens": 0,
+            "total_tokens": 0,
+        }
 
         template = load_prompt_template("eval_bot.j2")
 
@@ -34,19 +85,12 @@ class EvalBot:
         self.messages.append({"role": "user", "content": user_prompt})
 
     def invoke(self):
-        response = completion(
-            model=self.model_config.model_name,
-            api_base=os.environ[self.model_config.api_base_env],
-            api_key=os.environ[self.model_config.api_key_env],
-            custom_llm_provider="openai",
-            messages=self.messages,
-            temperature=0,
-        )
+        response = chat_completion(self.model_config, self.messages, stage="eval")
 
-        if hasattr(response, "usage"):
-            self.usage_info = response.usage
+        for key, value in response.usage.items():
+            self.usage_info[key] += value
 
-        content = response.choices[0].message.content
+        content = response.content
         log.info(content)
         return content.split("</think>")[1] if "</think>" in content else content
 
@@ -61,27 +105,36 @@ class ViewSelectionBot:
         rgb_img_list: list = [],
         pose_matrix_list: list = [],
         max_views: int = 5,
+        view_ids: list = None,
         *,
         model_config: ModelConfig,
+        protocol: str = "text",
     ):
+        # Only the frames of ``view_ids`` are sent, all by default.
+        if view_ids is None:
+            view_ids = list(range(len(rgb_img_list)))
         self.model_config = model_config
+        self.protocol = protocol
         self.messages = []
-        self.usage_info = {}
+        self.usage_info = {
+            "prompt_tokens": 0,
+            "completion_tokens": 0,
+            "total_tokens": 0,
+        }
 
         template = load_prompt_template("view_selection_bot.j2")
 
         system_prompt = template.render(
             question=question,
-            view_ids=list(range(len(rgb_img_list))),
+            view_ids=view_ids,
             max_views=max_views,
         )
 
         self.messages.append({"role": "system", "content": system_prompt})
 
         # Add image messages
-        for view_id, img_path in enumerate(rgb_img_list):
-            with open(img_path, "rb") as image_file:
-                image_data = base64.b64encode(image_file.read()).decode("utf-8")
+        for view_id in view_ids:
+            image_data = encode_image(rgb_img_list[view_id], cache=True)
 
             content = [
                 {
@@ -98,27 +151,116 @@ class ViewSelectionBot:
             self.messages.append({"role": "user", "content": content})
 
     def invoke(self):
-        response = completion(
-            model=self.model_config.model_name,
-            api_base=os.environ[self.model_config.api_base_env],
-            api_key=os.environ[self.model_config.api_key_env],
-            custom_llm_provider="openai",
-            messages=self.messages,
-            temperature=0,
-        )
+        if self.protocol == "tools":
+            response = chat_completion(
+                self.model_config,
+                self.messages,
+                stage="selection",
+                **tool_kwargs(SELECTION_TOOL),
+            )
+        else:
+            response = chat_completion(self.model_config, self.messages, stage="selection")
 
         # Extract usage information
-        if hasattr(response, "usage"):
-            self.usage_info = response.usage
-
-        content = response.choices[0].message.content
-        log.info(content)
+        for key, value in response.usage.items():
+            self.usage_info[key] += value
+
+        content = response.content
+        log.info(content or response.tool_calls)
+        if self.protocol == "tools":
+            selection = selection_from_tool_calls(response.tool_calls)
+            ledger.count("tool_call" if selection is not None else "tool_fallback")
+            if selection is not None:
+                return selection
         return content.split("</think>")[1] if "</think>" in content else content
 
     def get_token_usage(self):
         return self.usage_info
 
 
+class BatchViewSelectionBot:
+    """
+    View selection for several questions of one scene, sending the frames once.
+    """
+
+    def __init__(
+        self,
+        questions: list = [],
+        rgb_img_list: list = [],
+        max_views: int = 5,
+        view_ids: list = None,
+        *,
+        model_config: ModelConfig,
+        protocol: str = "text",
+    ):
+        # Only the frames of ``view_ids`` are sent, all by default.
+        if view_ids is None:
+            view_ids = list(range(len(rgb_img_list)))
+        self.model_config = model_config
+        self.protocol = protocol
+        self.messages = []
+        self.usage_info = {
+            "prompt_tokens": 0,
+            "completion_tokens": 0,
+            "total_tokens": 0,
+        }
+
+        template = load_prompt_template("batch_view_selection_bot.j2")
+
+        system_prompt = template.render(
+            questions=questions,
+            view_ids=view_ids,
+            max_views=max_views,
+        )
+
+        self.messages.append({"role": "system", "content": system_prompt})
+
+        for view_id in view_ids:
+            image_data = encode_image(rgb_img_list[view_id], cache=True)
+
+            content = [
+                {
+                    "type": "text",
+                    "text": f"This is the image corresponding to view id: {view_id}",
+                },
+                {
+                    "type": "image_url",
+                    "image_url": {
+                        "url": f"data:image/png;base64,{image_data}",
+                    },
+                },
+            ]
+            self.messages.append({"role": "user", "content": content})
+
+    def invoke(self):
+        if self.protocol == "tools":
+            response = chat_completion(
+                self.model_config,
+                self.messages,
+                stage="selection_batch",
+                **tool_kwargs(BATCH_SELECTION_TOOL),
+            )
+        else:
+            response = chat_completion(
+                self.model_config, self.messages, stage="selection_batch"
+            )
+
+        for key, value in response.usage.items():
+            self.usage_info[key] += value
+
+        content = response.content
+        log.info(content or response.tool_calls)
+        if self.protocol == "tools":
+            selection = batch_selection_from_tool_calls(response.tool_calls)
+            ledger.count("tool_call" if selection is not None else "tool_fallback")
+            if selection is not None:
+                return selection
+        return strip_think(content)
+
+    def get_token_usage(self):
+        return self.usage_info
+
+
 class Chatbot:
     def __init__(
         self,
@@ -130,6 +272,15 @@ class Chatbot:
         *,
         model_config: ModelConfig,
         min_action_step: int = 3,
+        stream: bool = False,
+        early_stop: bool = False,
+        protocol: str = "text",
+        repair_retries: int = 1,
+        max_actions_per_step: int = 1,
+        look_around_views: int = 0,
+        zoom: bool = False,
+        targeting: bool = False,
+        top_down_map: bool = False,
     ):
         self.model_config = model_config
         self.messages = []
@@ -139,6 +290,27 @@ class Chatbot:
             "total_tokens": 0,
         }
         self.min_action_step = min_action_step
+        # With ``stream`` invoke returns as soon as the next action is known.
+        self.stream = stream
+        self.early_stop = early_stop
+        self.pending = None
+        # With the "tools" protocol, replies without a valid action are asked again
+        # up to ``repair_retries`` times within the same step.
+        self.protocol = protocol
+        self.repair_retries = repair_retries
+        # Disabled actions are not advertised, a call of one would waste the step.
+        self.action_tool = action_tool(look_around_views > 0, zoom, targeting)
+        if protocol == "tools" and stream:
+            log.warning("Streaming is not supported with the tools protocol, disabled")
+            self.stream = False
+        # Macro steps: an ordered sequence of actions per step, see Camera.exec_macro.
+        self.max_actions_per_step = max_actions_per_step
+        if max_actions_per_step > 1 and protocol == "tools":
+            log.warning("Macro steps need the text protocol, one action per step")
+            self.max_actions_per_step = 1
+        if self.max_actions_per_step > 1 and self.stream:
+            log.warning("Streaming early commit would cut macro steps, disabled")
+            self.stream = False
 
         template = load_prompt_template("chatbot.j2")
 
@@ -147,136 +319,285 @@ class Chatbot:
             view_ids=view_ids,
             max_views=max_views,
             min_action_step=min_action_step,
+            max_actions_per_step=self.max_actions_per_step,
+            look_around_views=look_around_views,
+            zoom=zoom,
+            targeting=targeting,
         )
 
         self.messages.append({"role": "system", "content": system_prompt})
 
+        # Observations already in the conversation are referenced instead of re-sent.
+        self.seen_images = {}  # sha1 of the base64 image -> where it was shown
+        self.step = 0
+
         for view_id, img_path in best5_view_list.items():
-            with open(img_path, "rb") as image_file:
-                image_data = base64.b64encode(image_file.read()).decode("utf-8")
+            image_data = encode_image(img_path, cache=True)
 
             content = [
                 {
                     "type": "text",
                     "text": f"This is one of the best images, corresponding to view id: {view_id}",
                 },
-                {
-                    "type": "image_url",
-                    "image_url": {
-                        "url": f"data:image/png;base64,{image_data}",
-                    },
-                },
+                *self._image_content(image_data, f"view id {view_id}"),
             ]
             self.messages.append({"role": "user", "content": content})
 
-        with open(bird_eye_view, "rb") as image_file:
-            image_data = base64.b64encode(image_file.read()).decode("utf-8")
+        image_data = encode_image(bird_eye_view)
+        if top_down_map:
+            bird_eye_text = (
+                "This is a top-down map of the scene for your reference. Each numbered "
+                "blue arrow is the camera pose of the view with that id, which you can "
+                "reach with 'switch to view N'. The red arrow is your current pose."
+            )
+        else:
+            bird_eye_text = (
+                "This is the image of the scene from bird eye's view for your reference"
+            )
 
         content = [
             {
                 "type": "text",
-                "text": "This is the image of the scene from bird eye's view for your reference",
+                "text": bird_eye_text,
             },
+            *self._image_content(image_data, "the bird-eye view"),
+        ]
+        self.messages.append({"role": "user", "content": content})
+
+    def _image_content(self, image_data: str, label: str) -> list:
+        """
+        Content parts of an observation. An image identical to one already in the
+        conversation becomes a short text reference to it.
+        """
+        digest = hashlib.sha1(image_data.encode("ascii")).hexdigest()
+        earlier = self.seen_images.get(digest)
+        if earlier is not None:
+            ledger.count("duplicate_image")
+            return [
+                {
+                    "type": "text",
+                    "text": f"(View unchanged, identical to the image of {earlier}.)",
+                }
+            ]
+        self.seen_images[digest] = label
+        return [
             {
                 "type": "image_url",
                 "image_url": {
                     "url": f"data:image/png;base64,{image_data}",
                 },
-            },
+            }
         ]
-        self.messages.append({"role": "user", "content": content})
 
-    def invoke(self, img_path: str, step: int):
-        with open(img_path, "rb") as image_file:
-            image_data = base64.b64encode(image_file.read()).decode("utf-8")
+    def invoke(self, img_path: str, step: int, snapshots: list = [], note: str = None):
+        """
+        ``snapshots`` are the intermediate frames requested in the last macro step,
+        ``note`` is appended to the step text, e.g. the coverage summary.
+        """
+        if self.max_actions_per_step > 1:
+            action_rule = f"Perform up to {self.max_actions_per_step} actions in order, separated by ';'."
+        else:
+            action_rule = "Perform ONLY ONE action per step."
+        text = f"Here is the provided view image based on your adjustment. Currently you are in step {step}. {action_rule} Remember your minium action step budget is {self.min_action_step}. If you have reached minimum step budget and you are sure you have collected enough information, give your answer following pattern 'done+[answer]'."
+        if note:
+            text += f" {note}"
+        self.step = step
+        return self._ask(text, img_path, snapshots)
+
+    def invoke_in_text(self, text: str, img_path: str, step: int, snapshots: list = []):
+        """
+        Ask with a custom text instead of the step text, e.g. after a blank view.
+        """
+        self.step = step
+        return self._ask(text, img_path, snapshots)
+
+    def _ask(self, text: str, img_path: str, snapshots: list = []):
+        # The previous streamed reply must be complete before it enters the history.
+        self.finish()
+
+        content = []
+        for idx, snapshot_path in enumerate(snapshots):
+            image_data = encode_image(snapshot_path)
+            content += [
+                {
+                    "type": "text",
+                    "text": f"Intermediate frame {idx + 1} of your last action sequence",
+                },
+                *self._image_content(
+                    image_data, f"intermediate frame {idx + 1} of step {self.step}"
+                ),
+            ]
+
+        image_data = encode_image(img_path)
 
-        content = [
+        content += [
             {
                 "type": "text",
-                "text": f"Here is the provided view image based on your adjustment. Currently you are in step {step}. Perform ONLY ONE action per step. Remember your minium action step budget is {self.min_action_step}. If you have reached minimum step budget and you are sure you have collected enough information, give your answer following pattern 'done+[answer]'.",
-            },
-            {
-                "type": "image_url",
-                "image_url": {
-                    "url": f"data:image/png;base64,{image_data}",
-                },
+                "text": text,
             },
+            *self._image_content(image_data, f"step {self.step}"),
         ]
 
         self.messages.append({"role": "user", "content": content})
 
-        response = completion(
-            model=self.model_config.model_name,
-            api_base=os.environ[self.model_config.api_base_env],
-            api_key=os.environ[self.model_config.api_key_env],
-            custom_llm_provider="openai",
-            messages=self.messages,
-            temperature=0,
-        )
+        if self.protocol == "tools":
+            return self._ask_tools()
 
-        if hasattr(response, "usage"):
-            usage = response.usage
-            self.usage_info["prompt_tokens"] += getattr(usage, "prompt_tokens", 0)
-            self.usage_info["completion_tokens"] += getattr(
-                usage, "completion_tokens", 0
-            )
-            self.usage_info["total_tokens"] += getattr(usage, "total_tokens", 0)
+        if not self.stream:
+            response = chat_completion(self.model_config, self.messages, stage="chat")
+            self._add_reply(response)
+            return strip_think(response.content)
 
-        assistant_content = response.choices[0].message.content
+        messages = list(self.messages)
+        self.pending = StreamedReply(
+            lambda on_delta: chat_completion(
+                self.model_config, messages, stage="chat", on_delta=on_delta
+            ),
+            early_stop=self.early_stop,
+        )
+        return self.pending.action()
+
+    def _ask_tools(self):
+        for attempt in range(self.repair_retries + 1):
+            response = chat_completion(
+                self.model_config,
+                self.messages,
+                stage="chat",
+                **tool_kwargs(self.action_tool),
+            )
+            action = self._tool_action(response)
+            # The history keeps the canonical action, so no tool messages are needed.
+            self._add_reply(
+                response,
+                assistant_content=action
+                or response.content
+                or json.dumps(response.tool_calls),
+            )
+            if action is not None:
+                return action
+            if attempt < self.repair_retries:
+                ledger.count("repair_turn")
+                self.messages.append({"role": "user", "content": REPAIR_PROMPT})
+        return strip_think(response.content)
+
+    def _tool_action(self, response):
+        """
+        Canonical action of a reply, from its tool call or else from its text.
+        """
+        function = self.action_tool["function"]
+        arguments = tool_arguments(response.tool_calls, function["name"])
+        action = None
+        if arguments is not None:
+            action = action_from_arguments(
+                arguments, function["parameters"]["properties"]["action"]["enum"]
+            )
+        if action is not None:
+            ledger.count("tool_call")
+            return action
+        ledger.count("tool_fallback")
+        text = strip_think(response.content)
+        return text if is_action(text) else None
+
+    def _add_reply(self, response, assistant_content: str = None):
+        for key, value in response.usage.items():
+            self.usage_info[key] += value
+
+        if assistant_content is None:
+            assistant_content = response.content
         self.messages.append({"role": "assistant", "content": assistant_content})
+        if not is_action(strip_think(assistant_content)):
+            ledger.count("malformed_output")
 
         log.info(assistant_content)
-        return (
-            assistant_content.split("</think>")[1]
-            if "</think>" in assistant_content
-            else assistant_content
+
+    def finish(self):
+        """
+        Wait for the streamed reply in flight, if any, and add it to the history.
+        Returns the full reply if it asks for other actions than the one returned
+        early, so the caller can undo that action and execute the reply instead.
+        """
+        if self.pending is None:
+            return None
+        reply, self.pending = self.pending, None
+        self._add_reply(reply.wait())
+        if not reply.diverged():
+            return None
+        ledger.count("stream_divergence")
+        log.warning(
+            f"Executed {reply.committed!r} early, but the full reply asks for other actions"
         )
+        return strip_think(reply.result.content)
+
+    def fork(self) -> "Chatbot":
+        """
+        A copy continuing from the current conversation, e.g. an exploration branch.
+        The messages so far are shared, so forks must only append to their history.
+        """
+        self.finish()
+        branch = copy.copy(self)
+        # Branches call the model concurrently already and execute complete replies.
+        branch.stream = False
+        branch.messages = list(self.messages)
+        branch.usage_info = dict.fromkeys(self.usage_info, 0)
+        branch.seen_images = dict(self.seen_images)
+        return branch
 
-    def invoke_in_text(self, text: str, img_path: str):
-        with open(img_path, "rb") as image_file:
-            image_data = base64.b64encode(image_file.read()).decode("utf-8")
+    def get_token_usage(self):
+        self.finish()
+        return self.usage_info
 
-        content = [
-            {
-                "type": "text",
-                "text": text,
-            },
-            {
-                "type": "image_url",
-                "image_url": {
-                    "url": f"data:image/png;base64,{image_data}",
-                },
-            },
-        ]
 
-        self.messages.append({"role": "user", "content": content})
+class MergeBot:
+    """
+    Final answer from the findings of parallel exploration branches.
+    """
 
-        response = completion(
-            model=self.model_config.model_name,
-            api_base=os.environ[self.model_config.api_base_env],
-            api_key=os.environ[self.model_config.api_key_env],
-            custom_llm_provider="openai",
-            messages=self.messages,
-            temperature=0,
-        )
+    def __init__(
+        self,
+        question: str = None,
+        findings: list = [],
+        *,
+        model_config: ModelConfig,
+    ):
+        """
+        ``findings`` are (view id, answer, final frame path) of the branches.
+        """
+        self.model_config = model_config
+        self.usage_info = {
+            "prompt_tokens": 0,
+            "completion_tokens": 0,
+            "total_tokens": 0,
+        }
 
-        if hasattr(response, "usage"):
-            usage = response.usage
-            self.usage_info["prompt_tokens"] += getattr(usage, "prompt_tokens", 0)
-            self.usage_info["completion_tokens"] += getattr(
-                usage, "completion_tokens", 0
-            )
-            self.usage_info["total_tokens"] += getattr(usage, "total_tokens", 0)
+        template = load_prompt_template("merge_bot.j2")
+        system_prompt = template.render(question=question, num_branches=len(findings))
+        self.messages = [{"role": "system", "content": system_prompt}]
 
-        assistant_content = response.choices[0].message.content
-        self.messages.append({"role": "assistant", "content": assistant_content})
+        for view_id, answer, img_path in findings:
+            image_data = encode_image(img_path)
+            content = [
+                {
+                    "type": "text",
+                    "text": f"The explorer starting from view {view_id} answered: {answer}. This is its final view.",
+                },
+                {
+                    "type": "image_url",
+                    "image_url": {
+                        "url": f"data:image/png;base64,{image_data}",
+                    },
+                },
+            ]
+            self.messages.append({"role": "user", "content": content})
 
-        log.info(assistant_content)
-        return (
-            assistant_content.split("</think>")[1]
-            if "</think>" in assistant_content
-            else assistant_content
-        )
+    def invoke(self):
+        response = chat_completion(self.model_config, self.messages, stage="merge")
+
+        for key, value in response.usage.items():
+            self.usage_info[key] += value
+
+        content = response.content
+        log.info(content)
+        return strip_think(content)
 
     def get_token_usage(self):
         return self.usage_info
@@ -310,8 +631,7 @@ class BaselineBot:
 
         # NOTE There is a bug in litellm or llm providers, so that you must pass image like f"data:image/png;base64,{image_data}". Or it fails.
         for img_path in rgb_img_list:
-            with open(img_path, "rb") as image_file:
-                image_data = base64.b64encode(image_file.read()).decode("utf-8")
+            image_data = encode_image(img_path, cache=True)
 
             content = [
                 {
@@ -332,24 +652,13 @@ class BaselineBot:
         }
 
         messages_to_send = self.messages + [query_message]
-        response = completion(
-            model=self.model_config.model_name,
-            messages=messages_to_send,
-            api_base=os.environ[self.model_config.api_base_env],
-            api_key=os.environ[self.model_config.api_key_env],
-            custom_llm_provider="openai",
-            temperature=0,
+        response = chat_completion(
+            self.model_config, messages_to_send, stage="baseline"
         )
 
-        if hasattr(response, "usage"):
-            usage = response.usage
-            self.usage_info["prompt_tokens"] = getattr(usage, "prompt_tokens", 0)
-            self.usage_info["completion_tokens"] = getattr(
-                usage, "completion_tokens", 0
-            )
-            self.usage_info["total_tokens"] = getattr(usage, "total_tokens", 0)
+        self.usage_info.update(response.usage)
 
-        content = response.choices[0].message.content
+        content = response.content
         return content.split("</think>")[1] if "</think>" in content else content
 
     def get_token_usage(self):
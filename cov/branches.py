@@ -0,0 +1,171 @@
+"""
+Parallel exploration branches from the anchor views.
+
+Every selected anchor view starts a branch, a fork of the chat after its shared
+prefix (system prompt, anchor views and bird-eye view) with its own camera state and
+a small step budget. In each round the LLM calls of all active branches run
+concurrently, while camera actions and renders stay on the calling thread, since the
+simulator is not thread safe. Branches share the camera of the question and restore
+their state on it before every action, they do not get their own simulator agent.
+Actions go through the same dispatch as the chat loop. A final merge call answers
+from the final frames and answers of the branches.
+"""
+
+import contextvars
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+
+from cov.bots import Chatbot, MergeBot
+from cov.camera import Camera
+from cov.config import OpenEQAConfig
+from cov.execution import execute_action
+from cov.tracing import span
+from cov.utils import extract_answer, is_mostly_blank
+
+log = logging.getLogger(__name__)
+
+BRANCH_PROMPT = "You are one of {num_branches} explorers searching the scene in parallel, and you start from view {view_id}. Explore around it, you have at most {max_steps} steps to answer."
+BLANK_PROMPT = "You were moving to a blank view and I switched you back to your view."
+LAST_STEP_PROMPT = "This is your last step. Give your answer now following pattern 'done+[answer]'."
+
+
+@dataclass
+class Branch:
+    view_id: int
+    chatbot: Chatbot
+    state: dict  # Camera state, see Camera.get_state.
+    image_path: str = None
+    text: str = None  # Replaces the step text of the next call, if set.
+    show_birdeye: bool = False
+    override_path: str = None  # Panorama, close-up or map to show next, see ActionOutcome.
+    snapshots: list = field(default_factory=list)  # Intermediate frames of the last macro step.
+    answer: str = None
+
+
+def _observe(cam: Camera, branch: Branch, img_dir: str, birdeye_path: str):
+    """
+    Render the next view of a branch.
+    """
+    if branch.override_path is not None:
+        branch.image_path, branch.override_path = branch.override_path, None
+        return
+    if branch.show_birdeye:
+        branch.show_birdeye = False
+        branch.image_path = birdeye_path
+        return
+
+    cam.set_state(branch.state)
+    branch.image_path = cam.screen_shot(img_dir)
+    if is_mostly_blank(branch.image_path):
+        cam.switch_back_view()
+        branch.state = cam.get_state()
+        branch.image_path = cam.screen_shot(img_dir)
+        branch.text = BLANK_PROMPT
+
+
+def _ask(branch: Branch, step: int, max_steps: int, note: str = None) -> str:
+    snapshots, branch.snapshots = branch.snapshots, []
+    if step == max_steps:
+        text = f"{branch.text} {LAST_STEP_PROMPT}" if branch.text else LAST_STEP_PROMPT
+        return branch.chatbot.invoke_in_text(
+            text=text, img_path=branch.image_path, step=step, snapshots=snapshots
+        )
+    if branch.text:
+        return branch.chatbot.invoke_in_text(
+            text=branch.text, img_path=branch.image_path, step=step, snapshots=snapshots
+        )
+    return branch.chatbot.invoke(branch.image_path, step, snapshots, note=note)
+
+
+def explore_branches(
+    chatbot: Chatbot,
+    cam: Camera,
+    view_ids: list,
+    birdeye_path: str,
+    img_dir: str,
+    html_generator,
+    question: str,
+    config: OpenEQAConfig,
+):
+    """
+    Explore from each of ``view_ids`` in parallel and merge the branch answers.
+    The usage of all calls is added to ``chatbot``. Returns (answer, steps), where
+    steps counts the rounds, i.e. the wall-clock equivalent of serial steps.
+    """
+    max_steps = config.branches.max_steps
+    branches = []
+    for view_id in view_ids:
+        cam.switch_to_view(view_id)
+        branches.append(Branch(view_id, chatbot.fork(), cam.get_state()))
+
+    rounds = 0
+    workers = config.branches.max_workers or len(branches)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for step in range(1, max_steps + 1):
+            active = [branch for branch in branches if branch.answer is None]
+            if not active:
+                break
+            rounds += 1
+
+            with span("render", kind="branches", step=step, branches=len(active)):
+                for branch in active:
+                    _observe(cam, branch, img_dir, birdeye_path)
+
+            with span("branch_round", step=step, branches=len(active)):
+                futures = []
+                for branch in active:
+                    note = None
+                    if step == 1:
+                        note = BRANCH_PROMPT.format(
+                            num_branches=len(branches),
+                            view_id=branch.view_id,
+                            max_steps=max_steps,
+                        )
+                    # Each call runs in a copy of the question context (ledger, replay).
+                    context = contextvars.copy_context()
+                    futures.append(
+                        pool.submit(context.run, _ask, branch, step, max_steps, note)
+                    )
+                actions = [future.result() for future in futures]
+
+            for branch, action in zip(active, actions):
+                branch.text = None
+                html_generator.add_step(branch.image_path, f"[view {branch.view_id}] {action}")
+                if "done" in action.lower():
+                    branch.answer = extract_answer(action)
+                    continue
+                with span("branch_action", branch=branch.view_id):
+                    cam.set_state(branch.state)
+                    outcome = execute_action(
+                        cam, action, img_dir, config, branch.chatbot.max_actions_per_step
+                    )
+                    branch.state = cam.get_state()
+                branch.override_path = outcome.override_path
+                branch.show_birdeye = outcome.show_birdeye
+                branch.snapshots = outcome.snapshots
+                for snapshot_path in outcome.snapshots:
+                    html_generator.add_step(snapshot_path, f"[view {branch.view_id}] snapshot")
+
+    for branch in branches:
+        for key, value in branch.chatbot.get_token_usage().items():
+            chatbot.usage_info[key] += value
+    answers = {branch.answer.strip().lower() for branch in branches if branch.answer}
+    log.info(
+        f"{sum(branch.answer is not None for branch in branches)}/{len(branches)} branches answered in {rounds} rounds"
+    )
+    if len(answers) == 1 and all(branch.answer for branch in branches):
+        return branches[0].answer, rounds
+
+    # Branches out of steps still contribute what they saw last.
+    findings = [
+        (branch.view_id, branch.answer or "no answer yet", branch.image_path)
+        for branch in branches
+    ]
+
+    with span("merge", branches=len(findings)):
+        merge_bot = MergeBot(question, findings, model_config=config.model)
+        answer = extract_answer(merge_bot.invoke())
+    for key, value in merge_bot.get_token_usage().items():
+        chatbot.usage_info[key] += value
+    return answer, rounds
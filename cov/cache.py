@@ -0,0 +1,141 @@
+"""
+Persistent cache of deterministic (temperature=0) LLM responses.
+"""
+
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+log = logging.getLogger(__name__)
+
+CACHE_MODES = ("off", "read", "readwrite")
+
+
+def _hash_image_url(url: str) -> str:
+    return "sha256:" + hashlib.sha256(url.encode("utf-8")).hexdigest()
+
+
+def normalize_messages(messages: list) -> list:
+    """
+    Replace inline base64 images with their hashes so keys stay small.
+    """
+    normalized = []
+    for message in messages:
+        content = message.get("content")
+        if isinstance(content, list):
+            parts = []
+            for part in content:
+                if part.get("type") == "image_url":
+                    image_url = part["image_url"]
+                    if isinstance(image_url, dict):
+                        image_url = image_url.get("url", "")
+                    part = {"type": "image_url", "image_url": _hash_image_url(image_url)}
+                parts.append(part)
+            content = parts
+        normalized.append({**message, "content": content})
+    return normalized
+
+
+def cache_key(
+    model_name: str, messages: list, api_base: str = "", provider: str = "", **kwargs
+) -> str:
+    """
+    Key of a call, endpoints serving the same model name do not share entries.
+    """
+    payload = json.dumps(
+        {
+            "model": model_name,
+            "api_base": api_base,
+            "provider": provider,
+            "messages": normalize_messages(messages),
+            "kwargs": kwargs,
+        },
+        sort_keys=True,
+        ensure_ascii=False,
+        default=str,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """
+    SQLite-backed response cache shared by threads and processes.
+
+    Modes:
+        off: bypass the cache entirely.
+        read: serve hits, never write new entries.
+        readwrite: serve hits and store every new response.
+    """
+
+    def __init__(self, path: Path, mode: str = "readwrite"):
+        if mode not in CACHE_MODES:
+            raise ValueError(f"Unknown cache mode {mode}, expected one of {CACHE_MODES}")
+        self.path = Path(path)
+        self.mode = mode
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.conn = sqlite3.connect(str(self.path), timeout=30, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, model TEXT, content TEXT, usage TEXT, created REAL, "
+            "tool_calls TEXT)"
+        )
+        self.conn.commit()
+
+    def get(self, key: str):
+        """
+        Return (content, usage, tool_calls) of a cached response, or None.
+        """
+        if self.mode == "off":
+            return None
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT content, usage, tool_calls FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return row[0], json.loads(row[1]), json.loads(row[2]) if row[2] else None
+
+    def put(
+        self, key: str, model: str, content: str, usage: dict, tool_calls: list = None
+    ):
+        if self.mode != "readwrite":
+            return
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO responses "
+                "(key, model, content, usage, created, tool_calls) VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    key,
+                    model,
+                    content,
+                    json.dumps(usage),
+                    time.time(),
+                    json.dumps(tool_calls) if tool_calls else None,
+                ),
+            )
+            self.conn.commit()
+
+    def stats(self) -> dict:
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "mode": self.mode,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
@@ -1,104 +1,447 @@
+import contextvars
+import functools
 import logging
 import os
+import threading
+import weakref
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 import habitat_sim
 import magnum as mn
 import numpy as np
-from habitat_sim.utils.common import quat_from_angle_axis
-from natsort import natsorted
-from PIL import Image
-
-from cov.utils import extract_patterns
+from habitat_sim.utils.common import (
+    quat_from_angle_axis,
+    quat_from_coeffs,
+    quat_rotate_vector,
+    quat_to_coeffs,
+)
+from quaternion import as_rotation_matrix
+from scipy.spatial import cKDTree
+from PIL import Image, ImageDraw, ImageFont
+
+from cov import ledger
+from cov.config import RenderConfig
+from cov.utils import extract_patterns, list_views
 
 log = logging.getLogger(__name__)
 
+# Simulators of recently used scenes, see get_camera.
+_scene_cache = OrderedDict()
+_scene_cache_lock = threading.Lock()
+
+# 主相机水平视场角
+HFOV = 90
+
+# 俯视地图: 采集位姿范围外的边距和相机高于最高位姿的距离 (米)
+MAP_MARGIN = 1.5
+MAP_CAMERA_CLEARANCE = 0.5
+
+
+class FrameIndex:
+    """
+    场景全部采集帧 (包括采样跳过的帧) 的位姿 KD 树索引
+    相机位姿与某个采集帧足够接近时, 直接使用真实图像代替渲染
+    """
+
+    def __init__(self, pose_paths: list, img_paths: list):
+        poses = np.stack([np.loadtxt(path) for path in pose_paths])
+        self.rotations = poses[:, :3, :3]
+        self.img_paths = img_paths
+        self.tree = cKDTree(poses[:, :3, 3])
+
+    def nearest(self, position, rotation, max_distance: float, max_angle: float):
+        """
+        距离不超过 max_distance 米且旋转角不超过 max_angle 度的最近采集帧
+        返回 (图像路径, 距离, 角度), 没有时返回 None
+        """
+        best = None
+        for idx in self.tree.query_ball_point(position, max_distance):
+            # 两个旋转之间的夹角
+            cos = (np.trace(self.rotations[idx].T @ rotation) - 1) / 2
+            angle = float(np.degrees(np.arccos(np.clip(cos, -1.0, 1.0))))
+            if angle > max_angle:
+                continue
+            distance = float(np.linalg.norm(self.tree.data[idx] - position))
+            # 位置和角度按各自的容差归一化后比较
+            score = distance / max_distance + angle / max_angle
+            if best is None or score < best[0]:
+                best = (score, self.img_paths[idx], distance, angle)
+        return None if best is None else best[1:]
+
+
+def _load_font(size: int):
+    try:
+        return ImageFont.load_default(size=size)
+    except TypeError:  # Pillow < 10.1
+        return ImageFont.load_default()
+
+
+def _label_tile(img: Image.Image, label: str, width: int) -> Image.Image:
+    """
+    缩放子图并在左上角绘制标注
+    """
+    img = img.resize((width, round(img.height * width / img.width)))
+    draw = ImageDraw.Draw(img)
+    font = _load_font(max(12, width // 20))
+    left, top, right, bottom = draw.textbbox((8, 8), label, font=font)
+    draw.rectangle((0, 0, right + 8, bottom + 8), fill=(0, 0, 0))
+    draw.text((8, 8), label, fill=(255, 255, 255), font=font)
+    return img
+
+
+def _draw_arrow(draw: ImageDraw.ImageDraw, start, end, color, width: int):
+    """
+    从 start 到 end 绘制箭头, 坐标为像素
+    """
+    start, end = np.asarray(start, dtype=float), np.asarray(end, dtype=float)
+    radius = width * 1.5
+    draw.ellipse(
+        (start[0] - radius, start[1] - radius, start[0] + radius, start[1] + radius),
+        fill=color,
+    )
+    direction = end - start
+    length = np.linalg.norm(direction)
+    if length < 1:
+        return
+    direction /= length
+    normal = np.array([-direction[1], direction[0]])
+    head = width * 3
+    draw.line([tuple(start), tuple(end)], fill=color, width=width)
+    draw.polygon(
+        [
+            tuple(end + direction * head),
+            tuple(end + normal * head),
+            tuple(end - normal * head),
+        ],
+        fill=color,
+    )
+
+
+def _serialized(method):
+    """
+    在场景的渲染线程上执行, 共享同一仿真器的多个 Camera 互不干扰
+    """
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        return self.scene.run(method, self, *args, **kwargs)
+
+    return wrapper
+
+
+def _camera_agent_config(uuid: str, resolution):
+    """
+    探索用 agent 的配置: 一个彩色相机和移动/旋转动作
+    """
+    # 配置相机传感器
+    sensor_cfg = habitat_sim.CameraSensorSpec()
+    sensor_cfg.uuid = uuid
+    sensor_cfg.sensor_type = habitat_sim.SensorType.COLOR
+    sensor_cfg.resolution = list(resolution)
+    sensor_cfg.position = [0.0, 0.0, 0.0]
+    sensor_cfg.hfov = HFOV
+
+    agent_cfg = habitat_sim.agent.AgentConfiguration()
+    agent_cfg.sensor_specifications = [sensor_cfg]
+
+    # 配置动作空间
+    agent_cfg.action_space = {
+        "move_forward": habitat_sim.agent.ActionSpec(
+            "move_forward", habitat_sim.agent.ActuationSpec(amount=0.4)
+        ),
+        "move_backward": habitat_sim.agent.ActionSpec(
+            "move_backward", habitat_sim.agent.ActuationSpec(amount=0.4)
+        ),
+        "move_left": habitat_sim.agent.ActionSpec(
+            "move_left", habitat_sim.agent.ActuationSpec(amount=0.4)
+        ),
+        "move_right": habitat_sim.agent.ActionSpec(
+            "move_right", habitat_sim.agent.ActuationSpec(amount=0.4)
+        ),
+        "move_up": habitat_sim.agent.ActionSpec(
+            "move_up", habitat_sim.agent.ActuationSpec(amount=0.4)
+        ),
+        "move_down": habitat_sim.agent.ActionSpec(
+            "move_down", habitat_sim.agent.ActuationSpec(amount=0.4)
+        ),
+        "turn_left": habitat_sim.agent.ActionSpec(
+            "turn_left", habitat_sim.agent.ActuationSpec(amount=10.0)
+        ),
+        "turn_right": habitat_sim.agent.ActionSpec(
+            "turn_right", habitat_sim.agent.ActuationSpec(amount=10.0)
+        ),
+    }
+    return agent_cfg
+
+
+class SceneSimulator:
+    """
+    一个场景共享的仿真器, 网格和纹理只加载一次
+    包含 num_agents 个探索 agent, 每个 Camera 绑定其中一个
+    num_agents > 1 时所有仿真器调用都在同一个渲染线程上串行执行, 因为 GL 上下文
+    属于创建它的线程
+    """
 
-class Camera:
     def __init__(
         self,
         ply_path: Path,
         pose_path: Path,
         rgb_img_path: Path,
+        render_config: RenderConfig = None,
+        num_agents: int = 1,
     ):
+        self.render_config = render_config or RenderConfig()
+        self.num_agents = num_agents
         ply_path = str(ply_path)  # Because habitat-sim can't read PosixPath object.
-        self.view_pose_list = natsorted(
-            [
-                pose_file
-                for pose_file in pose_path.iterdir()
-                if pose_file.is_file() and pose_file.suffix == ".txt"
-            ],
-            key=lambda x: x.stem,
+        self.view_pose_list, self.view_img_list = list_views(
+            ply_path, pose_path, rgb_img_path
         )
 
-        self.view_img_list = natsorted(
-            [
-                img_file
-                for img_file in rgb_img_path.iterdir()
-                if img_file.is_file() and img_file.suffix == ".png"
-            ],
-            key=lambda x: x.stem,
-        )
-
-        if "hm3d" in ply_path:
-            sample_rate = 10
-        else:
-            sample_rate = 60
-
-        self.view_pose_list = self.view_pose_list[::sample_rate]
-        self.view_img_list = self.view_img_list[::sample_rate]
-        self.cur_view_idx = -1
-        self.screen_shot_cnt = 0
-        self.on_traj = False
+        self.frame_index = None
+        if self.render_config.snap_to_frames:
+            self.frame_index = FrameIndex(
+                *list_views(ply_path, pose_path, rgb_img_path, sampled=False)
+            )
 
         # 初始化habitat-sim仿真器
         backend_cfg = habitat_sim.SimulatorConfiguration()
         backend_cfg.scene_id = ply_path
         backend_cfg.enable_physics = False
 
-        # 配置相机传感器
-        sensor_cfg = habitat_sim.CameraSensorSpec()
-        sensor_cfg.uuid = "color_sensor"
-        sensor_cfg.sensor_type = habitat_sim.SensorType.COLOR
-        sensor_cfg.resolution = [1080, 1920]
-        sensor_cfg.position = [0.0, 0.0, 0.0]
-        sensor_cfg.hfov = 90
-
-        agent_cfg = habitat_sim.agent.AgentConfiguration()
-        agent_cfg.sensor_specifications = [sensor_cfg]
-
-        # 配置动作空间
-        agent_cfg.action_space = {
-            "move_forward": habitat_sim.agent.ActionSpec(
-                "move_forward", habitat_sim.agent.ActuationSpec(amount=0.4)
-            ),
-            "move_backward": habitat_sim.agent.ActionSpec(
-                "move_backward", habitat_sim.agent.ActuationSpec(amount=0.4)
-            ),
-            "move_left": habitat_sim.agent.ActionSpec(
-                "move_left", habitat_sim.agent.ActuationSpec(amount=0.4)
-            ),
-            "move_right": habitat_sim.agent.ActionSpec(
-                "move_right", habitat_sim.agent.ActuationSpec(amount=0.4)
-            ),
-            "move_up": habitat_sim.agent.ActionSpec(
-                "move_up", habitat_sim.agent.ActuationSpec(amount=0.4)
-            ),
-            "move_down": habitat_sim.agent.ActionSpec(
-                "move_down", habitat_sim.agent.ActuationSpec(amount=0.4)
-            ),
-            "turn_left": habitat_sim.agent.ActionSpec(
-                "turn_left", habitat_sim.agent.ActuationSpec(amount=10.0)
-            ),
-            "turn_right": habitat_sim.agent.ActionSpec(
-                "turn_right", habitat_sim.agent.ActuationSpec(amount=10.0)
-            ),
-        }
+        agent_cfgs = [
+            _camera_agent_config(
+                "color_sensor" if agent_id == 0 else f"color_sensor_{agent_id}",
+                self.render_config.resolution,
+            )
+            for agent_id in range(num_agents)
+        ]
+
+        # 辅助 agent 只在需要时渲染, 不增加普通截图的开销
+        def add_aux_agent(uuid, sensor_type, resolution, **spec):
+            aux_cfg = habitat_sim.CameraSensorSpec()
+            aux_cfg.uuid = uuid
+            aux_cfg.sensor_type = sensor_type
+            aux_cfg.resolution = list(resolution)
+            aux_cfg.position = [0.0, 0.0, 0.0]
+            aux_cfg.hfov = HFOV
+            for key, value in spec.items():
+                setattr(aux_cfg, key, value)
+            aux_agent_cfg = habitat_sim.agent.AgentConfiguration()
+            aux_agent_cfg.sensor_specifications = [aux_cfg]
+            agent_cfgs.append(aux_agent_cfg)
+            return len(agent_cfgs) - 1
+
+        self.zoom_agent_id = None
+        if self.render_config.zoom:
+            self.zoom_agent_id = add_aux_agent(
+                "zoom_sensor",
+                habitat_sim.SensorType.COLOR,
+                self.render_config.zoom_resolution,
+            )
+        self.depth_agent_id = None
+        if self.render_config.targeting:
+            self.depth_agent_id = add_aux_agent(
+                "depth_sensor",
+                habitat_sim.SensorType.DEPTH,
+                # 与主相机同宽高比, unproject 按主相机的像素坐标反投影
+                [
+                    max(1, round(side * self.render_config.depth_scale))
+                    for side in self.render_config.resolution
+                ],
+            )
+        self.map_agent_id = None
+        self._map_base = None  # 俯视地图底图, 每个场景渲染一次
+        self._map_projection = None
+        if self.render_config.top_down_map:
+            # 网格加载前场景边界未知, 按采集位姿的范围加上边距取景
+            self.map_poses = [np.loadtxt(path) for path in self.view_pose_list]
+            positions = np.array([pose[:3, 3] for pose in self.map_poses])
+            self.map_center = (positions.min(axis=0) + positions.max(axis=0)) / 2
+            extent = np.ptp(positions[:, [0, 2]], axis=0).max() + 2 * MAP_MARGIN
+            self.map_agent_id = add_aux_agent(
+                "map_sensor",
+                habitat_sim.SensorType.COLOR,
+                [self.render_config.map_resolution] * 2,
+                sensor_subtype=habitat_sim.SensorSubType.ORTHOGRAPHIC,
+                ortho_scale=1.0 / extent,
+            )
+
+        self._executor = None
+        self._render_thread = None
+        if num_agents > 1:
+            self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="render")
+            self._render_thread = self._executor.submit(threading.get_ident).result()
+
+        cfg = habitat_sim.Configuration(backend_cfg, agent_cfgs)
+        self.sim = self.run(habitat_sim.Simulator, cfg)
+
+        def initial_state(agent_id):
+            agent_state = self.sim.get_agent(agent_id).get_state()
+            return {
+                "position": [float(x) for x in agent_state.position],
+                "rotation": [float(x) for x in quat_to_coeffs(agent_state.rotation)],
+                "view_idx": -1,
+                "on_traj": False,
+            }
+
+        # 各探索 agent 创建时的位姿, 每个问题都从这里开始
+        self.initial_states = [
+            self.run(initial_state, agent_id) for agent_id in range(num_agents)
+        ]
+
+        self._cameras = weakref.WeakValueDictionary()  # thread ident -> Camera
+        self._cameras_lock = threading.Lock()
+
+    def run(self, fn, *args, **kwargs):
+        """
+        在渲染线程上执行 fn 并返回结果, 单 agent 时直接执行
+        """
+        if self._executor is None or threading.get_ident() == self._render_thread:
+            return fn(*args, **kwargs)
+        # 渲染线程中的调用仍计入当前问题的 ledger 和 trace
+        context = contextvars.copy_context()
+        return self._executor.submit(context.run, fn, *args, **kwargs).result()
+
+    def camera(self) -> "Camera":
+        """
+        当前线程的 Camera, 绑定一个空闲的探索 agent
+        已释放的 Camera 和已结束线程的 agent 会被回收
+        """
+        thread = threading.get_ident()
+        with self._cameras_lock:
+            cam = self._cameras.get(thread)
+            if cam is not None:
+                cam.reset()
+                return cam
+
+            alive = {t.ident for t in threading.enumerate()}
+            for ident in [ident for ident in self._cameras if ident not in alive]:
+                del self._cameras[ident]
+            used = {cam.agent_id for cam in self._cameras.values()}
+            free = [agent_id for agent_id in range(self.num_agents) if agent_id not in used]
+            if not free:
+                raise RuntimeError(
+                    f"All {self.num_agents} camera agents of the scene are in use, raise concurrent_questions"
+                )
+            cam = Camera(self, free[0])
+            self._cameras[thread] = cam
+            return cam
+
+    def _map_pixel(self, point):
+        """
+        世界坐标在俯视地图中的像素坐标
+        """
+        transform, projection_size, viewport = self._map_projection
+        projected = transform.transform_point(mn.Vector3(*[float(v) for v in point]))
+        pixel = mn.Vector2(projected[0], -projected[1]) / projection_size
+        pixel = (pixel + mn.Vector2(0.5)) * mn.Vector2(viewport)
+        return float(pixel[0]), float(pixel[1])
+
+    def map_arrow(self, draw, position, forward, color, width: int):
+        """
+        在俯视地图中绘制位于 position, 水平朝向 forward 的位姿箭头
+        """
+        forward = np.array([forward[0], 0.0, forward[2]])
+        norm = np.linalg.norm(forward)
+        forward = forward / norm if norm > 1e-6 else forward
+        start = self._map_pixel(position)
+        end = self._map_pixel(position + forward * MAP_MARGIN / 3)
+        _draw_arrow(draw, start, end, color, width)
+        return start
+
+    def map_base(self) -> Image.Image:
+        """
+        在天花板下方用正交相机渲染俯视图, 并绘制编号的采集位姿箭头
+        只渲染一次, 需在渲染线程上调用
+        """
+        if self._map_base is not None:
+            return self._map_base
+
+        bb = self.sim.get_active_scene_graph().get_root_node().cumulative_bb
+        top = max(pose[1, 3] for pose in self.map_poses) + MAP_CAMERA_CLEARANCE
+        height = min(top, bb.max.y - 0.05)
+
+        map_agent = self.sim.get_agent(self.map_agent_id)
+        state = map_agent.get_state()
+        state.position = np.array(
+            [self.map_center[0], height, self.map_center[2]], dtype=np.float32
+        )
+        state.rotation = quat_from_angle_axis(-np.pi / 2, np.array([1, 0, 0]))
+        map_agent.set_state(state)
+        rgb = self.sim.get_sensor_observations(self.map_agent_id)["map_sensor"]
+
+        render_camera = map_agent._sensors["map_sensor"].render_camera
+        self._map_projection = (
+            render_camera.projection_matrix @ render_camera.camera_matrix,
+            render_camera.projection_size()[0],
+            render_camera.viewport,
+        )
+
+        img = Image.fromarray(rgb).convert("RGB")
+        draw = ImageDraw.Draw(img)
+        size = self.render_config.map_resolution
+        font = _load_font(max(12, size // 60))
+        for idx, pose in enumerate(self.map_poses):
+            # 相机朝向 -Z
+            x, y = self.map_arrow(draw, pose[:3, 3], -pose[:3, 2], (0, 160, 255), 2)
+            draw.text(
+                (x + 4, y + 4),
+                str(idx),
+                fill=(255, 255, 255),
+                font=font,
+                stroke_width=2,
+                stroke_fill=(0, 0, 0),
+            )
+        self._map_base = img
+        return img
+
+    def close(self):
+        if getattr(self, "sim", None) is not None:
+            self.run(self.sim.close)
+            self.sim = None
+        if getattr(self, "_executor", None) is not None:
+            # 最后的引用可能在渲染线程上释放, 此时不能等待自身结束
+            self._executor.shutdown(wait=threading.get_ident() != self._render_thread)
+            self._executor = None
+
+    def __del__(self):
+        self.close()
+
+
+class Camera:
+    """
+    绑定场景仿真器中一个 agent 的轻量句柄, 保存每个问题的相机状态
+    通过 SceneSimulator.camera 或 get_camera 获取
+    """
+
+    def __init__(self, scene: SceneSimulator, agent_id: int = 0):
+        self.scene = scene
+        self.sim = scene.sim
+        self.agent_id = agent_id
+        self.agent = scene.run(scene.sim.get_agent, agent_id)
+        self.sensor_uuid = "color_sensor" if agent_id == 0 else f"color_sensor_{agent_id}"
+        self.render_config = scene.render_config
+        self.view_pose_list = scene.view_pose_list
+        self.view_img_list = scene.view_img_list
+        self.frame_index = scene.frame_index
+        self.cur_view_idx = -1
+        self.screen_shot_cnt = 0
+        self.on_traj = False
+        self.shot_size = None  # 最近一张截图为采集帧时的 (高, 宽), 渲染图为 None
+        # agent 可能被已结束线程的 Camera 移动过
+        self.reset()
 
-        cfg = habitat_sim.Configuration(backend_cfg, [agent_cfg])
-        self.sim = habitat_sim.Simulator(cfg)
-        self.agent = self.sim.get_agent(0)
+    def reset(self):
+        """
+        重置每个问题相关的状态和位姿, 以便同一场景的下一个问题复用仿真器
+        """
+        self.set_state(self.scene.initial_states[self.agent_id])
+        self.screen_shot_cnt = 0
+        self.shot_size = None
 
+    @_serialized
     def _go_to_camera_view(self, pose):
         """
         切换到指定pose矩阵的视角
@@ -126,6 +469,32 @@ class Camera:
 
         self.agent.set_state(agent_state)
 
+    @_serialized
+    def get_state(self) -> dict:
+        """
+        当前相机状态, 用于记录和回放
+        """
+        agent_state = self.agent.get_state()
+        return {
+            "position": [float(x) for x in agent_state.position],
+            "rotation": [float(x) for x in quat_to_coeffs(agent_state.rotation)],
+            "view_idx": self.cur_view_idx,
+            "on_traj": self.on_traj,
+        }
+
+    @_serialized
+    def set_state(self, state: dict):
+        """
+        恢复 get_state 返回的相机状态
+        """
+        agent_state = self.agent.get_state()
+        agent_state.position = np.array(state["position"], dtype=np.float32)
+        agent_state.rotation = quat_from_coeffs(state["rotation"])
+        self.agent.set_state(agent_state)
+        self.cur_view_idx = state["view_idx"]
+        self.on_traj = state["on_traj"]
+
+    @_serialized
     def shot_birdeye_view(self, img_dir: str):
         """
         生成场景鸟瞰图并保存
@@ -175,6 +544,7 @@ class Camera:
         pose = np.loadtxt(self.view_pose_list[self.cur_view_idx])
         self._go_to_camera_view(pose)
 
+    @_serialized
     def move_camera(self, direction):
         """
         移动相机位置，使用habitat-sim原生API
@@ -195,6 +565,7 @@ class Camera:
         if action:
             self.agent.act(action)
 
+    @_serialized
     def rotate_horizontal(self, angle_deg):
         """
         水平旋转相机（绕Y轴），使用habitat-sim原生API
@@ -223,14 +594,226 @@ class Camera:
             agent_state.rotation = new_rotation
             self.agent.set_state(agent_state)
 
+    @_serialized
+    def look_around(self, img_dir: str, num_views: int = 8, tile_width: int = 480):
+        """
+        在当前位置水平环视一周, 一次渲染 num_views 个朝向并拼接为一张带标注的图
+        每个子图标注转向该朝向所需的动作, 相机状态保持不变
+        返回拼接图路径
+        """
+        agent_state = self.agent.get_state()
+        origin_rotation = agent_state.rotation
+
+        tiles = []
+        for idx in range(num_views):
+            angle = round(360.0 * idx / num_views)
+            state = self.agent.get_state()
+            state.rotation = (
+                quat_from_angle_axis(np.radians(angle), np.array([0, 1, 0]))
+                * origin_rotation
+            )
+            self.agent.set_state(state)
+            rgb = self.sim.get_sensor_observations(self.agent_id)[self.sensor_uuid]
+
+            if angle == 0:
+                label = "current view"
+            elif angle <= 180:
+                label = f"left-rotation+{angle}"
+            else:
+                label = f"right-rotation+{360 - angle}"
+            tiles.append(_label_tile(Image.fromarray(rgb).convert("RGB"), label, tile_width))
+
+        agent_state.rotation = origin_rotation
+        self.agent.set_state(agent_state)
+
+        # 每行最多 4 个子图, 避免图像过宽被模型压缩
+        cols = min(4, num_views)
+        rows = (num_views + cols - 1) // cols
+        tile_w, tile_h = tiles[0].size
+        panorama = Image.new("RGB", (cols * tile_w, rows * tile_h))
+        for idx, tile in enumerate(tiles):
+            panorama.paste(tile, ((idx % cols) * tile_w, (idx // cols) * tile_h))
+
+        self.screen_shot_cnt += 1
+        os.makedirs(img_dir, exist_ok=True)
+        name = os.path.join(img_dir, f"{self.screen_shot_cnt}_look_around.png")
+        panorama.save(name)
+        return os.path.abspath(name)
+
+    def _pixel_ray(self, x: float, y: float):
+        """
+        最近一张截图中归一化坐标 (0-1000, 原点在左上角) 的视线在相机坐标系中 z=-1 处的 (x, y)
+        采集帧的视场角未知, 按渲染视场角近似, 但使用采集帧自身的宽高比
+        """
+        height, width = self.shot_size or self.render_config.resolution
+        tan_half = np.tan(np.radians(HFOV / 2))
+        ray_x = (2 * x / 1000 - 1) * tan_half
+        ray_y = (1 - 2 * y / 1000) * tan_half * height / width
+        return ray_x, ray_y
+
+    def pixel_direction(self, x: float, y: float):
+        """
+        图像归一化坐标 (0-1000, 原点在左上角) 对应的视线方向
+        返回相对当前朝向的 (yaw, pitch) 角度, 向左和向上为正
+        """
+        ray_x, ray_y = self._pixel_ray(x, y)
+        yaw = -np.degrees(np.arctan(ray_x))
+        pitch = np.degrees(np.arctan2(ray_y, np.sqrt(ray_x**2 + 1)))
+        return yaw, pitch
+
+    def _look_rotation(self, yaw: float, pitch: float):
+        """
+        当前朝向先水平转 yaw 再俯仰 pitch 后的旋转
+        """
+        yaw_quat = quat_from_angle_axis(np.radians(yaw), np.array([0, 1, 0]))
+        pitch_quat = quat_from_angle_axis(np.radians(pitch), np.array([1, 0, 0]))
+        return self.agent.get_state().rotation * yaw_quat * pitch_quat
+
+    @_serialized
+    def unproject(self, x: float, y: float):
+        """
+        用深度图将当前视角中 (x, y) 处的像素反投影为世界坐标
+        像素处没有几何体时返回 None
+        """
+        depth_agent_id = self.scene.depth_agent_id
+        if depth_agent_id is None:
+            raise RuntimeError("Targeting is disabled, set render.targeting=true")
+        depth_agent = self.sim.get_agent(depth_agent_id)
+        state = self.agent.get_state()
+        depth_agent.set_state(state)
+        depth = self.sim.get_sensor_observations(depth_agent_id)["depth_sensor"]
+
+        height, width = depth.shape[:2]
+        row = min(int(y / 1000 * height), height - 1)
+        col = min(int(x / 1000 * width), width - 1)
+        z = float(depth[row, col])
+        if z <= 0:
+            return None
+
+        # 深度为沿光轴的距离, 相机朝向 -Z
+        ray_x, ray_y = self._pixel_ray(x, y)
+        point = np.array([ray_x * z, ray_y * z, -z])
+        return state.position + quat_rotate_vector(state.rotation, point)
+
+    def _face(self, direction):
+        """
+        朝向世界坐标系中的 direction 且不横滚的旋转
+        """
+        yaw = np.arctan2(-direction[0], -direction[2])
+        pitch = np.arctan2(direction[1], np.linalg.norm(direction[[0, 2]]))
+        yaw_quat = quat_from_angle_axis(yaw, np.array([0, 1, 0]))
+        pitch_quat = quat_from_angle_axis(pitch, np.array([1, 0, 0]))
+        return yaw_quat * pitch_quat
+
+    @_serialized
+    def look_at(self, x: float, y: float, standoff: float = None) -> bool:
+        """
+        转向当前视角中 (x, y) 处的物体, 给定 standoff 时再移动到其前方 standoff 米处
+        返回是否执行成功
+        """
+        target = self.unproject(x, y)
+        if target is None:
+            log.warning(f"No geometry at pixel ({x}, {y}), ignoring the action")
+            return False
+
+        self.on_traj = False
+        agent_state = self.agent.get_state()
+        direction = target - agent_state.position
+        distance = float(np.linalg.norm(direction))
+        if distance < 1e-6:
+            return False
+        if standoff is not None and distance > standoff:
+            agent_state.position = (target - direction / distance * standoff).astype(
+                np.float32
+            )
+            log.info(f"Moving camera {distance - standoff:.2f}m towards ({x}, {y})")
+        agent_state.rotation = self._face(direction)
+        self.agent.set_state(agent_state)
+        return True
+
+    @_serialized
+    def zoom(self, img_dir: str, x: float, y: float, factor: float):
+        """
+        以窄视场角重新渲染当前视角中 (x, y) 附近的区域, 相机状态保持不变
+        返回放大图路径
+        """
+        zoom_agent_id = self.scene.zoom_agent_id
+        if zoom_agent_id is None:
+            raise RuntimeError("Zoom is disabled, set render.zoom=true")
+        factor = float(np.clip(factor, 1, self.render_config.max_zoom))
+
+        zoom_agent = self.sim.get_agent(zoom_agent_id)
+        state = self.agent.get_state()
+        state.rotation = self._look_rotation(*self.pixel_direction(x, y))
+        zoom_agent.set_state(state)
+
+        sensor = zoom_agent._sensors["zoom_sensor"]
+        sensor.fov = mn.Deg(
+            float(np.degrees(2 * np.arctan(np.tan(np.radians(HFOV / 2)) / factor)))
+        )
+        rgb = self.sim.get_sensor_observations(zoom_agent_id)["zoom_sensor"]
+
+        self.screen_shot_cnt += 1
+        os.makedirs(img_dir, exist_ok=True)
+        name = os.path.join(img_dir, f"{self.screen_shot_cnt}_zoom.png")
+        Image.fromarray(rgb).convert("RGB").save(name)
+        return os.path.abspath(name)
+
+    @_serialized
+    def top_down_map(self, img_dir: str):
+        """
+        俯视地图, 蓝色编号箭头为各视角的采集位姿, 红色箭头为当前位姿
+        底图每个场景只渲染一次, 之后只叠加当前位姿, 相机状态保持不变
+        返回地图路径
+        """
+        if self.scene.map_agent_id is None:
+            raise RuntimeError("The top-down map is disabled, set render.top_down_map=true")
+
+        img = self.scene.map_base().copy()
+        state = self.agent.get_state()
+        forward = quat_rotate_vector(state.rotation, np.array([0.0, 0.0, -1.0]))
+        self.scene.map_arrow(ImageDraw.Draw(img), state.position, forward, (255, 0, 0), 5)
+
+        self.screen_shot_cnt += 1
+        os.makedirs(img_dir, exist_ok=True)
+        name = os.path.join(img_dir, f"{self.screen_shot_cnt}_map.png")
+        img.save(name)
+        return os.path.abspath(name)
+
+    @_serialized
+    def _render(self):
+        """
+        渲染当前 agent 的彩色图像
+        """
+        return self.sim.get_sensor_observations(self.agent_id)[self.sensor_uuid]
+
     def screen_shot(self, img_dir: str, img_name: str = None):
         """
         截取当前视角的图像
         返回截图路径
         """
         self.screen_shot_cnt += 1
+        self.shot_size = None
         if self.on_traj:
-            return self.view_img_list[self.cur_view_idx]
+            img_path = self.view_img_list[self.cur_view_idx]
+            self.shot_size = Image.open(img_path).size[::-1]
+            return img_path
+
+        # 位姿接近某个采集帧时直接返回真实图像, 不渲染
+        if self.frame_index is not None and img_name is None:
+            state = self.scene.run(self.agent.get_state)
+            match = self.frame_index.nearest(
+                state.position,
+                as_rotation_matrix(state.rotation),
+                self.render_config.snap_distance,
+                self.render_config.snap_angle,
+            )
+            if match is not None:
+                img_path, distance, angle = match
+                log.info(f"Using captured frame {img_path.name} ({distance:.2f}m, {angle:.1f}°)")
+                ledger.count("captured_frame")
+                self.shot_size = Image.open(img_path).size[::-1]
+                return img_path
 
         os.makedirs(img_dir, exist_ok=True)
         name = os.path.join(
@@ -238,8 +821,7 @@ class Camera:
             f"{self.screen_shot_cnt}.png" if not img_name else f"{img_name}.png",
         )
 
-        observations = self.sim.get_sensor_observations()
-        rgb = observations["color_sensor"]
+        rgb = self._render()
 
         img = Image.fromarray(rgb)
         img.save(name)
@@ -256,6 +838,38 @@ class Camera:
         move_insts = [inst for inst in insts if inst["type"] == "movement"]
         rotate_insts = [inst for inst in insts if inst["type"] == "rotation"]
         switch_insts = [inst for inst in insts if inst["type"] == "switch"]
+        for inst in move_insts + rotate_insts + switch_insts:
+            self._exec_command(inst)
+
+    def exec_macro(self, action: str, img_dir: str, max_actions: int = 4) -> list:
+        """
+        按顺序执行宏步骤中的多个指令, 在每个 snapshot 处截图
+        返回中间帧路径列表, 最终视角由调用方截图
+        """
+        if "done" in action.lower():
+            return []
+
+        snapshots = []
+        executed = 0
+        for inst in extract_patterns(action, ordered=True):
+            if inst["type"] == "snapshot":
+                # 连续或开头的 snapshot 与上一帧相同, 跳过
+                if executed and (not snapshots or snapshots[-1][0] != executed):
+                    snapshots.append((executed, self.screen_shot(img_dir)))
+                continue
+            if executed >= max_actions:
+                log.warning(f"Macro step exceeds {max_actions} actions, ignoring the rest")
+                break
+            self._exec_command(inst)
+            executed += 1
+
+        # 最后一个动作之后的 snapshot 就是最终视角
+        return [path for idx, path in snapshots if idx < executed]
+
+    def _exec_command(self, inst: dict):
+        """
+        执行单个解析后的指令
+        """
         DIRECTION_TO_KEY = {
             "forward": "a",
             "backward": "s",
@@ -264,24 +878,60 @@ class Camera:
             "upward": "j",
             "downward": "k",
         }
-        for inst in move_insts:
+        if inst["type"] == "movement":
             for _ in range(inst["value"]):
                 self.move_camera(DIRECTION_TO_KEY[inst["direction"]])
             log.info(f"Moving camera {inst['direction']} by {inst['value']} steps")
 
-        for inst in rotate_insts:
+        elif inst["type"] == "rotation":
             angle = inst["value"]
             direction = inst["direction"]
             angle = -angle if "right" in direction.lower() else angle
             self.rotate_horizontal(angle)
             log.info(f"Rotating camera by {angle} degrees")
 
-        for inst in switch_insts:
+        elif inst["type"] == "switch":
             if inst["target"] is not None:
                 self.switch_to_view(inst["target"])
             else:
                 self.switch_back_view()
 
-    def __del__(self):
-        if hasattr(self, "sim"):
-            self.sim.close()
+
+def get_camera(
+    ply_path: Path,
+    pose_path: Path,
+    rgb_img_path: Path,
+    cache_size: int = 1,
+    render_config: RenderConfig = None,
+    num_agents: int = 1,
+) -> Camera:
+    """
+    Return a reset Camera of the scene for the calling thread, reusing the simulator
+    of the last ``cache_size`` scenes instead of loading the mesh again for every
+    question. Up to ``num_agents`` threads can hold a Camera of the same scene at once.
+    """
+    key = str(ply_path)
+    render_config = render_config or RenderConfig()
+    with _scene_cache_lock:
+        scene = _scene_cache.pop(key, None)
+        if scene is not None and (
+            scene.render_config != render_config or scene.num_agents < num_agents
+        ):
+            scene = None
+        if scene is None:
+            scene = SceneSimulator(
+                ply_path=ply_path,
+                pose_path=pose_path,
+                rgb_img_path=rgb_img_path,
+                render_config=render_config,
+                num_agents=num_agents,
+            )
+        else:
+            log.info(f"Reusing simulator of {key}")
+
+        if cache_size > 0:
+            _scene_cache[key] = scene
+            while len(_scene_cache) > cache_size:
+                # Cameras still in use keep the evicted simulator open until released.
+                _scene_cache.popitem(last=False)
+        return scene.camera()
@@ -14,11 +14,19 @@ from omegaconf import MISSING
 class ModelConfig:
     """
     Currently support only OPENAI compatible api base.
+    Rate limits are shared by all models behind the same ``api_base_env``, 0 means unlimited.
+    Prices are USD per million tokens and only used for cost estimates.
     """
 
     model_name: str
     api_base_env: str
     api_key_env: str
+    requests_per_min: int = 0
+    tokens_per_min: int = 0
+    max_retries: int = 5
+    prompt_price_per_mtok: float = 0.0
+    completion_price_per_mtok: float = 0.0
+    cached_price_per_mtok: float = 0.0
 
 
 @dataclass
@@ -33,6 +41,9 @@ class GeminiFlashConfig(ModelConfig):
     model_name: str = "google/gemini-2.5-flash"
     api_base_env: str = "OPENROUTER_API_BASE"
     api_key_env: str = "OPENROUTER_API_KEY"
+    prompt_price_per_mtok: float = 0.3
+    completion_price_per_mtok: float = 2.5
+    cached_price_per_mtok: float = 0.075
 
 
 @dataclass
@@ -40,6 +51,9 @@ class GeminiFlashLiteConfig(ModelConfig):
     model_name: str = "google/gemini-2.5-flash-lite"
     api_base_env: str = "OPENROUTER_API_BASE"
     api_key_env: str = "OPENROUTER_API_KEY"
+    prompt_price_per_mtok: float = 0.1
+    completion_price_per_mtok: float = 0.4
+    cached_price_per_mtok: float = 0.025
 
 
 @dataclass
@@ -47,6 +61,9 @@ class GPTConfig(ModelConfig):
     model_name: str = "openai/gpt-4o-mini"
     api_base_env: str = "OPENROUTER_API_BASE"
     api_key_env: str = "OPENROUTER_API_KEY"
+    prompt_price_per_mtok: float = 0.15
+    completion_price_per_mtok: float = 0.6
+    cached_price_per_mtok: float = 0.075
 
 
 
@@ -71,6 +88,17 @@ class Qwen32bConfig(ModelConfig):
     api_key_env: str = "OLLAMA_API_KEY"
 
 
+@dataclass
+class MockConfig(ModelConfig):
+    """
+    Local mock server from tools/mock_vlm_server.py, for load testing.
+    """
+
+    model_name: str = "mock-vlm"
+    api_base_env: str = "MOCK_API_BASE"
+    api_key_env: str = "MOCK_API_KEY"
+
+
 @dataclass
 class DatasetConfig:
     question_file: Path
@@ -83,6 +111,136 @@ class HM3DFullConfig(DatasetConfig):
     output_dir: Path = Path("results/oeqa-hm3d-full/")
 
 
+@dataclass
+class HedgeConfig:
+    """
+    Duplicate a request once it runs longer than the ``quantile`` latency of its model.
+    """
+
+    enabled: bool = False
+    quantile: float = 0.9
+    max_hedge_rate: float = 0.1  # Fraction of calls allowed to be hedged.
+    min_samples: int = 20  # Latency samples needed before hedging starts.
+
+
+@dataclass
+class CacheConfig:
+    """
+    Persistent LLM response cache, mode is one of "off", "read" or "readwrite".
+    """
+
+    mode: str = "off"
+    path: Path = Path("results/llm_cache.sqlite")
+
+
+@dataclass
+class ReplayConfig:
+    """
+    Episode traces, mode is one of "off", "record" or "replay".
+    """
+
+    mode: str = "off"
+    trace_dir: Path = Path("results/traces")
+
+
+@dataclass
+class TraceConfig:
+    """
+    Tracing spans of every pipeline stage, format is "chrome" or "jsonl".
+    """
+
+    enabled: bool = False
+    path: Path = Path("results/trace.json")
+    format: str = "chrome"
+
+
+@dataclass
+class RetrievalConfig:
+    """
+    Shortlist the ``top_m`` frames most similar to the question before view selection.
+    ``backend`` is "hashing" (deterministic stub) or "clip" (needs open_clip_torch).
+    """
+
+    enabled: bool = False
+    backend: str = "hashing"
+    top_m: int = 20
+    index_dir: Path = Path("results/retrieval_index")
+    model: str = "ViT-B-32"
+    pretrained: str = "laion2b_s34b_b79k"
+
+
+@dataclass
+class RenderConfig:
+    """
+    Simulator rendering. ``resolution`` is [height, width] of the exploration frames.
+    ``zoom`` offers a "zoom+X,Y,F" action re-rendering a region of the view with a
+    narrower hfov at ``zoom_resolution``, so the base frames can stay low-res.
+    ``targeting`` offers "look-at+X,Y" and "go-to+X,Y" actions, which unproject a
+    pixel with a depth render at ``depth_scale`` times ``resolution``, keeping its
+    aspect, and face it, or move to ``standoff`` meters in front of it. ``top_down_map``
+    replaces the bird-eye shot with an orthographic map of ``map_resolution`` pixels
+    showing the numbered view poses and the current pose. ``snap_to_frames`` returns
+    the captured frame, sampled or not, closest to the camera pose instead of a
+    render when it is within ``snap_distance`` meters and ``snap_angle`` degrees.
+    """
+
+    resolution: List[int] = field(default_factory=lambda: [1080, 1920])
+    zoom: bool = False
+    zoom_resolution: List[int] = field(default_factory=lambda: [720, 720])
+    max_zoom: int = 8
+    targeting: bool = False
+    depth_scale: float = 0.25
+    standoff: float = 1.0
+    top_down_map: bool = False
+    map_resolution: int = 1024
+    snap_to_frames: bool = False
+    snap_distance: float = 0.15
+    snap_angle: float = 10.0
+
+
+@dataclass
+class CoverageConfig:
+    """
+    Per-episode coverage memory on a grid of ``voxel_size`` meters and ``yaw_bins``
+    headings. Each view comes with a coverage summary and a warning when the camera
+    returns to a cell it left. ``reuse_frames`` shows the earlier frame of a revisited
+    cell instead of rendering, if the pose is within ``reuse_distance`` meters and
+    ``reuse_angle`` degrees of the one that produced it.
+    """
+
+    enabled: bool = False
+    voxel_size: float = 0.5
+    yaw_bins: int = 8
+    reuse_frames: bool = False
+    reuse_distance: float = 0.05
+    reuse_angle: float = 2.0
+
+
+@dataclass
+class BranchConfig:
+    """
+    Explore from every selected anchor view in a parallel branch of at most
+    ``max_steps`` steps, then answer with one merge call over the final frames of the
+    branches. ``max_workers`` caps the concurrent LLM calls, 0 means one per branch.
+    """
+
+    enabled: bool = False
+    max_steps: int = 6
+    max_workers: int = 0
+
+
+@dataclass
+class StreamConfig:
+    """
+    Stream chat replies and execute the first action as soon as it is unambiguous,
+    while the rest of the reply is still being generated. ``early_stop`` ends the
+    generation right after that action to save completion tokens.
+    """
+
+    enabled: bool = False
+    early_stop: bool = False
+
+
 @dataclass
 class OpenEQAConfig:
     defaults: List[Any] = field(
@@ -95,6 +253,28 @@ class OpenEQAConfig:
     agent: str = "baseline"  # "cov" or "baseline"
     max_views_k: int = 5
     min_action_step: int = 3
+    results_fsync_every: int = 10  # Results appended between fsyncs of the store.
+    scene_order: str = "largest_first"  # "largest_first" or "first_seen"
+    scene_cache_size: int = 1  # Simulators of recent scenes kept alive for reuse.
+    num_workers: int = 1  # Worker processes, each with its own simulator.
+    worker_timeout_s: float = 1800  # A question running longer restarts its worker.
+    concurrent_questions: int = 1  # Questions per scene in flight at once, sharing its simulator.
+    batch_selection: bool = False  # Select views for all questions of a scene at once.
+    selection_batch_size: int = 16  # Questions per batched view selection request.
+    action_protocol: str = "text"  # "text" (regex parsing) or "tools" (function calling).
+    action_repair_retries: int = 1  # Re-asks per step for replies without a valid action.
+    macro_steps: bool = False  # Allow an ordered action sequence per step.
+    macro_max_actions: int = 4  # Actions executed per macro step, the rest is ignored.
+    look_around_views: int = 0  # Views of the "look-around" panorama action, 0 disables it.
+    hedge: HedgeConfig = field(default_factory=HedgeConfig)
+    cache: CacheConfig = field(default_factory=CacheConfig)
+    replay: ReplayConfig = field(default_factory=ReplayConfig)
+    trace: TraceConfig = field(default_factory=TraceConfig)
+    stream: StreamConfig = field(default_factory=StreamConfig)
+    retrieval: RetrievalConfig = field(default_factory=RetrievalConfig)
+    render: RenderConfig = field(default_factory=RenderConfig)
+    coverage: CoverageConfig = field(default_factory=CoverageConfig)
+    branches: BranchConfig = field(default_factory=BranchConfig)
 
 
 # https://dashscope.aliyuncs.com/compatible-mode/v1
@@ -115,3 +295,4 @@ cs.store(group="model", name="gemma", node=GemmaConfig)
 cs.store(group="model", name="qwen8b", node=Qwen8bConfig)
 cs.store(group="model", name="qwen32b", node=Qwen32bConfig)
 cs.store(group="model", name="gpt", node=GPTConfig)
+cs.store(group="model", name="mock", node=MockConfig)
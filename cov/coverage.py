@@ -0,0 +1,115 @@
+"""
+Per-episode exploration coverage on a voxel/yaw grid.
+
+Every camera view of an episode is recorded in the grid cell of its position
+(``voxel_size`` meters) and heading (``yaw_bins`` sectors). Coming back to a cell seen
+before, after leaving it, is a revisit; small adjustments within the current cell are
+not. The model gets a compact coverage summary with every view, and with
+``reuse_frames`` a revisit at nearly the same pose shows the earlier frame instead of
+rendering again.
+"""
+
+import logging
+from dataclasses import dataclass
+from typing import Optional
+
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+
+def heading(rotation: list) -> float:
+    """
+    Yaw in degrees of an [x, y, z, w] rotation, 0 when facing -Z, positive to the left.
+    """
+    x, y, z, w = rotation
+    # The camera looks along -Z, i.e. minus the third column of the rotation matrix.
+    forward_x = -2 * (x * z + w * y)
+    forward_z = -(1 - 2 * (x * x + y * y))
+    return float(np.degrees(np.arctan2(-forward_x, -forward_z)))
+
+
+@dataclass
+class Visit:
+    step: int
+    image_path: str
+    state: dict  # Camera state the image was taken at.
+
+
+class CoverageMemory:
+    """
+    Views of one episode, keyed by (voxel, yaw bin) of the camera state.
+    """
+
+    def __init__(self, voxel_size: float = 0.5, yaw_bins: int = 8):
+        self.voxel_size = voxel_size
+        self.yaw_bins = yaw_bins
+        self.visits = {}  # (ix, iy, iz, yaw bin) -> first visit
+        self.revisits = 0
+        self.last_cell = None  # Cell of the last recorded view.
+
+    def _sector(self) -> float:
+        return 360.0 / self.yaw_bins
+
+    def cell(self, state: dict) -> tuple:
+        """
+        Grid cell of a ``Camera.get_state`` dict.
+        """
+        voxel = tuple(int(v) for v in np.floor(np.array(state["position"]) / self.voxel_size))
+        # Bin 0 is centered on yaw 0.
+        yaw = (heading(state["rotation"]) + self._sector() / 2) % 360
+        return voxel + (int(yaw // self._sector()),)
+
+    def lookup(self, state: dict) -> Optional[Visit]:
+        """
+        The earlier visit of the cell of ``state`` if this returns to it, None if the
+        cell is new or the camera has not left it since the last view.
+        """
+        cell = self.cell(state)
+        if cell == self.last_cell:
+            return None
+        return self.visits.get(cell)
+
+    def record(self, state: dict, step: int, image_path: str):
+        cell = self.cell(state)
+        if cell not in self.visits:
+            self.visits[cell] = Visit(step, str(image_path), dict(state))
+        elif cell != self.last_cell:
+            self.revisits += 1
+        self.last_cell = cell
+
+    @staticmethod
+    def same_pose(visit: Visit, state: dict, max_distance: float, max_angle: float) -> bool:
+        """
+        Whether ``state`` is within ``max_distance`` meters and ``max_angle`` degrees of
+        the pose the image of ``visit`` was taken at, so the image can stand in for it.
+        """
+        distance = np.linalg.norm(np.subtract(state["position"], visit.state["position"]))
+        dot = abs(float(np.dot(state["rotation"], visit.state["rotation"])))
+        angle = np.degrees(2 * np.arccos(min(1.0, dot)))
+        return distance <= max_distance and angle <= max_angle
+
+    def summary(self, state: dict, revisit: Visit = None) -> str:
+        """
+        Coverage summary for the model, with the unseen headings of the current voxel
+        as rotations from the current heading.
+        """
+        places = {cell[:3] for cell in self.visits}
+        text = f"Coverage so far: {len(self.visits)} views from {len(places)} places."
+        if revisit is not None:
+            text += f" You already saw this view at step {revisit.step}, avoid going back and forth."
+
+        current = self.cell(state)
+        yaw = heading(state["rotation"])
+        rotations = []
+        for yaw_bin in range(self.yaw_bins):
+            if current[:3] + (yaw_bin,) in self.visits:
+                continue
+            delta = (yaw_bin * self._sector() - yaw + 180) % 360 - 180
+            if round(delta) > 0:
+                rotations.append(f"left-rotation+{round(delta)}")
+            elif round(delta) < 0:
+                rotations.append(f"right-rotation+{round(-delta)}")
+        if rotations:
+            text += f" Unseen headings from here: {', '.join(rotations)}."
+        return text
@@ -0,0 +1,62 @@
+"""
+Execution of chat actions on a camera, shared by the chat loop and exploration branches.
+"""
+
+import logging
+from dataclasses import dataclass, field
+
+from cov.camera import Camera
+from cov.config import OpenEQAConfig
+from cov.tracing import span
+from cov.utils import extract_target, extract_zoom, is_mostly_blank
+
+log = logging.getLogger(__name__)
+
+
+@dataclass
+class ActionOutcome:
+    override_path: str = None  # Panorama, close-up or map to show instead of the next screenshot.
+    show_birdeye: bool = False  # Show the initial bird-eye view next.
+    snapshots: list = field(default_factory=list)  # Intermediate frames of a macro step.
+
+
+def execute_action(
+    cam: Camera,
+    action: str,
+    img_dir: str,
+    config: OpenEQAConfig,
+    max_actions_per_step: int = 1,
+) -> ActionOutcome:
+    """
+    Execute one reply of the chatbot. Answers ("done+[...]") leave the camera unchanged.
+    """
+    outcome = ActionOutcome()
+    if "switch to bird-eye-view" in action and config.render.top_down_map:
+        # The map overlays the current pose, so it is drawn again every time.
+        with span("render", kind="top_down_map"):
+            outcome.override_path = cam.top_down_map(img_dir)
+    elif "switch to bird-eye-view" in action:
+        outcome.show_birdeye = True
+    elif "look-around" in action and config.look_around_views > 0:
+        with span("render", kind="look_around", views=config.look_around_views):
+            outcome.override_path = cam.look_around(img_dir, config.look_around_views)
+    elif config.render.zoom and extract_zoom(action) is not None:
+        x, y, factor = extract_zoom(action)
+        with span("render", kind="zoom", factor=factor):
+            outcome.override_path = cam.zoom(img_dir, x, y, factor)
+    elif config.render.targeting and extract_target(action) is not None:
+        kind, x, y = extract_target(action)
+        with span("exec_action", kind=kind) as action_attrs:
+            action_attrs["ok"] = cam.look_at(
+                x, y, config.render.standoff if kind == "go-to" else None
+            )
+    elif max_actions_per_step > 1:
+        with span("exec_action", macro=True) as action_attrs:
+            snapshots = cam.exec_macro(action, img_dir, max_actions_per_step)
+            # Blank intermediate frames show nothing, like blank steps.
+            outcome.snapshots = [path for path in snapshots if not is_mostly_blank(path)]
+            action_attrs["snapshots"] = len(outcome.snapshots)
+    else:
+        with span("exec_action"):
+            cam.exec_instruction(action)
+    return outcome
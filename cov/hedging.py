@@ -0,0 +1,150 @@
+"""
+Hedged requests: when a call runs longer than the running latency quantile of its
+model, a duplicate is issued and whichever finishes first wins.
+"""
+
+import logging
+import threading
+import time
+from collections import defaultdict, deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+log = logging.getLogger(__name__)
+
+
+class LatencyTracker:
+    """
+    Sliding window of call latencies per model.
+    """
+
+    def __init__(self, window: int = 200):
+        self.samples = defaultdict(lambda: deque(maxlen=window))
+        self.lock = threading.Lock()
+
+    def add(self, key: str, latency: float):
+        with self.lock:
+            self.samples[key].append(latency)
+
+    def count(self, key: str) -> int:
+        with self.lock:
+            return len(self.samples[key])
+
+    def quantile(self, key: str, q: float) -> float:
+        with self.lock:
+            ordered = sorted(self.samples[key])
+        if not ordered:
+            return float("inf")
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class Hedger:
+    """
+    Issue a duplicate call once the primary exceeds the ``quantile`` latency of its model.
+
+    Threads can not interrupt an in-flight HTTP request, so "cancelling" the loser means
+    cancelling it if it has not started yet and otherwise discarding its response. Tokens
+    spent by discarded responses are accounted in ``extra_tokens`` and passed to the
+    ``on_loser`` callback of the call.
+    """
+
+    def __init__(
+        self,
+        quantile: float = 0.9,
+        max_hedge_rate: float = 0.1,
+        min_samples: int = 20,
+        max_workers: int = 8,
+    ):
+        self.quantile = quantile
+        self.max_hedge_rate = max_hedge_rate
+        self.min_samples = min_samples
+        self.tracker = LatencyTracker()
+        self.pool = ThreadPoolExecutor(max_workers=max_workers)
+        self.lock = threading.Lock()
+
+        self.calls = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.extra_tokens = 0
+
+    def _submit(self, key: str, fn, record: bool = False):
+        """
+        Run ``fn`` in the pool. With ``record`` its latency is added to the tracker,
+        timed inside the pool so that queueing is not counted.
+        """
+        if not record:
+            return self.pool.submit(fn)
+
+        def timed():
+            start = time.monotonic()
+            result = fn()
+            self.tracker.add(key, time.monotonic() - start)
+            return result
+
+        return self.pool.submit(timed)
+
+    def _account_loser(self, future, tokens_of, on_loser):
+        if future.cancelled() or future.exception() is not None:
+            return
+        with self.lock:
+            self.extra_tokens += tokens_of(future.result())
+        if on_loser is not None:
+            on_loser(future.result())
+
+    def _may_hedge(self, key: str) -> bool:
+        if self.tracker.count(key) < self.min_samples:
+            return False
+        with self.lock:
+            return self.hedges < self.max_hedge_rate * self.calls
+
+    def call(self, key: str, fn, hedge_fn=None, tokens_of=lambda result: 0, on_loser=None):
+        """
+        Run ``fn`` with hedging. The duplicate runs ``hedge_fn`` (defaults to ``fn``),
+        ``tokens_of`` maps a result to the tokens it consumed. ``on_loser`` is called with
+        the discarded result, possibly from a pool thread after ``call`` returned.
+        """
+        with self.lock:
+            self.calls += 1
+
+        # Only the primary is sampled. The hedge waits for the rate limiter inside its
+        # call, which would bias the quantile upwards.
+        primary = self._submit(key, fn, record=True)
+        threshold = self.tracker.quantile(key, self.quantile)
+        if not self._may_hedge(key):
+            return primary.result()
+
+        done, _ = wait([primary], timeout=threshold)
+        if done:
+            return primary.result()
+
+        with self.lock:
+            self.hedges += 1
+        log.info(f"Hedging {key} request after {threshold:.2f}s")
+        hedge = self._submit(key, hedge_fn or fn)
+
+        pending = {primary, hedge}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            winner = next((f for f in done if f.exception() is None), None)
+            if winner is not None:
+                break
+        else:
+            # Both failed, surface the primary's error.
+            return primary.result()
+
+        loser = hedge if winner is primary else primary
+        if winner is hedge:
+            with self.lock:
+                self.hedge_wins += 1
+        loser.cancel()
+        loser.add_done_callback(lambda f: self._account_loser(f, tokens_of, on_loser))
+        return winner.result()
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "calls": self.calls,
+                "hedges": self.hedges,
+                "hedge_rate": self.hedges / self.calls if self.calls else 0.0,
+                "hedge_wins": self.hedge_wins,
+                "extra_tokens": self.extra_tokens,
+            }
@@ -0,0 +1,223 @@
+"""
+Per-question and per-run ledger of LLM calls: tokens, images, uploaded bytes, latency and cost.
+"""
+
+import json
+import logging
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import asdict, dataclass
+from pathlib import Path
+
+from cov.config import ModelConfig
+
+log = logging.getLogger(__name__)
+
+COUNTERS = (
+    "calls",
+    "prompt_tokens",
+    "completion_tokens",
+    "cached_tokens",
+    "images",
+    "uploaded_bytes",
+    "latency_s",
+    "cache_hits",
+    "cost_usd",
+)
+
+_active = ContextVar("cov_cost_ledger", default=None)
+
+
+@dataclass
+class CallRecord:
+    stage: str
+    prompt_tokens: int
+    completion_tokens: int
+    cached_tokens: int
+    images: int
+    uploaded_bytes: int
+    latency_s: float
+    cache_hit: bool
+    cost_usd: float
+    share: float = 1.0  # Fraction of a call shared by several questions.
+
+
+def estimate_cost(
+    model_config: ModelConfig,
+    prompt_tokens: int,
+    completion_tokens: int,
+    cached_tokens: int = 0,
+) -> float:
+    """
+    USD cost of one call from the per-million-token prices of ``model_config``.
+    """
+    uncached = max(0, prompt_tokens - cached_tokens)
+    return (
+        uncached * model_config.prompt_price_per_mtok
+        + cached_tokens * model_config.cached_price_per_mtok
+        + completion_tokens * model_config.completion_price_per_mtok
+    ) / 1e6
+
+
+def _rollup(records) -> dict:
+    totals = dict.fromkeys(COUNTERS, 0)
+    for record in records:
+        share = record.get("share", 1.0)
+        totals["calls"] += share
+        totals["cache_hits"] += int(record["cache_hit"]) * share
+        for key in COUNTERS:
+            if key in record:
+                totals[key] += record[key]
+    return totals
+
+
+class CostLedger:
+    """
+    Ledger of every LLM call made while answering one question.
+    """
+
+    def __init__(self, question_id: str, model_config: ModelConfig):
+        self.question_id = question_id
+        self.model_config = model_config
+        self.records = []
+        self.events = defaultdict(int)  # Output protocol events, see ``count``.
+        self._events_lock = threading.Lock()  # Exploration branches count concurrently.
+
+    def record(
+        self,
+        stage: str,
+        usage: dict,
+        cached_tokens: int,
+        images: int,
+        uploaded_bytes: int,
+        latency_s: float,
+        cache_hit: bool,
+    ):
+        prompt_tokens = usage.get("prompt_tokens", 0)
+        completion_tokens = usage.get("completion_tokens", 0)
+        cost = (
+            0.0
+            if cache_hit
+            else estimate_cost(
+                self.model_config, prompt_tokens, completion_tokens, cached_tokens
+            )
+        )
+        self.records.append(
+            CallRecord(
+                stage=stage,
+                prompt_tokens=prompt_tokens,
+                completion_tokens=completion_tokens,
+                cached_tokens=cached_tokens,
+                images=images,
+                uploaded_bytes=uploaded_bytes,
+                latency_s=latency_s,
+                cache_hit=cache_hit,
+                cost_usd=cost,
+            )
+        )
+
+    def add_shared(self, calls: list, share: float):
+        """
+        Add ``share`` of calls made for several questions, e.g. batched view selection.
+        """
+        for call in calls:
+            scaled = dict(call, share=call.get("share", 1.0) * share)
+            for key in (
+                "prompt_tokens",
+                "completion_tokens",
+                "cached_tokens",
+                "images",
+                "uploaded_bytes",
+                "latency_s",
+                "cost_usd",
+            ):
+                scaled[key] = call[key] * share
+            self.records.append(CallRecord(**scaled))
+
+    def summary(self) -> dict:
+        """
+        Totals per stage and overall, plus the individual calls.
+        """
+        calls = [asdict(record) for record in self.records]
+        by_stage = defaultdict(list)
+        for call in calls:
+            by_stage[call["stage"]].append(call)
+        return {
+            "total": _rollup(calls),
+            "stages": {stage: _rollup(records) for stage, records in by_stage.items()},
+            "events": dict(self.events),
+            "calls": calls,
+        }
+
+
+class RunLedger:
+    """
+    Roll-up of question ledgers over a run.
+    """
+
+    def __init__(self, model_config: ModelConfig):
+        self.model_config = model_config
+        self.questions = 0
+        self.stages = defaultdict(lambda: dict.fromkeys(COUNTERS, 0))
+        self.events = defaultdict(int)
+
+    def add(self, summary: dict):
+        self.questions += 1
+        for stage, totals in summary["stages"].items():
+            for key in COUNTERS:
+                self.stages[stage][key] += totals[key]
+        for event, n in summary.get("events", {}).items():
+            self.events[event] += n
+
+    def summary(self) -> dict:
+        total = dict.fromkeys(COUNTERS, 0)
+        for totals in self.stages.values():
+            for key in COUNTERS:
+                total[key] += totals[key]
+        return {
+            "model": self.model_config.model_name,
+            "questions": self.questions,
+            "total": total,
+            "per_question_cost_usd": total["cost_usd"] / self.questions
+            if self.questions
+            else 0.0,
+            "stages": dict(self.stages),
+            "events": dict(self.events),
+        }
+
+    def save(self, path: Path):
+        with open(path, "w") as f:
+            json.dump(self.summary(), f, indent=2)
+        log.info(f"Cost ledger saved to: {path}")
+
+
+def current():
+    """
+    The ledger of the running question, or None.
+    """
+    return _active.get()
+
+
+@contextmanager
+def question(question_id: str, model_config: ModelConfig):
+    """
+    Collect all LLM calls made inside the block into a new ``CostLedger``.
+    """
+    ledger = CostLedger(question_id, model_config)
+    token = _active.set(ledger)
+    try:
+        yield ledger
+    finally:
+        _active.reset(token)
+
+
+def count(event: str, n: int = 1):
+    """
+    Count an event of the running question, e.g. "malformed_output".
+    """
+    question_ledger = current()
+    if question_ledger is not None:
+        with question_ledger._events_lock:
+            question_ledger.events[event] += n
@@ -0,0 +1,355 @@
+"""
+Single entry point for all LLM calls made by the bots.
+"""
+
+import logging
+import os
+import time
+from dataclasses import dataclass, field
+from typing import Callable
+
+from litellm import completion
+
+from cov import ledger, replay
+from cov.cache import ResponseCache, cache_key
+from cov.config import ModelConfig, OpenEQAConfig
+from cov.hedging import Hedger
+from cov.ratelimit import RETRYABLE_STATUS, estimate_tokens, get_rate_limiter
+from cov import tracing
+from cov.tracing import span
+
+log = logging.getLogger(__name__)
+
+# litellm provider of every model endpoint.
+PROVIDER = "openai"
+
+# Process-wide call options, set by ``configure``.
+_hedger = None
+_cache = None
+
+
+@dataclass
+class LLMResult:
+    content: str
+    usage: dict = field(default_factory=dict)
+    latency: float = 0.0
+    cached: bool = False
+    cached_tokens: int = 0  # Prompt tokens served from the provider's prompt cache.
+    truncated: bool = False  # Streaming was stopped early by the caller.
+    tool_calls: list = None  # [{"name": ..., "arguments": json text}] if tools were used.
+
+
+def usage_to_dict(usage) -> dict:
+    """
+    Convert a litellm usage object into plain token counters.
+    """
+    return {
+        key: getattr(usage, key, 0) or 0
+        for key in ("prompt_tokens", "completion_tokens", "total_tokens")
+    }
+
+
+def configure(config: OpenEQAConfig):
+    """
+    Set up process-wide LLM call options from the experiment config.
+    """
+    global _hedger, _cache
+
+    _hedger = None
+    if config.hedge.enabled:
+        _hedger = Hedger(
+            quantile=config.hedge.quantile,
+            max_hedge_rate=config.hedge.max_hedge_rate,
+            min_samples=config.hedge.min_samples,
+        )
+
+    if _cache is not None:
+        _cache.close()
+    _cache = None
+    if config.cache.mode != "off":
+        _cache = ResponseCache(config.cache.path, mode=config.cache.mode)
+
+
+def get_stats() -> dict:
+    """
+    Process-wide statistics of the optional call layers.
+    """
+    stats = {}
+    if _hedger is not None:
+        stats["hedge"] = _hedger.stats()
+    if _cache is not None:
+        stats["cache"] = _cache.stats()
+    return stats
+
+
+def _cached_tokens(usage) -> int:
+    details = getattr(usage, "prompt_tokens_details", None)
+    return getattr(details, "cached_tokens", 0) or 0
+
+
+def _record_loser(question_ledger, response):
+    """
+    Charge the tokens of a discarded hedge duplicate to the question that issued it.
+    """
+    if question_ledger is None:
+        return
+    usage = getattr(response, "usage", None)
+    question_ledger.record(
+        "hedge",
+        usage_to_dict(usage),
+        cached_tokens=_cached_tokens(usage),
+        images=0,
+        uploaded_bytes=0,
+        latency_s=0.0,
+        cache_hit=False,
+    )
+
+
+def _total_tokens(response) -> int:
+    return getattr(getattr(response, "usage", None), "total_tokens", 0) or 0
+
+
+def payload_stats(messages: list, estimate: bool = True) -> dict:
+    """
+    Image count, uploaded bytes and, with ``estimate``, estimated prompt tokens of a
+    message list.
+    """
+    images, image_bytes, text_bytes = 0, 0, 0
+    for message in messages:
+        content = message.get("content")
+        if isinstance(content, str):
+            text_bytes += len(content.encode("utf-8"))
+            continue
+        for part in content or []:
+            if part.get("type") == "text":
+                text_bytes += len(part.get("text", "").encode("utf-8"))
+            elif part.get("type") == "image_url":
+                image_url = part["image_url"]
+                if isinstance(image_url, dict):
+                    image_url = image_url.get("url", "")
+                images += 1
+                image_bytes += len(image_url)
+    stats = {"images": images, "image_bytes": image_bytes, "text_bytes": text_bytes}
+    if estimate:
+        stats["estimated_prompt_tokens"] = estimate_tokens(messages)
+    return stats
+
+
+def chat_completion(
+    model_config: ModelConfig,
+    messages: list,
+    stage: str = "chat",
+    on_delta: Callable[[str], bool] = None,
+    **kwargs,
+) -> LLMResult:
+    """
+    Call the OPENAI compatible endpoint of ``model_config``.
+    ``stage`` names the calling bot, e.g. "selection" or "chat", for traces.
+    Responses are replayed from a trace or served from the cache when enabled.
+
+    With ``on_delta`` the reply is streamed and every text delta is passed to it;
+    returning True stops the generation. Replayed and cached replies are passed
+    as a single delta.
+    """
+    # Only spans use the token estimate, and nothing is needed without spans or a ledger.
+    question_ledger = ledger.current()
+    payload = {}
+    if tracing.enabled():
+        payload = payload_stats(messages)
+    elif question_ledger is not None:
+        payload = payload_stats(messages, estimate=False)
+    with span(
+        f"llm.{stage}",
+        model=model_config.model_name,
+        messages=len(messages),
+        stream=on_delta is not None,
+        **payload,
+    ) as attrs:
+        result = _complete(model_config, messages, stage, on_delta, **kwargs)
+        attrs.update(result.usage, cached=result.cached, truncated=result.truncated)
+
+    if question_ledger is not None:
+        question_ledger.record(
+            stage,
+            result.usage,
+            cached_tokens=result.cached_tokens,
+            images=payload["images"],
+            uploaded_bytes=payload["image_bytes"] + payload["text_bytes"],
+            latency_s=result.latency,
+            cache_hit=result.cached,
+        )
+    return result
+
+
+def _complete(
+    model_config: ModelConfig,
+    messages: list,
+    stage: str,
+    on_delta: Callable[[str], bool] = None,
+    **kwargs,
+) -> LLMResult:
+    episode = replay.current()
+    key = None
+    if _cache is not None or episode is not None:
+        key = cache_key(
+            model_config.model_name,
+            messages,
+            api_base=os.environ.get(model_config.api_base_env, ""),
+            provider=PROVIDER,
+            **kwargs,
+        )
+
+    if isinstance(episode, replay.EpisodePlayer):
+        content, usage, tool_calls = episode.next_llm(stage, key)
+        if on_delta is not None:
+            on_delta(content)
+        return LLMResult(content=content, usage=usage, cached=True, tool_calls=tool_calls)
+
+    hit = _cache.get(key) if _cache is not None else None
+    if hit is not None:
+        content, usage, tool_calls = hit
+        # No tokens are spent on a hit, the stored usage only keeps its counters.
+        result = LLMResult(
+            content=content,
+            usage=dict.fromkeys(usage, 0),
+            cached=True,
+            tool_calls=tool_calls,
+        )
+        if on_delta is not None:
+            on_delta(content)
+    else:
+        result = _call_provider(model_config, messages, on_delta, **kwargs)
+        # A truncated reply is not what a plain call would return.
+        if _cache is not None and not result.truncated:
+            _cache.put(
+                key,
+                model_config.model_name,
+                result.content,
+                result.usage,
+                tool_calls=result.tool_calls,
+            )
+
+    if episode is not None:
+        episode.on_llm(stage, key, result.content, result.usage, tool_calls=result.tool_calls)
+    return result
+
+
+def _stream(response, on_delta: Callable[[str], bool]):
+    """
+    Consume a litellm stream, returns the text, the usage chunk if any and whether
+    ``on_delta`` stopped it.
+    """
+    parts, usage = [], None
+    for chunk in response:
+        usage = getattr(chunk, "usage", None) or usage
+        if not chunk.choices:
+            continue
+        delta = chunk.choices[0].delta.content
+        if not delta:
+            continue
+        parts.append(delta)
+        if on_delta(delta):
+            # Closing the HTTP response makes the server stop generating.
+            close = getattr(getattr(response, "completion_stream", None), "close", None)
+            if close is not None:
+                close()
+            return "".join(parts), usage, True
+    return "".join(parts), usage, False
+
+
+def _call_provider(
+    model_config: ModelConfig,
+    messages: list,
+    on_delta: Callable[[str], bool] = None,
+    **kwargs,
+) -> LLMResult:
+    """
+    Provider call with rate limiting.
+    429/503 responses are retried up to ``model_config.max_retries`` times with AIMD backoff.
+    Slow calls are hedged when enabled by ``configure``, streamed calls never are.
+    """
+    limiter = get_rate_limiter(model_config)
+    estimated_tokens = estimate_tokens(messages)
+    # The discarded hedge duplicate may finish after this call returned, outside the
+    # context of the question that paid for it.
+    question_ledger = ledger.current()
+
+    def call(**stream_kwargs):
+        return completion(
+            model=model_config.model_name,
+            api_base=os.environ[model_config.api_base_env],
+            api_key=os.environ[model_config.api_key_env],
+            custom_llm_provider=PROVIDER,
+            messages=messages,
+            temperature=0,
+            **stream_kwargs,
+            **kwargs,
+        )
+
+    def hedged_call():
+        # The duplicate request takes its own slot from the rate limiter.
+        limiter.acquire(estimated_tokens)
+        return call()
+
+    def stream_call():
+        response = call(stream=True, stream_options={"include_usage": True})
+        return _stream(response, on_delta)
+
+    for attempt in range(model_config.max_retries + 1):
+        limiter.acquire(estimated_tokens)
+        start = time.monotonic()
+        try:
+            if on_delta is not None:
+                # Throttling is reported when the stream opens, before any delta.
+                content, usage, truncated = stream_call()
+            elif _hedger is not None:
+                response = _hedger.call(
+                    model_config.model_name,
+                    call,
+                    hedge_fn=hedged_call,
+                    tokens_of=_total_tokens,
+                    on_loser=lambda response: _record_loser(question_ledger, response),
+                )
+            else:
+                response = call()
+        except Exception as e:
+            status = getattr(e, "status_code", None)
+            if status not in RETRYABLE_STATUS or attempt == model_config.max_retries:
+                raise
+            backoff = limiter.on_throttle(attempt)
+            log.warning(
+                f"{model_config.model_name} returned {status}, retry {attempt + 1}/{model_config.max_retries} in {backoff:.1f}s"
+            )
+            continue
+
+        limiter.on_success()
+        if on_delta is not None:
+            usage_dict = usage_to_dict(usage)
+            if usage is None:
+                # Stopped streams end before the usage chunk, estimate it.
+                usage_dict = {
+                    "prompt_tokens": estimated_tokens,
+                    "completion_tokens": max(1, len(content) // 4),
+                }
+                usage_dict["total_tokens"] = sum(usage_dict.values())
+            return LLMResult(
+                content=content,
+                usage=usage_dict,
+                latency=time.monotonic() - start,
+                cached_tokens=_cached_tokens(usage),
+                truncated=truncated,
+            )
+
+        usage = getattr(response, "usage", None)
+        message = response.choices[0].message
+        tool_calls = [
+            {"name": tool_call.function.name, "arguments": tool_call.function.arguments}
+            for tool_call in getattr(message, "tool_calls", None) or []
+        ]
+        return LLMResult(
+            content=message.content or "",
+            usage=usage_to_dict(usage),
+            latency=time.monotonic() - start,
+            cached_tokens=_cached_tokens(usage),
+            tool_calls=tool_calls or None,
+        )
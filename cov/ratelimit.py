@@ -0,0 +1,230 @@
+"""
+Cross-process token-bucket rate limiting for LLM providers.
+
+Every provider (keyed by ``ModelConfig.api_base_env``) owns a small JSON state
+file guarded by ``fcntl.flock``, so all processes hitting the same provider on
+one machine share a single budget. 429/503 responses shrink the effective rate
+multiplicatively, successful calls grow it back additively (AIMD).
+"""
+
+import base64
+import fcntl
+import json
+import logging
+import math
+import os
+import random
+import struct
+import tempfile
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+from cov.config import ModelConfig
+
+log = logging.getLogger(__name__)
+
+RETRYABLE_STATUS = (429, 503)
+
+# AIMD parameters for the shared rate multiplier.
+MIN_RATE_SCALE = 0.1
+RATE_INCREASE = 0.05
+RATE_DECREASE = 0.5
+MAX_BACKOFF_S = 60.0
+
+# Fallback cost for images whose size can not be read from the payload header.
+DEFAULT_IMAGE_TOKENS = 1105
+
+
+def _state_dir() -> Path:
+    return Path(
+        os.environ.get(
+            "COV_RATELIMIT_DIR", os.path.join(tempfile.gettempdir(), "cov-ratelimit")
+        )
+    )
+
+
+def _image_size_from_data_url(url: str):
+    """
+    Read (width, height) from the IHDR chunk of a base64 PNG data url without decoding it.
+    """
+    if "base64," not in url:
+        return None
+    head = url.split("base64,", 1)[1][:44]
+    try:
+        raw = base64.b64decode(head)
+    except ValueError:
+        return None
+    if raw[:8] != b"\x89PNG\r\n\x1a\n" or len(raw) < 24:
+        return None
+    return struct.unpack(">II", raw[16:24])
+
+
+def estimate_image_tokens(url: str) -> int:
+    """
+    Estimate image tokens with the common 512px tile scheme (fit in 2048, short side 768).
+    """
+    size = _image_size_from_data_url(url)
+    if size is None:
+        return DEFAULT_IMAGE_TOKENS
+    width, height = size
+    scale = min(1.0, 2048 / max(width, height))
+    width, height = width * scale, height * scale
+    scale = min(1.0, 768 / min(width, height))
+    width, height = width * scale, height * scale
+    return 85 + 170 * math.ceil(width / 512) * math.ceil(height / 512)
+
+
+def estimate_tokens(messages: list) -> int:
+    """
+    Estimate prompt tokens of a chat message list before sending it.
+    Text is counted as ~4 characters per token, images by their pixel size.
+    """
+    tokens = 0
+    for message in messages:
+        content = message.get("content")
+        if isinstance(content, str):
+            tokens += len(content) // 4 + 4
+            continue
+        for part in content or []:
+            if part.get("type") == "text":
+                tokens += len(part.get("text", "")) // 4
+            elif part.get("type") == "image_url":
+                image_url = part["image_url"]
+                if isinstance(image_url, dict):
+                    image_url = image_url.get("url", "")
+                tokens += estimate_image_tokens(image_url)
+        tokens += 4
+    return tokens
+
+
+class RateLimiter:
+    """
+    Requests/min and tokens/min buckets shared by all processes using one provider.
+    A limit of 0 disables that bucket; AIMD backoff is always active.
+    """
+
+    def __init__(self, key: str, requests_per_min: int = 0, tokens_per_min: int = 0):
+        self.key = key
+        self.requests_per_min = requests_per_min
+        self.tokens_per_min = tokens_per_min
+
+        state_dir = _state_dir()
+        state_dir.mkdir(parents=True, exist_ok=True)
+        self.state_path = state_dir / f"{key}.json"
+        self.lock_path = state_dir / f"{key}.lock"
+
+    @contextmanager
+    def _locked_state(self):
+        with open(self.lock_path, "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                state = self._load_state()
+                yield state
+                tmp_path = self.state_path.with_suffix(".tmp")
+                with open(tmp_path, "w") as f:
+                    json.dump(state, f)
+                os.replace(tmp_path, self.state_path)
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _load_state(self) -> dict:
+        now = time.time()
+        default = {
+            "requests": float(self.requests_per_min),
+            "tokens": float(self.tokens_per_min),
+            "updated": now,
+            "rate_scale": 1.0,
+            "cooldown_until": 0.0,
+        }
+        try:
+            with open(self.state_path, "r") as f:
+                return {**default, **json.load(f)}
+        except (FileNotFoundError, json.JSONDecodeError):
+            return default
+
+    def _refill(self, state: dict, now: float):
+        elapsed = max(0.0, now - state["updated"])
+        scale = state["rate_scale"]
+        for bucket, limit in (
+            ("requests", self.requests_per_min),
+            ("tokens", self.tokens_per_min),
+        ):
+            capacity = limit * scale
+            state[bucket] = min(capacity, state[bucket] + elapsed * capacity / 60)
+        state["updated"] = now
+
+    def acquire(self, tokens: int = 0):
+        """
+        Block until one request of ``tokens`` estimated tokens fits in both buckets.
+        """
+        while True:
+            with self._locked_state() as state:
+                now = time.time()
+                self._refill(state, now)
+                wait = state["cooldown_until"] - now
+                scale = state["rate_scale"]
+
+                if wait <= 0:
+                    # Never ask for more than a full bucket, or we'd wait forever.
+                    cost = min(tokens, self.tokens_per_min * scale)
+                    waits = [0.0]
+                    if self.requests_per_min and state["requests"] < 1:
+                        waits.append(
+                            (1 - state["requests"]) * 60 / (self.requests_per_min * scale)
+                        )
+                    if self.tokens_per_min and state["tokens"] < cost:
+                        waits.append(
+                            (cost - state["tokens"]) * 60 / (self.tokens_per_min * scale)
+                        )
+                    wait = max(waits)
+                    if wait <= 0:
+                        if self.requests_per_min:
+                            state["requests"] -= 1
+                        if self.tokens_per_min:
+                            state["tokens"] -= cost
+                        return
+
+            log.debug(f"Rate limiter {self.key} waiting {wait:.2f}s")
+            time.sleep(min(wait, MAX_BACKOFF_S))
+
+    def on_success(self):
+        """
+        Additive increase of the shared rate multiplier.
+        """
+        with self._locked_state() as state:
+            state["rate_scale"] = min(1.0, state["rate_scale"] + RATE_INCREASE)
+
+    def on_throttle(self, attempt: int) -> float:
+        """
+        Multiplicative decrease after a 429/503 and a jittered exponential cooldown.
+        Returns the cooldown in seconds.
+        """
+        backoff = min(MAX_BACKOFF_S, 2**attempt) * (0.5 + random.random() / 2)
+        with self._locked_state() as state:
+            now = time.time()
+            self._refill(state, now)
+            state["rate_scale"] = max(
+                MIN_RATE_SCALE, state["rate_scale"] * RATE_DECREASE
+            )
+            state["cooldown_until"] = max(state["cooldown_until"], now + backoff)
+        return backoff
+
+
+_limiters = {}
+
+
+def get_rate_limiter(model_config: ModelConfig) -> RateLimiter:
+    """
+    Return the process-wide limiter of the provider behind ``model_config``.
+    """
+    key = model_config.api_base_env
+    limiter = _limiters.get(key)
+    if limiter is None:
+        limiter = RateLimiter(
+            key,
+            requests_per_min=model_config.requests_per_min,
+            tokens_per_min=model_config.tokens_per_min,
+        )
+        _limiters[key] = limiter
+    return limiter
@@ -0,0 +1,146 @@
+"""
+Record LLM responses, actions and camera states of an episode, and replay them offline.
+
+A trace is a gzipped JSONL file per question. In replay mode ``chat_completion`` serves
+recorded responses in order instead of calling the provider, while bots and the camera
+run for real, giving deterministic network-free runs of the whole pipeline.
+"""
+
+import gzip
+import json
+import logging
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from pathlib import Path
+
+import numpy as np
+
+from cov.config import OpenEQAConfig
+
+log = logging.getLogger(__name__)
+
+REPLAY_MODES = ("off", "record", "replay")
+
+_active = ContextVar("cov_replay_episode", default=None)
+
+
+def get_trace_path(config: OpenEQAConfig, question_id: str) -> Path:
+    return config.replay.trace_dir / f"{question_id}.jsonl.gz"
+
+
+class EpisodeRecorder:
+    def __init__(self, path: Path):
+        self.path = path
+        self.events = []
+
+    def on_llm(
+        self, stage: str, key: str, content: str, usage: dict, tool_calls: list = None
+    ):
+        event = {"type": "llm", "stage": stage, "key": key, "content": content, "usage": usage}
+        if tool_calls:
+            event["tool_calls"] = tool_calls
+        self.events.append(event)
+
+    def on_step(self, step: int, action: str, camera_state: dict):
+        self.events.append(
+            {"type": "step", "step": step, "action": action, "camera": camera_state}
+        )
+
+    def close(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with gzip.open(self.path, "wt", encoding="utf-8") as f:
+            for event in self.events:
+                f.write(json.dumps(event, ensure_ascii=False) + "\n")
+        log.info(f"Episode trace saved to: {self.path}")
+
+
+class EpisodePlayer:
+    def __init__(self, path: Path):
+        if not path.exists():
+            raise FileNotFoundError(f"No recorded trace for replay: {path}")
+        self.path = path
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            events = [json.loads(line) for line in f]
+        self.llm_events = [e for e in events if e["type"] == "llm"]
+        self.step_events = {e["step"]: e for e in events if e["type"] == "step"}
+        self.used = set()  # Indexes of the served LLM events.
+        self.mismatches = 0
+        self._lock = threading.Lock()
+
+    def next_llm(self, stage: str, key: str):
+        """
+        Return (content, usage, tool_calls) of the next recorded response.
+        Concurrent calls, e.g. of exploration branches, may not come in the recorded
+        order, so the first unused response of the same request is preferred.
+        """
+        with self._lock:
+            unused = [idx for idx in range(len(self.llm_events)) if idx not in self.used]
+            if not unused:
+                raise RuntimeError(f"Trace {self.path} has no more recorded LLM responses")
+            match = next(
+                (
+                    idx
+                    for idx in unused
+                    if self.llm_events[idx]["stage"] == stage
+                    and self.llm_events[idx]["key"] == key
+                ),
+                None,
+            )
+            if match is None:
+                match = unused[0]
+                self.mismatches += 1
+                log.warning(
+                    f"Replay diverged at LLM call {len(self.used) + 1} ({stage}): request differs from the recording"
+                )
+            self.used.add(match)
+        event = self.llm_events[match]
+        return event["content"], event["usage"], event.get("tool_calls")
+
+    def on_llm(
+        self, stage: str, key: str, content: str, usage: dict, tool_calls: list = None
+    ):
+        pass
+
+    def on_step(self, step: int, action: str, camera_state: dict):
+        event = self.step_events.get(step)
+        if event is None or event["action"] != action:
+            self.mismatches += 1
+            log.warning(f"Replay diverged at step {step}: action differs from the recording")
+            return
+        for key in ("position", "rotation"):
+            if not np.allclose(event["camera"][key], camera_state[key], atol=1e-4):
+                self.mismatches += 1
+                log.warning(f"Replay diverged at step {step}: camera {key} differs")
+
+    def close(self):
+        log.info(f"Replayed {self.path} with {self.mismatches} mismatches")
+
+
+def current():
+    """
+    The recorder or player of the running episode, or None.
+    """
+    return _active.get()
+
+
+@contextmanager
+def episode(config: OpenEQAConfig, question_id: str):
+    """
+    Record or replay the LLM calls of one question according to ``config.replay.mode``.
+    """
+    mode = config.replay.mode
+    if mode not in REPLAY_MODES:
+        raise ValueError(f"Unknown replay mode {mode}, expected one of {REPLAY_MODES}")
+    if mode == "off":
+        yield None
+        return
+
+    path = get_trace_path(config, question_id)
+    handler = EpisodeRecorder(path) if mode == "record" else EpisodePlayer(path)
+    token = _active.set(handler)
+    try:
+        yield handler
+        handler.close()
+    finally:
+        _active.reset(token)
@@ -0,0 +1,165 @@
+"""
+Append-only JSONL results store with a question_id index for resuming.
+
+Export to the JSON list format written by earlier versions of main.py:
+
+    python -m cov.results results/oeqa-hm3d-full/qwen3-vl-flash/cov/3/cov-results.jsonl
+"""
+
+import argparse
+import json
+import logging
+import os
+import time
+from pathlib import Path
+
+log = logging.getLogger(__name__)
+
+# Fields added to results by later versions, kept in the store but not exported, so
+# the JSON keeps the schema of earlier versions.
+STORE_ONLY_FIELDS = ("ledger", "selected_views", "shortlist")
+
+
+class ResultsStore:
+    """
+    Results are appended one JSON object per line and fsynced in batches, so a killed
+    run loses at most the last unsynced batch and never corrupts earlier records. A
+    truncated trailing line is dropped when the store is reopened, corrupt complete
+    lines are skipped.
+    """
+
+    def __init__(
+        self,
+        path: Path,
+        fsync_every: int = 10,
+        fsync_interval_s: float = 5.0,
+        legacy_json_path: Path = None,
+    ):
+        self.path = Path(path)
+        self.fsync_every = fsync_every
+        self.fsync_interval_s = fsync_interval_s
+        self.index = {}  # question_id -> byte offset of its line
+        self.unsynced = 0
+        self.last_sync = time.monotonic()
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._load_index()
+        self.file = open(self.path, "ab")
+
+        if not self.index and legacy_json_path is not None and legacy_json_path.exists():
+            self._import_legacy(legacy_json_path)
+
+    def _load_index(self):
+        if not self.path.exists():
+            return
+        valid_end = 0
+        with open(self.path, "rb") as f:
+            offset = 0
+            for line in f:
+                # Only the last line can be cut short by a killed run.
+                if not line.endswith(b"\n"):
+                    log.warning(f"Dropping truncated record at byte {offset} of {self.path}")
+                    break
+                try:
+                    self.index[json.loads(line)["question_id"]] = offset
+                except (json.JSONDecodeError, KeyError, TypeError):
+                    log.warning(f"Skipping corrupt record at byte {offset} of {self.path}")
+                offset += len(line)
+                valid_end = offset
+        if valid_end < self.path.stat().st_size:
+            with open(self.path, "r+b") as f:
+                f.truncate(valid_end)
+
+    def _import_legacy(self, legacy_json_path: Path):
+        with open(legacy_json_path, "r") as f:
+            results = json.load(f)
+        for result in results:
+            self.append(result)
+        self.sync()
+        log.info(f"Imported {len(results)} results from {legacy_json_path}")
+
+    def __contains__(self, question_id: str) -> bool:
+        return question_id in self.index
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def get(self, question_id: str) -> dict:
+        """
+        Read one result by question_id.
+        """
+        self.file.flush()
+        with open(self.path, "rb") as f:
+            f.seek(self.index[question_id])
+            return json.loads(f.readline())
+
+    def values(self):
+        """
+        Iterate the latest result of every question in insertion order.
+        """
+        self.file.flush()
+        offsets = set(self.index.values())
+        with open(self.path, "rb") as f:
+            offset = 0
+            for line in f:
+                if offset in offsets:
+                    yield json.loads(line)
+                offset += len(line)
+
+    def append(self, result: dict):
+        line = (json.dumps(result, ensure_ascii=False) + "\n").encode("utf-8")
+        offset = self.file.tell()
+        self.file.write(line)
+        self.file.flush()
+        self.index[result["question_id"]] = offset
+
+        self.unsynced += 1
+        if (
+            self.unsynced >= self.fsync_every
+            or time.monotonic() - self.last_sync >= self.fsync_interval_s
+        ):
+            self.sync()
+
+    def sync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.unsynced = 0
+        self.last_sync = time.monotonic()
+
+    def export_json(self, output_path: Path):
+        """
+        Write all results as one indented JSON list, atomically, without the
+        ``STORE_ONLY_FIELDS``.
+        """
+        results = [
+            {key: value for key, value in result.items() if key not in STORE_ONLY_FIELDS}
+            for result in self.values()
+        ]
+        tmp_path = Path(output_path).with_suffix(".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(results, f, indent=2, ensure_ascii=False)
+        os.replace(tmp_path, output_path)
+        log.info(f"Exported {len(self)} results to: {output_path}")
+
+    def close(self):
+        if not self.file.closed:
+            self.sync()
+            self.file.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export a JSONL results store to JSON")
+    parser.add_argument("store", type=Path, help="path of the *-results.jsonl store")
+    parser.add_argument(
+        "-o", "--output", type=Path, default=None, help="defaults to the .json sibling"
+    )
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    store = ResultsStore(args.store)
+    store.export_json(args.output or args.store.with_suffix(".json"))
+    store.close()
+
+
+if __name__ == "__main__":
+    main()
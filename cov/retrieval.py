@@ -0,0 +1,201 @@
+"""
+Text-conditioned pre-filter of scene frames before LLM view selection.
+
+Frames of a scene are embedded once and persisted to a per-scene ``.npz`` index, the
+question is embedded on every call and the ``top_m`` most similar frames are
+shortlisted. Backends:
+
+- "hashing": deterministic and dependency free, for tests and benchmarks of the
+  plumbing. Its similarities carry no meaning.
+- "clip": open_clip image/text embeddings on CPU, install ``open_clip_torch``.
+"""
+
+import hashlib
+import logging
+import re
+import threading
+from collections import OrderedDict
+from pathlib import Path
+
+import numpy as np
+from PIL import Image
+
+from cov.config import RetrievalConfig
+
+log = logging.getLogger(__name__)
+
+RETRIEVAL_BACKENDS = ("hashing", "clip")
+
+
+def _normalize(embeddings: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(embeddings, axis=-1, keepdims=True)
+    return embeddings / np.maximum(norms, 1e-12)
+
+
+class HashingBackend:
+    """
+    Images are fixed random projections of a 16x16 thumbnail, texts are hashed bags
+    of words. Deterministic across runs and machines.
+    """
+
+    name = "hashing"
+
+    def __init__(self, dim: int = 64):
+        self.dim = dim
+        rng = np.random.default_rng(0)
+        self.projection = rng.standard_normal((16 * 16 * 3, dim)).astype(np.float32)
+
+    def embed_images(self, img_paths: list) -> np.ndarray:
+        thumbnails = [
+            np.asarray(Image.open(path).convert("RGB").resize((16, 16)), dtype=np.float32)
+            for path in img_paths
+        ]
+        pixels = np.stack(thumbnails).reshape(len(img_paths), -1) / 255.0
+        return _normalize(pixels @ self.projection)
+
+    def embed_text(self, text: str) -> np.ndarray:
+        embedding = np.zeros(self.dim, dtype=np.float32)
+        for word in re.findall(r"\w+", text.lower()):
+            digest = hashlib.md5(word.encode("utf-8")).digest()
+            sign = 1.0 if digest[4] % 2 else -1.0
+            embedding[int.from_bytes(digest[:4], "little") % self.dim] += sign
+        return _normalize(embedding)
+
+
+class ClipBackend:
+    """
+    open_clip embeddings, images are embedded in batches on CPU.
+    """
+
+    name = "clip"
+
+    def __init__(self, model: str, pretrained: str, batch_size: int = 32):
+        try:
+            import open_clip
+            import torch
+        except ImportError as e:
+            raise ImportError(
+                "The clip retrieval backend needs open_clip_torch, use retrieval.backend=hashing otherwise"
+            ) from e
+
+        self.torch = torch
+        self.batch_size = batch_size
+        self.model, _, self.preprocess = open_clip.create_model_and_transforms(
+            model, pretrained=pretrained
+        )
+        self.model.eval()
+        self.tokenizer = open_clip.get_tokenizer(model)
+        self.name = f"clip-{model}-{pretrained}"
+
+    def embed_images(self, img_paths: list) -> np.ndarray:
+        embeddings = []
+        with self.torch.no_grad():
+            for start in range(0, len(img_paths), self.batch_size):
+                batch = self.torch.stack(
+                    [
+                        self.preprocess(Image.open(path).convert("RGB"))
+                        for path in img_paths[start : start + self.batch_size]
+                    ]
+                )
+                embeddings.append(self.model.encode_image(batch).float().numpy())
+        return _normalize(np.concatenate(embeddings))
+
+    def embed_text(self, text: str) -> np.ndarray:
+        with self.torch.no_grad():
+            tokens = self.tokenizer([text])
+            return _normalize(self.model.encode_text(tokens).float().numpy()[0])
+
+
+class Retriever:
+    """
+    Shortlist scene frames for a question, with one persisted index per scene.
+    """
+
+    def __init__(self, config: RetrievalConfig, max_scenes: int = 4):
+        if config.backend not in RETRIEVAL_BACKENDS:
+            raise ValueError(
+                f"Unknown retrieval backend {config.backend}, expected one of {RETRIEVAL_BACKENDS}"
+            )
+        self.config = config
+        if config.backend == "clip":
+            self.backend = ClipBackend(config.model, config.pretrained)
+        else:
+            self.backend = HashingBackend()
+        self.max_scenes = max_scenes
+        self.indexes = OrderedDict()  # episode_history -> frame embeddings
+        self.lock = threading.Lock()  # Questions of a scene build its index once.
+
+    def _index_path(self, episode_history: str) -> Path:
+        return (
+            Path(self.config.index_dir)
+            / self.backend.name
+            / f"{episode_history.replace('/', '__')}.npz"
+        )
+
+    def scene_index(self, episode_history: str, img_paths: list) -> np.ndarray:
+        """
+        Frame embeddings of a scene, loaded from disk or computed and saved.
+        """
+        with self.lock:
+            if episode_history in self.indexes:
+                self.indexes.move_to_end(episode_history)
+                return self.indexes[episode_history]
+
+            names = np.array([Path(path).name for path in img_paths])
+            mtimes = np.array([Path(path).stat().st_mtime_ns for path in img_paths])
+            path = self._index_path(episode_history)
+            embeddings = None
+            if path.exists():
+                index = np.load(path)
+                if np.array_equal(index["names"], names) and np.array_equal(
+                    index["mtimes"], mtimes
+                ):
+                    embeddings = index["embeddings"]
+                else:
+                    log.info(f"Frames of {episode_history} changed, rebuilding {path}")
+
+            if embeddings is None:
+                embeddings = self.backend.embed_images(img_paths).astype(np.float32)
+                path.parent.mkdir(parents=True, exist_ok=True)
+                tmp_path = path.with_suffix(".tmp.npz")
+                np.savez(tmp_path, names=names, mtimes=mtimes, embeddings=embeddings)
+                tmp_path.replace(path)
+                log.info(f"Indexed {len(img_paths)} frames of {episode_history} to {path}")
+
+            self.indexes[episode_history] = embeddings
+            if len(self.indexes) > self.max_scenes:
+                self.indexes.popitem(last=False)
+            return embeddings
+
+    def rank(self, episode_history: str, question: str, img_paths: list) -> list:
+        """
+        All view ids ordered by similarity to the question, best first.
+        """
+        embeddings = self.scene_index(episode_history, img_paths)
+        scores = embeddings @ self.backend.embed_text(question)
+        # Stable sort keeps view order among ties.
+        return np.argsort(-scores, kind="stable").tolist()
+
+    def shortlist(self, episode_history: str, question: str, img_paths: list) -> list:
+        """
+        The ``top_m`` view ids most similar to the question, in view order.
+        """
+        if len(img_paths) <= self.config.top_m:
+            return list(range(len(img_paths)))
+        return sorted(self.rank(episode_history, question, img_paths)[: self.config.top_m])
+
+
+_retriever = None
+_retriever_lock = threading.Lock()  # Concurrent questions share the retriever.
+
+
+def get_retriever(config: RetrievalConfig) -> Retriever:
+    """
+    Process-wide retriever, so the embedding model is loaded once.
+    """
+    global _retriever
+
+    with _retriever_lock:
+        if _retriever is None or _retriever.config != config:
+            _retriever = Retriever(config)
+        return _retriever
@@ -0,0 +1,412 @@
+"""
+Serial and multiprocess runners over scene groups.
+
+In parallel mode each worker process keeps its own simulator alive across the
+questions of a scene and pulls the next scene group from a shared queue owned by
+the parent as soon as it is idle (work stealing). The parent is the only writer of
+the results store, restarts crashed or hung workers and re-queues their unfinished
+questions, so a lost worker never loses its peers' work.
+
+With ``concurrent_questions`` above 1, the questions of a scene group run in threads
+that share the simulator of the scene, each on its own camera agent.
+"""
+
+import contextvars
+import logging
+import multiprocessing as mp
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from multiprocessing import connection
+
+from cov import ledger, replay, tracing
+from cov.agents import Preselection, baseline_agent, batch_view_selection, cov_agent
+from cov.config import OpenEQAConfig
+from cov.llm import configure as configure_llm
+from cov.llm import get_stats as get_llm_stats
+from cov.results import ResultsStore
+from cov.scheduler import SceneGroup
+
+log = logging.getLogger(__name__)
+
+AGENT_REGISTRY = {"cov": cov_agent, "baseline": baseline_agent}
+
+# Attempts per question before it is given up after worker crashes or hangs.
+MAX_QUESTION_ATTEMPTS = 2
+
+# Consecutive workers of a slot dying before they are ready, e.g. on a bad config,
+# before the run is given up.
+MAX_STARTUP_FAILURES = 3
+
+
+def run_question(cfg: OpenEQAConfig, item: dict, preselection: Preselection = None) -> dict:
+    """
+    Answer one question with the configured agent, attaching its cost ledger.
+    """
+    question_id = item["question_id"]
+    agent_func = AGENT_REGISTRY[cfg.agent]
+    agent_kwargs = {}
+    with replay.episode(cfg, question_id), ledger.question(
+        question_id, cfg.model
+    ) as question_ledger, tracing.span(
+        "question", question_id=question_id, agent=cfg.agent
+    ):
+        if preselection is not None:
+            question_ledger.add_shared(preselection.calls, preselection.share)
+            agent_kwargs["preselected_views"] = preselection.views
+        result = agent_func(
+            episode_history=item["episode_history"],
+            question_id=question_id,
+            question=item["question"],
+            gts=[item["answer"]] if "answer" in item else None,
+            config=cfg,
+            **agent_kwargs,
+        )
+    result["ledger"] = question_ledger.summary()
+    return result
+
+
+def preselect_views(cfg: OpenEQAConfig, episode_history: str, items: list) -> dict:
+    """
+    Batched view selection for the pending questions of a scene, if enabled.
+    Questions missing from the returned dict select their views on their own.
+    """
+    if not cfg.batch_selection or cfg.agent != "cov" or len(items) < 2:
+        return {}
+    try:
+        return batch_view_selection(episode_history, items, cfg)
+    except Exception as e:
+        log.exception(f"Batched view selection failed for {episode_history}: {e}")
+        return {}
+
+
+def _answer_concurrently(
+    cfg: OpenEQAConfig, items: list, preselections: dict, on_start=None
+):
+    """
+    Answer ``items`` with at most ``cfg.concurrent_questions`` in flight, yielding
+    (item, result, error) as they finish. ``on_start`` is called with each item before
+    it starts, on the calling thread.
+    """
+    if cfg.concurrent_questions <= 1:
+        for item in items:
+            if on_start is not None:
+                on_start(item)
+            try:
+                yield item, run_question(cfg, item, preselections.get(item["question_id"])), None
+            except Exception as e:
+                yield item, None, e
+        return
+
+    queue = deque(items)
+    with ThreadPoolExecutor(
+        max_workers=cfg.concurrent_questions, thread_name_prefix="question"
+    ) as pool:
+        running = {}
+        while queue or running:
+            while queue and len(running) < cfg.concurrent_questions:
+                item = queue.popleft()
+                if on_start is not None:
+                    on_start(item)
+                context = contextvars.copy_context()
+                future = pool.submit(
+                    context.run,
+                    run_question,
+                    cfg,
+                    item,
+                    preselections.get(item["question_id"]),
+                )
+                running[future] = item
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                item = running.pop(future)
+                error = future.exception()
+                yield item, None if error else future.result(), error
+
+
+def _store_result(result: dict, results: ResultsStore, run_ledger, num_questions: int):
+    run_ledger.add(result["ledger"])
+    # Store data instantly in case of losing result data accidently.
+    with tracing.span("write_results", results=len(results)):
+        results.append(result)
+    log.info(
+        f"Successfully processed {result['question_id']}, total completed: {len(results)}/{num_questions}"
+    )
+
+
+def run_serial(
+    cfg: OpenEQAConfig,
+    scene_groups: list,
+    results: ResultsStore,
+    run_ledger,
+    num_questions: int,
+):
+    for scene_idx, group in enumerate(scene_groups):
+        pending = sum(item["question_id"] not in results for item in group.items)
+        log.info(
+            f"Scene {scene_idx + 1}/{len(scene_groups)} {group.episode_history}: {pending}/{len(group)} questions pending"
+        )
+        preselections = preselect_views(
+            cfg,
+            group.episode_history,
+            [item for item in group.items if item["question_id"] not in results],
+        )
+
+        items = []
+        progress = {}
+        for idx, item in enumerate(group.items):
+            question_id = item["question_id"]
+            progress[question_id] = f"scene {scene_idx + 1}/{len(scene_groups)}, question {idx + 1}/{len(group)}"
+
+            # Skip exsiting
+            if question_id in results:
+                log.info(f"Skipping already processed {progress[question_id]}: {question_id}")
+                continue
+            items.append(item)
+
+        def on_start(item):
+            log.info(f"Processing {progress[item['question_id']]}: {item['question_id']}")
+
+        for item, result, error in _answer_concurrently(cfg, items, preselections, on_start):
+            if error is not None:
+                log.error(
+                    f"Failed to process question {item['question_id']}: {error}",
+                    exc_info=error,
+                )
+                continue
+            _store_result(result, results, run_ledger, num_questions)
+
+
+def _worker_main(worker_id: int, cfg: OpenEQAConfig, conn):
+    """
+    Worker loop: ask for a scene group, answer its questions, repeat until None.
+    Pipe sends are synchronous, so every reported result survives a later crash.
+    """
+    logging.basicConfig(
+        level=logging.INFO,
+        format=f"[%(asctime)s][worker {worker_id}][%(name)s][%(levelname)s] - %(message)s",
+    )
+    configure_llm(cfg)
+    tracing.configure(cfg)
+
+    conn.send(("ready", None))
+    while True:
+        group = conn.recv()
+        if group is None:
+            break
+        # Preselection loads the scene and calls the model for the whole group, the
+        # parent times it like a question.
+        conn.send(("preselect", group.episode_history))
+        preselections = preselect_views(cfg, group.episode_history, group.items)
+        conn.send(("preselected", None))
+        for item, result, error in _answer_concurrently(
+            cfg,
+            group.items,
+            preselections,
+            on_start=lambda item: conn.send(("start", item["question_id"])),
+        ):
+            if error is not None:
+                log.error(
+                    f"Failed to process question {item['question_id']}: {error}",
+                    exc_info=error,
+                )
+                conn.send(("error", item["question_id"]))
+            else:
+                conn.send(("result", result))
+        conn.send(("ready", None))
+
+    log.info(f"Worker {worker_id} LLM call stats: {get_llm_stats()}")
+
+
+class _WorkerHandle:
+    def __init__(self, worker_id: int, cfg: OpenEQAConfig, ctx):
+        self.worker_id = worker_id
+        self.conn, child_conn = ctx.Pipe()
+        self.process = ctx.Process(
+            target=_worker_main,
+            args=(worker_id, cfg, child_conn),
+            daemon=True,
+        )
+        self.process.start()
+        child_conn.close()
+        self.idle = False
+        self.started = False  # Reported ready at least once.
+        self.group = None  # Scene group being processed.
+        self.finished = set()  # Question ids of the group already reported.
+        self.inflight = {}  # question_id -> start time
+        self.preselect_start = None  # Start time of the group's view preselection.
+
+    def assign(self, group: SceneGroup):
+        self.idle = False
+        self.group = group
+        self.finished = set()
+        self.inflight = {}
+        self.preselect_start = None
+        self.conn.send(group)
+
+    def unfinished_items(self) -> list:
+        if self.group is None:
+            return []
+        return [
+            item for item in self.group.items if item["question_id"] not in self.finished
+        ]
+
+
+def run_parallel(
+    cfg: OpenEQAConfig,
+    scene_groups: list,
+    results: ResultsStore,
+    run_ledger,
+    num_questions: int,
+):
+    """
+    Answer questions with ``cfg.num_workers`` worker processes.
+    """
+    pending = deque()
+    for group in scene_groups:
+        items = [item for item in group.items if item["question_id"] not in results]
+        if items:
+            pending.append(SceneGroup(group.episode_history, items))
+    log.info(
+        f"Running {sum(len(g) for g in pending)} questions in {len(pending)} scene groups on {cfg.num_workers} workers"
+    )
+
+    # Simulators and GL contexts do not survive fork, always start fresh interpreters.
+    ctx = mp.get_context("spawn")
+    workers = [_WorkerHandle(worker_id, cfg, ctx) for worker_id in range(cfg.num_workers)]
+    attempts = {}
+    startup_failures = [0] * cfg.num_workers
+
+    def handle_message(worker: _WorkerHandle, kind: str, payload):
+        if kind == "ready":
+            worker.idle = True
+            worker.started = True
+            startup_failures[worker.worker_id] = 0
+            worker.group = None
+        elif kind == "preselect":
+            worker.preselect_start = time.monotonic()
+        elif kind == "preselected":
+            worker.preselect_start = None
+        elif kind == "start":
+            worker.inflight[payload] = time.monotonic()
+        elif kind == "result":
+            worker.finished.add(payload["question_id"])
+            worker.inflight.pop(payload["question_id"], None)
+            _store_result(payload, results, run_ledger, num_questions)
+        elif kind == "error":
+            worker.finished.add(payload)
+            worker.inflight.pop(payload, None)
+
+    def drain(worker: _WorkerHandle):
+        # Collect whatever a dead worker reported before it died.
+        try:
+            while worker.conn.poll():
+                handle_message(worker, *worker.conn.recv())
+        except (EOFError, OSError):
+            pass
+
+    def requeue(worker: _WorkerHandle, reason: str, culprits: list = None):
+        """
+        Re-queue the unfinished questions of a lost worker. An attempt is charged to
+        ``culprits`` (default: the whole group if it was lost in view preselection,
+        else the in-flight questions if there is only one). When several were in
+        flight at a crash, each is re-queued as a group of its own, so that a retry
+        tells which one crashes.
+        """
+        if culprits is None and worker.preselect_start is not None:
+            culprits = [item["question_id"] for item in worker.unfinished_items()]
+        elif culprits is None:
+            culprits = list(worker.inflight) if len(worker.inflight) == 1 else []
+        items, isolated = [], []
+        for item in worker.unfinished_items():
+            question_id = item["question_id"]
+            if question_id in culprits:
+                attempts[question_id] = attempts.get(question_id, 0) + 1
+                if attempts[question_id] >= MAX_QUESTION_ATTEMPTS:
+                    log.error(f"Giving up question {question_id}, worker {reason}")
+                    continue
+            if question_id in worker.inflight and len(worker.inflight) > 1 and not culprits:
+                isolated.append(item)
+            else:
+                items.append(item)
+        if items:
+            pending.appendleft(SceneGroup(worker.group.episode_history, items))
+        for item in isolated:
+            pending.appendleft(SceneGroup(worker.group.episode_history, [item]))
+        if items or isolated:
+            log.warning(
+                f"Worker {worker.worker_id} {reason}, re-queued {len(items) + len(isolated)} questions of {worker.group.episode_history}"
+            )
+
+    while True:
+        # Hand scene groups to idle workers.
+        for worker in workers:
+            if worker.idle and pending:
+                group = pending.popleft()
+                log.info(
+                    f"Worker {worker.worker_id} takes scene {group.episode_history} ({len(group)} questions, {len(pending)} scene groups left)"
+                )
+                worker.assign(group)
+
+        if not pending and all(worker.idle for worker in workers):
+            break
+
+        for conn in connection.wait([worker.conn for worker in workers], timeout=1.0):
+            worker = next(w for w in workers if w.conn is conn)
+            try:
+                handle_message(worker, *conn.recv())
+            except (EOFError, OSError):
+                pass  # Worker died, handled below.
+
+        # Restart crashed or hung workers.
+        for idx, worker in enumerate(workers):
+            reason, hung = None, None
+            if not worker.process.is_alive():
+                reason = f"exited with code {worker.process.exitcode}"
+            else:
+                now = time.monotonic()
+                hung = [
+                    question_id
+                    for question_id, start in worker.inflight.items()
+                    if now - start > cfg.worker_timeout_s
+                ]
+                if (
+                    worker.preselect_start is not None
+                    and now - worker.preselect_start > cfg.worker_timeout_s
+                ):
+                    hung = [item["question_id"] for item in worker.unfinished_items()]
+                    reason = f"timed out in view preselection of {worker.group.episode_history}"
+                    worker.process.kill()
+                elif hung:
+                    reason = f"timed out on {', '.join(hung)}"
+                    worker.process.kill()
+            if reason is None:
+                continue
+
+            worker.process.join()
+            drain(worker)
+            worker.conn.close()
+            requeue(worker, reason, hung)
+            if not worker.started:
+                startup_failures[worker.worker_id] += 1
+                if startup_failures[worker.worker_id] >= MAX_STARTUP_FAILURES:
+                    for other in workers:
+                        if other is not worker:
+                            other.process.kill()
+                    remaining = [item["question_id"] for group in pending for item in group.items]
+                    remaining += [
+                        item["question_id"]
+                        for other in workers
+                        if other is not worker
+                        for item in other.unfinished_items()
+                    ]
+                    raise RuntimeError(
+                        f"Worker {worker.worker_id} {reason} before getting ready {MAX_STARTUP_FAILURES} times in a row, "
+                        f"giving up {len(remaining)} remaining questions: {', '.join(remaining)}"
+                    )
+            workers[idx] = _WorkerHandle(worker.worker_id, cfg, ctx)
+
+    for worker in workers:
+        worker.conn.send(None)
+    for worker in workers:
+        worker.process.join()
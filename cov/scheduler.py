@@ -0,0 +1,51 @@
+"""
+Scene-affinity scheduling: questions are grouped by scene so that per-scene caches
+(simulator, encoded frames, selection results) are reused across consecutive questions.
+"""
+
+import logging
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import List
+
+log = logging.getLogger(__name__)
+
+SCENE_ORDERS = ("first_seen", "largest_first")
+
+
+@dataclass
+class SceneGroup:
+    episode_history: str
+    items: List[dict] = field(default_factory=list)
+
+    def __len__(self):
+        return len(self.items)
+
+
+def group_by_scene(questions: list, order: str = "largest_first") -> List[SceneGroup]:
+    """
+    Group questions by ``episode_history``, keeping file order inside each group.
+
+    "largest_first" schedules scenes with the most questions first, which amortizes
+    scene loading best and balances work when groups are handed to parallel workers.
+    "first_seen" keeps the order in which scenes first appear in the question file.
+    """
+    if order not in SCENE_ORDERS:
+        raise ValueError(f"Unknown scene order {order}, expected one of {SCENE_ORDERS}")
+
+    groups = OrderedDict()
+    for item in questions:
+        episode_history = item["episode_history"]
+        if episode_history not in groups:
+            groups[episode_history] = SceneGroup(episode_history)
+        groups[episode_history].items.append(item)
+
+    scene_groups = list(groups.values())
+    if order == "largest_first":
+        # sorted is stable, ties keep first seen order.
+        scene_groups = sorted(scene_groups, key=len, reverse=True)
+
+    log.info(
+        f"Scheduled {len(questions)} questions in {len(scene_groups)} scene groups ({order})"
+    )
+    return scene_groups
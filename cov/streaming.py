@@ -0,0 +1,142 @@
+"""
+Early action commit for streamed chat replies.
+
+A streamed reply is parsed as it arrives. Once its first action can no longer change,
+the agent executes it and renders the next view while the model is still writing the
+rest of the reply. If the complete reply asks for something else, e.g. a later action
+was the one meant, the agent undoes the early action and executes the full reply.
+"""
+
+import contextvars
+import logging
+import re
+import threading
+from typing import Callable, Optional
+
+from cov.utils import extract_patterns, extract_target, extract_zoom
+
+log = logging.getLogger(__name__)
+
+# Actions of the chatbot grammar that are complete once matched. Numbers must be
+# followed by a non-digit, "forward-movement+1" may still become "+10".
+ACTION_PATTERNS = (
+    re.compile(r"\w+-movement\+\d+(?=\D)"),
+    re.compile(r"\w+-rotation\+\d+(?=\D)"),
+    re.compile(r"switch(?:ing)? to view \d+(?=\D)"),
+    re.compile(r"switch(?:ing)? to bird-eye-view"),
+    re.compile(r"look-around"),
+    re.compile(r"zoom\+\d+,\s*\d+,\s*\d+(?=\D)"),
+    re.compile(r"(?:look-at|go-to)\+\d+,\s*\d+(?=\D)"),
+)
+
+
+def strip_think(text: str) -> str:
+    return text.split("</think>")[1] if "</think>" in text else text
+
+
+def action_signature(text: str) -> tuple:
+    """
+    Everything the agent executes for a reply, to compare two replies.
+    """
+    return (
+        extract_patterns(text),
+        "done" in text.lower(),
+        "switch to bird-eye-view" in text,
+        "look-around" in text,
+        extract_zoom(text),
+        extract_target(text),
+    )
+
+
+def early_action(text: str) -> Optional[str]:
+    """
+    The first action of a partial reply once it is unambiguous, or None.
+
+    Nothing is committed inside an open <think> block, nor when "done" or a bare
+    "switch" comes before the action, since the full reply may then mean an answer
+    or a switch back.
+    """
+    if "<think>" in text and "</think>" not in text:
+        return None
+    reply = strip_think(text)
+
+    first = None
+    for pattern in ACTION_PATTERNS:
+        match = pattern.search(reply)
+        if match is not None and (first is None or match.start() < first.start()):
+            first = match
+    if first is None:
+        return None
+
+    prefix = reply[: first.start()].lower()
+    if "done" in prefix or "switch" in prefix:
+        return None
+    return first.group(0)
+
+
+class StreamedReply:
+    """
+    A chat reply generated in a background thread.
+
+    ``action`` returns as soon as the first action is unambiguous, or the whole reply
+    if it never is (e.g. "done+[answer]"). ``wait`` blocks until the reply is complete.
+    """
+
+    def __init__(self, generate: Callable, early_stop: bool = False):
+        self.early_stop = early_stop
+        self.text = ""
+        self.committed = None
+        self.result = None
+        self.error = None
+        self._action_ready = threading.Event()
+
+        # The ledger and replay episode of the question live in context variables.
+        context = contextvars.copy_context()
+        self._thread = threading.Thread(
+            target=context.run, args=(self._run, generate), daemon=True
+        )
+        self._thread.start()
+
+    def _on_delta(self, delta: str) -> bool:
+        self.text += delta
+        if self.committed is None:
+            self.committed = early_action(self.text)
+            if self.committed is not None:
+                self._action_ready.set()
+                return self.early_stop
+        return False
+
+    def _run(self, generate: Callable):
+        try:
+            self.result = generate(self._on_delta)
+        except Exception as e:
+            self.error = e
+        finally:
+            self._action_ready.set()
+
+    def action(self) -> str:
+        self._action_ready.wait()
+        if self.committed is not None:
+            return self.committed
+        return strip_think(self.wait().content)
+
+    def wait(self):
+        """
+        The complete ``LLMResult``, raising the error of the call if it failed.
+        """
+        self._thread.join()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+    def diverged(self) -> bool:
+        """
+        Whether the complete reply asks for other actions than the committed one,
+        e.g. a later action, several actions or an answer.
+        """
+        result = self.wait()
+        if self.committed is None or result.truncated:
+            return False
+        return action_signature(strip_think(result.content)) != action_signature(
+            self.committed
+        )
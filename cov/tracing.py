@@ -0,0 +1,109 @@
+"""
+Lightweight tracing spans written as Chrome trace events or JSONL.
+
+The Chrome format is streamed as an unterminated JSON array, which chrome://tracing
+and Perfetto accept, so a killed run still leaves a readable trace. Several processes
+may append to the same file.
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+from cov.config import OpenEQAConfig
+
+log = logging.getLogger(__name__)
+
+TRACE_FORMATS = ("chrome", "jsonl")
+
+
+class Tracer:
+    def __init__(self, path: Path, fmt: str = "chrome"):
+        if fmt not in TRACE_FORMATS:
+            raise ValueError(f"Unknown trace format {fmt}, expected one of {TRACE_FORMATS}")
+        self.path = Path(path)
+        self.fmt = fmt
+        self.lock = threading.Lock()
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.file = open(self.path, "a", buffering=1)
+        if fmt == "chrome" and self.file.tell() == 0:
+            self.file.write("[\n")
+
+    def write(self, name: str, start_us: float, dur_us: float, attrs: dict):
+        if self.fmt == "chrome":
+            event = {
+                "name": name,
+                "cat": name.split(".")[0],
+                "ph": "X",
+                "ts": start_us,
+                "dur": dur_us,
+                "pid": os.getpid(),
+                "tid": threading.get_ident(),
+                "args": attrs,
+            }
+            line = json.dumps(event, default=str) + ",\n"
+        else:
+            event = {
+                "name": name,
+                "start_us": start_us,
+                "dur_us": dur_us,
+                "pid": os.getpid(),
+                "tid": threading.get_ident(),
+                **attrs,
+            }
+            line = json.dumps(event, default=str) + "\n"
+        with self.lock:
+            self.file.write(line)
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+_tracer = None
+
+
+def configure(config: OpenEQAConfig):
+    """
+    Open the trace file of ``config.trace`` for this process.
+    """
+    global _tracer
+
+    if _tracer is not None:
+        _tracer.close()
+    _tracer = None
+    if config.trace.enabled:
+        _tracer = Tracer(config.trace.path, fmt=config.trace.format)
+        log.info(f"Tracing spans to: {config.trace.path}")
+
+
+def enabled() -> bool:
+    """
+    Whether spans are written in this process.
+    """
+    return _tracer is not None
+
+
+@contextmanager
+def span(name: str, **attrs):
+    """
+    Time the enclosed block. Yields the attribute dict, so attributes known only
+    inside the block can be added to it. A no-op when tracing is disabled.
+    """
+    if _tracer is None:
+        yield attrs
+        return
+
+    start = time.time()
+    try:
+        yield attrs
+    except BaseException as e:
+        attrs["error"] = repr(e)
+        raise
+    finally:
+        end = time.time()
+        _tracer.write(name, start * 1e6, (end - start) * 1e6, attrs)
@@ -1,9 +1,11 @@
+import json
 import logging
 import re
 from pathlib import Path
 
 import numpy as np
 from jinja2 import Environment, FileSystemLoader
+from natsort import natsorted
 from PIL import Image
 
 from cov.config import OpenEQAConfig
@@ -11,20 +13,24 @@ from cov.config import OpenEQAConfig
 log = logging.getLogger(__name__)
 
 
-def extract_patterns(log_text: str):
+def extract_patterns(log_text: str, ordered: bool = False):
     """
     解析日志文本中的多个命令
     返回命令对象列表
+    ordered 为 True 时按出现顺序返回, 并解析宏步骤中的 snapshot (请求中间帧)
     """
     commands = []
     patterns = {
         "movement": re.compile(r"(\w+)-movement\+(\d+)"),
         "rotation": re.compile(r"(\w+)-rotation\+(\d+)"),
         "switch": re.compile(r"switch(?:ing)?(?: to view (\d+))?"),
+        "snapshot": re.compile(r"\bsnapshot\b"),
     }
+    positions = []
 
     # 查找所有movement命令
     for match in patterns["movement"].finditer(log_text):
+        positions.append(match.start())
         commands.append(
             {
                 "type": "movement",
@@ -35,6 +41,7 @@ def extract_patterns(log_text: str):
 
     # 查找所有rotation命令
     for match in patterns["rotation"].finditer(log_text):
+        positions.append(match.start())
         commands.append(
             {
                 "type": "rotation",
@@ -45,6 +52,7 @@ def extract_patterns(log_text: str):
 
     # 查找所有switch命令
     for match in patterns["switch"].finditer(log_text):
+        positions.append(match.start())
         commands.append(
             {
                 "type": "switch",
@@ -54,7 +62,103 @@ def extract_patterns(log_text: str):
             }
         )
 
-    return commands
+    if not ordered:
+        return commands
+
+    # 查找所有snapshot请求
+    for match in patterns["snapshot"].finditer(log_text):
+        positions.append(match.start())
+        commands.append({"type": "snapshot"})
+
+    order = sorted(range(len(commands)), key=lambda i: positions[i])
+    return [commands[i] for i in order]
+
+
+def parse_batch_selection(text: str, num_questions: int, num_views: int) -> dict:
+    """
+    解析批量选视角的 JSON 回复 {"Q1": [..], "Q2": [..]}
+    返回 {问题下标: 视角列表}，无法解析或视角非法的问题不包含在内
+    """
+    match = re.search(r"\{.*\}", text, re.DOTALL)
+    if match is None:
+        return {}
+    try:
+        reply = json.loads(match.group(0))
+    except json.JSONDecodeError:
+        return {}
+    if not isinstance(reply, dict):
+        return {}
+
+    selections = {}
+    for idx in range(num_questions):
+        views = reply.get(f"Q{idx + 1}")
+        if not isinstance(views, list) or not views:
+            continue
+        try:
+            views = [int(v) for v in views]
+        except (TypeError, ValueError):
+            continue
+        if all(0 <= v < num_views for v in views):
+            selections[idx] = views
+    return selections
+
+
+def extract_zoom(text: str):
+    """
+    解析 "zoom+X,Y,F" 放大指令
+    X, Y 为 0-1000 的图像坐标, F 为放大倍数
+    返回 (x, y, factor), 没有放大指令时返回 None
+    """
+    match = re.search(r"zoom\+(\d+),\s*(\d+),\s*(\d+)", text)
+    if match is None:
+        return None
+    x, y, factor = (int(v) for v in match.groups())
+    return min(x, 1000), min(y, 1000), max(factor, 1)
+
+
+def extract_target(text: str):
+    """
+    解析 "look-at+X,Y" 或 "go-to+X,Y" 指向指令
+    X, Y 为 0-1000 的图像坐标
+    返回 (kind, x, y), kind 为 "look-at" 或 "go-to", 没有指向指令时返回 None
+    """
+    match = re.search(r"(look-at|go-to)\+(\d+),\s*(\d+)", text)
+    if match is None:
+        return None
+    return match.group(1), min(int(match.group(2)), 1000), min(int(match.group(3)), 1000)
+
+
+def list_views(ply_path, pose_path: Path, rgb_img_path: Path, sampled: bool = True):
+    """
+    列出场景采样后的视角 pose 文件和对应图像, 不需要创建仿真器
+    sampled 为 False 时返回全部采集帧
+    """
+    view_pose_list = natsorted(
+        [
+            pose_file
+            for pose_file in pose_path.iterdir()
+            if pose_file.is_file() and pose_file.suffix == ".txt"
+        ],
+        key=lambda x: x.stem,
+    )
+
+    view_img_list = natsorted(
+        [
+            img_file
+            for img_file in rgb_img_path.iterdir()
+            if img_file.is_file() and img_file.suffix == ".png"
+        ],
+        key=lambda x: x.stem,
+    )
+
+    if not sampled:
+        return view_pose_list, view_img_list
+    if "hm3d" in str(ply_path):
+        sample_rate = 10
+    else:
+        sample_rate = 60
+
+    return view_pose_list[::sample_rate], view_img_list[::sample_rate]
 
 
 def is_mostly_blank(image_path, threshold=0.9, blank_value=255):
@@ -165,6 +269,11 @@ def get_results_path(config: OpenEQAConfig) -> Path:
     )
 
 
+def get_results_store_path(config: OpenEQAConfig) -> Path:
+    """获取追加写入的结果 JSONL 文件路径"""
+    return get_results_path(config).with_suffix(".jsonl")
+
+
 def extract_answer(text: str) -> str:
     """
     从大模型输出中提取 answer。
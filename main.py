@@ -8,18 +8,23 @@ import logging
 import hydra
 from dotenv import load_dotenv
 
-from cov.agents import cov_agent, baseline_agent
+from cov import ledger, tracing
 from cov.config import OpenEQAConfig
-from cov.utils import get_results_path
+from cov.llm import configure as configure_llm
+from cov.llm import get_stats as get_llm_stats
+from cov.results import ResultsStore
+from cov.runner import run_parallel, run_serial
+from cov.scheduler import group_by_scene
+from cov.utils import get_results_path, get_results_store_path
 
 load_dotenv()
 log = logging.getLogger(__name__)
 
-AGENT_REGISTRY = {"cov": cov_agent, "baseline": baseline_agent}
-
 @hydra.main(version_base=None, config_name="openeqa")
 def main(cfg: OpenEQAConfig):
     log.info(cfg)
+    configure_llm(cfg)
+    tracing.configure(cfg)
 
     # Load OpenEQA questions
     with open(cfg.dataset.question_file, "r") as f:
@@ -28,53 +33,33 @@ def main(cfg: OpenEQAConfig):
     log.info(f"Loaded {len(questions)} questions from {cfg.dataset.question_file}")
 
     result_path = get_results_path(cfg)
-
-    # Load exsiting questions
-    processed_ids = set()
-    results = []
-    if result_path.exists():
-        with open(result_path, "r") as f:
-            results = json.load(f)
-            processed_ids = {r["question_id"] for r in results}
-        log.info(f"Found {len(processed_ids)} already processed questions")
-
-    agent_func = AGENT_REGISTRY[cfg.agent]
-    for idx, item in enumerate(questions):
-        question_id = item["question_id"]
-
-        # Skip exsiting
-        if question_id in processed_ids:
-            log.info(
-                f"Skipping already processed question {idx + 1}/{len(questions)}: {question_id}"
-            )
-            continue
-
-        log.info(f"Processing question {idx + 1}/{len(questions)}: {question_id}")
-
-        try:
-            result = agent_func(
-                episode_history=item["episode_history"],
-                question_id=question_id,
-                question=item["question"],
-                gts=[item["answer"]] if "answer" in item else None,
-                config=cfg,
-            )
-            results.append(result)
-            # Store data instantly in case of losing result data accidently.
-            # Use w mode because original results have been stored.
-            with open(result_path, "w") as f:
-                json.dump(results, f, indent=2, ensure_ascii=False)
-
-            log.info(
-                f"Successfully processed {question_id}, total completed: {len(results)}"
-            )
-
-        except Exception as e:
-            log.exception(f"Failed to process question {question_id}: {e}")
-            continue
+    ledger_path = result_path.with_name(f"{cfg.agent}-cost-ledger.json")
+    run_ledger = ledger.RunLedger(cfg.model)
+
+    # Load exsiting questions, results of older runs in result_path are imported once.
+    results = ResultsStore(
+        get_results_store_path(cfg),
+        fsync_every=cfg.results_fsync_every,
+        legacy_json_path=result_path,
+    )
+    for r in results.values():
+        if "ledger" in r:
+            run_ledger.add(r["ledger"])
+    log.info(f"Found {len(results)} already processed questions")
+
+    scene_groups = group_by_scene(questions, order=cfg.scene_order)
+    if cfg.num_workers > 1:
+        run_parallel(cfg, scene_groups, results, run_ledger, len(questions))
+    else:
+        run_serial(cfg, scene_groups, results, run_ledger, len(questions))
 
     log.info(f"All processing complete. Total results: {len(results)}")
+    results.export_json(result_path)
+    results.close()
     log.info(f"Results saved to: {result_path}")
+    log.info(f"LLM call stats: {get_llm_stats()}")
+    run_ledger.save(ledger_path)
+    log.info(f"Run cost: {run_ledger.summary()['total']}")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,14 @@
+"""
+Helpers shared by the benchmark tools, without simulator dependencies.
+"""
+
+import subprocess
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], text=True, stderr=subprocess.DEVNULL
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
@@ -0,0 +1,104 @@
+"""
+Recall@M of the retrieval pre-filter against the views picked by the LLM.
+
+Takes the results of a run without retrieval, whose ``selected_views`` are the
+LLM's picks over all frames, and measures how many of them survive a top-M
+shortlist of each retrieval backend:
+
+    python -m tools.bench_retrieval --results results/oeqa-hm3d-full/qwen3-vl-flash/cov/3/cov-results.jsonl --backend clip --top-m 5 10 20 40
+"""
+
+import argparse
+import json
+import logging
+import statistics
+import time
+from pathlib import Path
+
+from cov.config import RetrievalConfig
+from cov.results import ResultsStore
+from cov.retrieval import RETRIEVAL_BACKENDS, Retriever
+from cov.utils import list_views, process_openeqa_path
+from tools.bench_common import git_commit
+
+log = logging.getLogger(__name__)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Recall@M of the retrieval pre-filter")
+    parser.add_argument("--results", type=Path, required=True, help="*-results.jsonl store of a cov run")
+    parser.add_argument(
+        "--question-file", type=Path, default=Path("data/open-eqa-hm3d-full.json")
+    )
+    parser.add_argument("--dataset-dir", type=Path, default=Path("data/frames"))
+    parser.add_argument("--backend", choices=RETRIEVAL_BACKENDS, default="hashing")
+    parser.add_argument("--top-m", type=int, nargs="+", default=[5, 10, 20, 40])
+    parser.add_argument("--index-dir", type=Path, default=Path("results/retrieval_index"))
+    parser.add_argument("--output-dir", type=Path, default=Path("bench_results"))
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    with open(args.question_file, "r") as f:
+        questions = {item["question_id"]: item for item in json.load(f)}
+    # The exported JSON drops the view picks, read them from the store.
+    store = ResultsStore(args.results)
+    results = [
+        r
+        for r in store.values()
+        # Picks made over a shortlist would bias the recall upwards.
+        if r.get("selected_views") and r.get("shortlist") is None
+    ]
+    store.close()
+    log.info(f"Evaluating {len(results)} questions with LLM view picks")
+
+    retriever = Retriever(
+        RetrievalConfig(enabled=True, backend=args.backend, index_dir=args.index_dir)
+    )
+    recalls = {m: [] for m in args.top_m}
+    index_s, query_s = 0.0, []
+    for result in results:
+        item = questions[result["question_id"]]
+        episode_history = item["episode_history"]
+        glb_path, pose_path, rgb_img_path = map(
+            lambda x: args.dataset_dir / x, process_openeqa_path(episode_history)
+        )
+        _, view_img_list = list_views(glb_path, pose_path, rgb_img_path)
+
+        start = time.perf_counter()
+        retriever.scene_index(episode_history, view_img_list)
+        index_s += time.perf_counter() - start
+
+        start = time.perf_counter()
+        ranking = retriever.rank(episode_history, item["question"], view_img_list)
+        query_s.append(time.perf_counter() - start)
+
+        picks = set(result["selected_views"])
+        for m in args.top_m:
+            recalls[m].append(len(picks & set(ranking[:m])) / len(picks))
+
+    commit = git_commit()
+    report = {
+        "commit": commit,
+        "timestamp": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "backend": retriever.backend.name,
+        "results": str(args.results),
+        "num_questions": len(results),
+        "recall": {
+            str(m): statistics.mean(values) if values else None
+            for m, values in recalls.items()
+        },
+        "index_s": index_s,
+        "median_query_s": statistics.median(query_s) if query_s else None,
+    }
+    args.output_dir.mkdir(parents=True, exist_ok=True)
+    output_path = args.output_dir / f"retrieval-{args.backend}-{commit}.json"
+    with open(output_path, "w") as f:
+        json.dump(report, f, indent=2)
+
+    for m, recall in report["recall"].items():
+        log.info(f"recall@{m}: {recall}")
+    log.info(f"Benchmark results saved to: {output_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,222 @@
+"""
+Per-stage micro-benchmarks of the CoV pipeline on synthetic scenes.
+
+Generates a synthetic GLB room with pose/frame directories laid out like an HM3D
+episode, times each stage in isolation and writes the results to a JSON file named
+after the current commit, so runs can be diffed between commits:
+
+    python -m tools.bench_stages --repeats 20 --output-dir bench_results/
+"""
+
+import argparse
+import json
+import logging
+import platform
+import statistics
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+import trimesh
+from PIL import Image
+
+from cov.bots import ViewSelectionBot
+from cov.camera import SceneSimulator
+from cov.config import ModelConfig
+from cov.utils import extract_patterns, is_mostly_blank, process_openeqa_path
+from tools.bench_common import git_commit
+from tools.html_generator import HTMLGenerator
+
+log = logging.getLogger(__name__)
+
+STAGES = [
+    "camera_init",
+    "switch_to_view",
+    "screen_shot",
+    "is_mostly_blank",
+    "payload_build",
+    "extract_patterns",
+    "generate_html",
+]
+
+SAMPLE_ACTIONS = [
+    "forward-movement+2",
+    "I will turn to see the wall. left-rotation+30",
+    "switch to view 3",
+    "Moving closer. forward-movement+1 then upward-movement+1 and right-rotation+10",
+    "I'm now verifying my answer by checking view 2. done+[a white air conditioner]",
+]
+
+
+def make_synthetic_scene(
+    root: Path,
+    scene_id: str = "SYNTH",
+    num_frames: int = 200,
+    num_boxes: int = 30,
+    seed: int = 0,
+) -> str:
+    """
+    Write a box room with random furniture, camera poses and frames under ``root``.
+    Returns the episode_history of the scene.
+    """
+    rng = np.random.default_rng(seed)
+    episode_history = f"hm3d-v0/000-hm3d-{scene_id}"
+    glb_path, pose_path, rgb_img_path = map(
+        lambda x: root / x, process_openeqa_path(episode_history)
+    )
+    for path in (glb_path.parent, pose_path, rgb_img_path):
+        path.mkdir(parents=True, exist_ok=True)
+
+    room_size = np.array([8.0, 3.0, 8.0])
+    room = trimesh.creation.box(extents=room_size)
+    room.invert()  # Faces point inward so the walls are visible from inside.
+    room.visual.face_colors = [200, 200, 190, 255]
+    meshes = [room]
+    for _ in range(num_boxes):
+        extents = rng.uniform(0.2, 1.0, size=3)
+        box = trimesh.creation.box(extents=extents)
+        position = rng.uniform(-room_size / 2 + 0.5, room_size / 2 - 0.5)
+        position[1] = -room_size[1] / 2 + extents[1] / 2
+        box.apply_translation(position)
+        box.visual.face_colors = np.append(rng.integers(0, 255, size=3), 255)
+        meshes.append(box)
+    trimesh.util.concatenate(meshes).export(glb_path)
+
+    for idx in range(num_frames):
+        yaw = 2 * np.pi * idx / num_frames
+        pose = np.eye(4)
+        pose[:3, :3] = trimesh.transformations.rotation_matrix(yaw, [0, 1, 0])[:3, :3]
+        pose[:3, 3] = [2.5 * np.cos(yaw), 0.0, 2.5 * np.sin(yaw)]
+        np.savetxt(pose_path / f"{idx:05d}.txt", pose)
+        frame = rng.integers(0, 255, size=(480, 640, 3), dtype=np.uint8)
+        Image.fromarray(frame).save(rgb_img_path / f"comp_{idx:05d}-rgb.png")
+
+    return episode_history
+
+
+def timeit(fn, repeats: int) -> dict:
+    samples = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - start)
+    samples.sort()
+    return {
+        "repeats": repeats,
+        "mean_s": statistics.mean(samples),
+        "median_s": statistics.median(samples),
+        "p90_s": samples[min(len(samples) - 1, int(0.9 * len(samples)))],
+        "min_s": samples[0],
+    }
+
+
+def run_benchmarks(data_dir: Path, episode_history: str, stages: list, repeats: int) -> dict:
+    glb_path, pose_path, rgb_img_path = map(
+        lambda x: data_dir / x, process_openeqa_path(episode_history)
+    )
+    shot_dir = data_dir / "shots"
+    results = {}
+
+    def new_camera():
+        return SceneSimulator(
+            ply_path=glb_path, pose_path=pose_path, rgb_img_path=rgb_img_path
+        ).camera()
+
+    if "camera_init" in stages:
+        # Each construction builds and tears down a simulator, keep the count small.
+        results["camera_init"] = timeit(new_camera, max(1, repeats // 5))
+
+    cam = new_camera()
+    num_views = len(cam.view_pose_list)
+
+    if "switch_to_view" in stages:
+        counter = iter(range(10**9))
+        results["switch_to_view"] = timeit(
+            lambda: cam.switch_to_view(next(counter) % num_views), repeats
+        )
+
+    cam.switch_to_view(0)
+    cam.move_camera("a")
+    shot_path = cam.screen_shot(str(shot_dir))
+    if "screen_shot" in stages:
+        results["screen_shot"] = timeit(lambda: cam.screen_shot(str(shot_dir)), repeats)
+
+    if "is_mostly_blank" in stages:
+        results["is_mostly_blank"] = timeit(lambda: is_mostly_blank(shot_path), repeats)
+
+    if "payload_build" in stages:
+        model_config = ModelConfig(
+            model_name="bench", api_base_env="BENCH_API_BASE", api_key_env="BENCH_API_KEY"
+        )
+        results["payload_build"] = timeit(
+            lambda: ViewSelectionBot(
+                question="What is on the table?",
+                rgb_img_list=cam.view_img_list,
+                model_config=model_config,
+            ),
+            repeats,
+        )
+        results["payload_build"]["num_images"] = len(cam.view_img_list)
+
+    if "extract_patterns" in stages:
+        results["extract_patterns"] = timeit(
+            lambda: [extract_patterns(action) for action in SAMPLE_ACTIONS], repeats
+        )
+
+    if "generate_html" in stages:
+        html_generator = HTMLGenerator("bench", "bench")
+        html_generator.set_question("What is on the table?")
+        html_generator.set_best5(cam.view_img_list[:5])
+        html_generator.set_birdeye(shot_path)
+        for step in range(40):
+            html_generator.add_step(shot_path, SAMPLE_ACTIONS[step % len(SAMPLE_ACTIONS)])
+        results["generate_html"] = timeit(html_generator.generate_html, repeats)
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Per-stage CoV micro-benchmarks")
+    parser.add_argument("--repeats", type=int, default=20)
+    parser.add_argument("--num-frames", type=int, default=200)
+    parser.add_argument("--num-boxes", type=int, default=30)
+    parser.add_argument("--stages", nargs="+", default=STAGES, choices=STAGES)
+    parser.add_argument("--output-dir", type=Path, default=Path("bench_results"))
+    parser.add_argument(
+        "--data-dir",
+        type=Path,
+        default=None,
+        help="where to write the synthetic scene, a temp dir by default",
+    )
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        data_dir = args.data_dir or Path(tmp_dir)
+        episode_history = make_synthetic_scene(
+            data_dir, num_frames=args.num_frames, num_boxes=args.num_boxes
+        )
+        stages = run_benchmarks(data_dir, episode_history, args.stages, args.repeats)
+
+    commit = git_commit()
+    report = {
+        "commit": commit,
+        "timestamp": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "num_frames": args.num_frames,
+        "stages": stages,
+    }
+    args.output_dir.mkdir(parents=True, exist_ok=True)
+    output_path = args.output_dir / f"stages-{commit}.json"
+    with open(output_path, "w") as f:
+        json.dump(report, f, indent=2)
+
+    for name, stats in stages.items():
+        log.info(f"{name:>18}: median {stats['median_s'] * 1000:.2f} ms")
+    log.info(f"Benchmark results saved to: {output_path}")
+
+
+if __name__ == "__main__":
+    main()
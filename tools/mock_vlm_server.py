@@ -0,0 +1,399 @@
+"""
+Local OPENAI compatible mock VLM server for load testing.
+
+Point a model config at it through its api base env var, e.g.
+
+    python -m tools.mock_vlm_server --port 8000 --latency lognormal --latency-mean 2 --error-rate 0.05
+    MOCK_API_BASE=http://127.0.0.1:8000/v1 MOCK_API_KEY=mock python main.py model=mock agent=cov
+"""
+
+import argparse
+import json
+import logging
+import math
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from cov.ratelimit import estimate_tokens
+
+log = logging.getLogger(__name__)
+
+MOVE_DIRECTIONS = ["forward", "backward", "left", "right", "upward", "downward"]
+
+
+class MockPolicy:
+    """
+    Produce CoV style replies, either scripted or randomized.
+    """
+
+    def __init__(self, args):
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.lock = threading.Lock()
+        self.script = None
+        self.script_idx = 0
+        if args.script:
+            with open(args.script, "r") as f:
+                self.script = json.load(f)
+
+    def _num_images(self, messages: list) -> int:
+        return sum(
+            1
+            for m in messages
+            if isinstance(m.get("content"), list)
+            and any(p.get("type") == "image_url" for p in m["content"])
+        )
+
+    def _kind(self, messages: list) -> str:
+        system = next(
+            (m["content"] for m in messages if m.get("role") == "system"), ""
+        )
+        if isinstance(system, list):
+            system = " ".join(p.get("text", "") for p in system)
+        if "select" in system and "viewpoint IDs" in system:
+            return "selection_batch" if "EACH question" in system else "selection"
+        if "actively explore" in system:
+            return "chat"
+        return "answer"
+
+    def _random_action(self, messages: list) -> str:
+        steps = sum(1 for m in messages if m.get("role") == "assistant")
+        if steps >= self.args.min_steps and self.rng.random() < self.args.done_prob:
+            return "I'm now verifying my answer by checking the view. done+[mock answer]"
+        choice = self.rng.random()
+        system = messages[0].get("content") if messages else ""
+        if "look-around" in str(system) and choice < 0.1:
+            return "look-around"
+        if "zoom+X,Y,F" in str(system) and choice > 0.9:
+            x, y = self.rng.randint(0, 1000), self.rng.randint(0, 1000)
+            return f"zoom+{x},{y},{self.rng.choice([2, 4])}"
+        if "look-at+X,Y" in str(system) and choice > 0.85:
+            x, y = self.rng.randint(0, 1000), self.rng.randint(0, 1000)
+            return f"{self.rng.choice(['look-at', 'go-to'])}+{x},{y}"
+        if choice < 0.5:
+            direction = self.rng.choice(MOVE_DIRECTIONS)
+            return f"{direction}-movement+{self.rng.randint(1, 3)}"
+        if choice < 0.8:
+            direction = self.rng.choice(["left", "right"])
+            return f"{direction}-rotation+{self.rng.choice([10, 20, 30, 45, 90])}"
+        return f"switch to view {self.rng.randrange(max(1, self.args.num_views))}"
+
+    def _chat_reply(self, messages: list) -> str:
+        action = self._random_action(messages)
+        system = messages[0].get("content") if messages else ""
+        if "done" in action or "actions per step" not in str(system):
+            return action
+        # Macro steps: a few actions with snapshots in between.
+        actions = [action]
+        for _ in range(self.rng.randint(0, 2)):
+            next_action = self._random_action(messages[:1])
+            if "done" not in next_action:
+                actions += ["snapshot", next_action]
+        return "; ".join(actions)
+
+    def _explanation(self) -> str:
+        # Trailing reasoning after the action, as written by thinking models.
+        if not self.args.tail_words:
+            return ""
+        return " Reasoning: " + " ".join(["the view"] * (self.args.tail_words // 2))
+
+    def reply(self, messages: list) -> str:
+        with self.lock:
+            if self.script is not None:
+                text = self.script[self.script_idx % len(self.script)]
+                self.script_idx += 1
+                return text
+
+            kind = self._kind(messages)
+            if kind == "selection":
+                num_views = max(1, self._num_images(messages))
+                views = self.rng.sample(
+                    range(num_views), min(self.args.max_views, num_views)
+                )
+                return f"selected views: {', '.join(map(str, views))};"
+            if kind == "selection_batch":
+                num_views = max(1, self._num_images(messages))
+                labels = re.findall(r"^\s*(Q\d+):", messages[0]["content"], re.MULTILINE)
+                return json.dumps(
+                    {
+                        label: self.rng.sample(
+                            range(num_views), min(self.args.max_views, num_views)
+                        )
+                        for label in labels
+                    }
+                )
+            if kind == "chat":
+                return self._chat_reply(messages) + self._explanation()
+            return "done+[mock answer]"
+
+    def latency(self) -> float:
+        with self.lock:
+            mean, std = self.args.latency_mean, self.args.latency_std
+            if self.args.latency == "uniform":
+                return self.rng.uniform(max(0.0, mean - std), mean + std)
+            if self.args.latency == "lognormal":
+                # Parametrize by the desired mean and standard deviation.
+                if mean <= 0:
+                    return 0.0
+                sigma2 = math.log(1 + (std / mean) ** 2)
+                mu = math.log(mean) - sigma2 / 2
+                return self.rng.lognormvariate(mu, math.sqrt(sigma2))
+            return mean
+
+    def error_status(self):
+        with self.lock:
+            if self.rng.random() < self.args.error_rate:
+                return self.rng.choice(self.args.error_status)
+        return None
+
+    def malformed(self) -> bool:
+        with self.lock:
+            return self.rng.random() < self.args.malformed_rate
+
+    def completion_tokens(self, text: str) -> int:
+        if self.args.completion_tokens:
+            return self.args.completion_tokens
+        return max(1, len(text) // 4)
+
+
+def to_tool_arguments(name: str, text: str) -> dict:
+    """
+    Arguments of tool ``name`` equivalent to a text protocol reply.
+    """
+    if name == "select_views":
+        return {"view_ids": [int(v) for v in re.findall(r"\d+", text)]}
+    if name == "select_views_batch":
+        return {"selections": json.loads(text)}
+
+    match = re.search(r"(\w+)-(movement|rotation)\+(\d+)", text)
+    if match:
+        return {
+            "action": "move" if match.group(2) == "movement" else "rotate",
+            "direction": match.group(1),
+            "amount": int(match.group(3)),
+        }
+    match = re.search(r"switch to view (\d+)", text)
+    if match:
+        return {"action": "switch_view", "view_id": int(match.group(1))}
+    if "bird-eye-view" in text:
+        return {"action": "bird_eye_view"}
+    if "look-around" in text:
+        return {"action": "look_around"}
+    match = re.search(r"zoom\+(\d+),(\d+),(\d+)", text)
+    if match:
+        x, y, factor = map(int, match.groups())
+        return {"action": "zoom", "x": x, "y": y, "factor": factor}
+    match = re.search(r"(look-at|go-to)\+(\d+),(\d+)", text)
+    if match:
+        action = match.group(1).replace("-", "_")
+        return {"action": action, "x": int(match.group(2)), "y": int(match.group(3))}
+    return {"action": "answer", "answer": text.split("done+", 1)[-1].strip("[]")}
+
+
+def _stream_chunks(text: str, size: int = 4):
+    for start in range(0, len(text), size):
+        yield text[start : start + size]
+
+
+def make_handler(policy: MockPolicy):
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            log.debug(format % args)
+
+        def _send_json(self, status: int, body: dict, headers: dict = None):
+            data = json.dumps(body).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            for key, value in (headers or {}).items():
+                self.send_header(key, value)
+            self.end_headers()
+            self.wfile.write(data)
+
+        def _send_stream(self, request: dict, text: str, usage: dict):
+            """
+            Server-sent events in the OPENAI chunk format, about one token per chunk.
+            """
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Cache-Control", "no-cache")
+            self.end_headers()
+
+            chunk = {
+                "id": f"chatcmpl-{uuid.uuid4().hex}",
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": request.get("model", policy.args.model),
+            }
+
+            def send(choices, **extra):
+                event = dict(chunk, choices=choices, **extra)
+                self.wfile.write(f"data: {json.dumps(event)}\n\n".encode("utf-8"))
+                self.wfile.flush()
+
+            try:
+                for piece in _stream_chunks(text):
+                    send([{"index": 0, "delta": {"content": piece}, "finish_reason": None}])
+                    time.sleep(policy.args.token_latency)
+                send([{"index": 0, "delta": {}, "finish_reason": "stop"}])
+                if (request.get("stream_options") or {}).get("include_usage"):
+                    send([], usage=usage)
+                self.wfile.write(b"data: [DONE]\n\n")
+            except (BrokenPipeError, ConnectionResetError):
+                log.debug("Client closed the stream early")
+
+        def do_GET(self):
+            if self.path.rstrip("/").endswith("/models"):
+                self._send_json(
+                    200,
+                    {"object": "list", "data": [{"id": policy.args.model, "object": "model"}]},
+                )
+            else:
+                self._send_json(404, {"error": {"message": "not found"}})
+
+        def do_POST(self):
+            if not self.path.rstrip("/").endswith("/chat/completions"):
+                self._send_json(404, {"error": {"message": "not found"}})
+                return
+
+            length = int(self.headers.get("Content-Length", 0))
+            request = json.loads(self.rfile.read(length) or b"{}")
+            messages = request.get("messages", [])
+
+            time.sleep(policy.latency())
+
+            status = policy.error_status()
+            if status is not None:
+                self._send_json(
+                    status,
+                    {"error": {"message": f"mock error {status}", "code": status}},
+                    headers={"Retry-After": "1"} if status == 429 else {},
+                )
+                return
+
+            text = policy.reply(messages)
+            tool_calls = None
+            if policy.malformed():
+                text = "I am not sure which action to take here."
+            elif request.get("tools"):
+                name = request["tools"][0]["function"]["name"]
+                tool_calls = [
+                    {
+                        "id": f"call_{uuid.uuid4().hex[:12]}",
+                        "type": "function",
+                        "function": {
+                            "name": name,
+                            "arguments": json.dumps(to_tool_arguments(name, text)),
+                        },
+                    }
+                ]
+            prompt_tokens = int(estimate_tokens(messages) * policy.args.prompt_token_scale)
+            completion_tokens = policy.completion_tokens(text)
+            usage = {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+            }
+            if request.get("stream"):
+                self._send_stream(request, text, usage)
+                return
+
+            self._send_json(
+                200,
+                {
+                    "id": f"chatcmpl-{uuid.uuid4().hex}",
+                    "object": "chat.completion",
+                    "created": int(time.time()),
+                    "model": request.get("model", policy.args.model),
+                    "choices": [
+                        {
+                            "index": 0,
+                            "message": {
+                                "role": "assistant",
+                                "content": None if tool_calls else text,
+                                "tool_calls": tool_calls,
+                            },
+                            "finish_reason": "tool_calls" if tool_calls else "stop",
+                        }
+                    ],
+                    "usage": usage,
+                },
+            )
+
+    return Handler
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Mock OPENAI compatible VLM server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--model", default="mock-vlm")
+    parser.add_argument(
+        "--script",
+        default=None,
+        help="JSON list of replies returned in order (cycled) instead of random actions",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--latency", choices=["fixed", "uniform", "lognormal"], default="fixed"
+    )
+    parser.add_argument("--latency-mean", type=float, default=0.5, help="seconds")
+    parser.add_argument("--latency-std", type=float, default=0.2, help="seconds")
+    parser.add_argument(
+        "--token-latency",
+        type=float,
+        default=0.0,
+        help="seconds between streamed chunks, --latency is the time to first chunk",
+    )
+    parser.add_argument(
+        "--tail-words",
+        type=int,
+        default=0,
+        help="words of reasoning appended after each chat action",
+    )
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--error-status", type=int, nargs="+", default=[429, 503])
+    parser.add_argument(
+        "--malformed-rate",
+        type=float,
+        default=0.0,
+        help="fraction of replies without any action or tool call",
+    )
+    parser.add_argument("--num-views", type=int, default=20, help="for 'switch to view N'")
+    parser.add_argument("--max-views", type=int, default=5, help="views per selection")
+    parser.add_argument("--min-steps", type=int, default=3)
+    parser.add_argument("--done-prob", type=float, default=0.3)
+    parser.add_argument(
+        "--completion-tokens",
+        type=int,
+        default=0,
+        help="fixed completion tokens to report, 0 estimates from the reply",
+    )
+    parser.add_argument(
+        "--prompt-token-scale",
+        type=float,
+        default=1.0,
+        help="multiplier on the estimated prompt tokens reported in usage",
+    )
+    return parser.parse_args()
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    args = parse_args()
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(MockPolicy(args)))
+    log.info(f"Mock VLM server listening on http://{args.host}:{args.port}/v1")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()